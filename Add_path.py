@@ -1,8 +1,14 @@
+import logging
 from pathlib import Path, PurePath
 from sys import path
 from typing import Union
 
+logger = logging.getLogger(__name__)
+
 class Add_path():
+    # Paths already added (or found) by add_path, so a repeat call does not scan sys.path.
+    _added = set()
+
     @classmethod
     def add_path(cls, newPath: Union[str, PurePath]) -> list:
         """
@@ -15,11 +21,14 @@ class Add_path():
         """
         strPath = str(newPath) if isinstance(newPath, PurePath) else newPath
 
+        if strPath in cls._added:
+            return strPath
         if strPath in path:
-            print(f'path: {newPath} is already on sys.path. (No action taken.)')
+            logger.debug(f'path: {newPath} is already on sys.path. (No action taken.)')
         else:
-            print(f'Adding new path: {strPath} to sys.path.')
+            logger.debug(f'Adding new path: {strPath} to sys.path.')
             path.append(strPath)
+        cls._added.add(strPath)
         return strPath
 
     @classmethod
@@ -0,0 +1,232 @@
+import logging
+import sys
+from array import array
+from typing import Any, Callable, Iterator, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+* AstArena is a structure of arrays. A node is only an index into parallel array.array columns,
+*   so a node costs a few dozen bytes instead of a Python object with a __dict__.
+* The children of all nodes live in one flat array. Each node records the offset and count of its slice.
+*   This works because the parser builds the tree bottom-up: the children always exist before their parent.
+* append_arena copies a range of nodes with array slices; only columns whose values move are rewritten.
+* AstNode is a __slots__ view of (arena, index) that is made on demand; the arena never holds AstNode objects.
+"""
+
+class AstArena:
+    """
+    Array-backed storage for an abstract syntax tree.
+    Each node has a kind, an optional value, its child indices, and its source span (start, end, line).
+    """
+    def __init__(self):
+        self._kind_names = []    # kind id -> kind name
+        self._kind_ids = {}      # kind name -> kind id
+        self._kinds = array('H')
+        self._starts = array('q')
+        self._ends = array('q')
+        self._lines = array('l')
+        self._child_offsets = array('q')
+        self._child_counts = array('l')
+        self._children = array('q')
+        self._values = []
+        self.root = -1
+
+    def __len__(self) -> int:
+        return len(self._kinds)
+
+    def add(self, kind: str, children: Sequence[int] = (), value: Any = None, start: int = 0, end: int = 0, lineno: int = 0) -> int:
+        """
+        Add a node.
+        :param kind: node kind, like 'proc' or 'binop'
+        :param children: indices of nodes already in this arena
+        :param value: leaf or operator value, like 'MEANS', '+' or 42
+        :param start: offset of the first char in the source
+        :param end: offset after the last char in the source
+        :param lineno: line of the first token
+        :return: index of the new node
+        """
+        self._kinds.append(self._kind_id(kind))
+        self._starts.append(start)
+        self._ends.append(end)
+        self._lines.append(lineno)
+        self._child_offsets.append(len(self._children))
+        self._child_counts.append(len(children))
+        self._children.extend(children)
+        self._values.append(value)
+        return len(self._kinds) - 1
+
+    def _kind_id(self, kind: str) -> int:
+        kind_id = self._kind_ids.get(kind)
+        if kind_id is None:
+            kind_id = len(self._kind_names)
+            self._kind_names.append(kind)
+            self._kind_ids[kind] = kind_id
+        return kind_id
+
+    def kind(self, index: int) -> str:
+        return self._kind_names[self._kinds[index]]
+
+    def value(self, index: int) -> Any:
+        return self._values[index]
+
+    def span(self, index: int) -> Tuple[int, int]:
+        return self._starts[index], self._ends[index]
+
+    def lineno(self, index: int) -> int:
+        return self._lines[index]
+
+    def children(self, index: int) -> Sequence[int]:
+        offset = self._child_offsets[index]
+        return self._children[offset:offset + self._child_counts[index]]
+
+    def node(self, index: int) -> 'AstNode':
+        return AstNode(self, index)
+
+    def walk(self, index: int = None) -> Iterator[int]:
+        """
+        Visit the subtree in pre-order (parent before children, children left to right).
+        :param index: root of the subtree. If None, use the root of the tree.
+        :return: iterator of node indices
+        """
+        if index is None:
+            index = self.root
+        if index < 0:
+            return
+        stack = [index]
+        while stack:
+            i = stack.pop()
+            yield i
+            stack.extend(reversed(self.children(i)))
+
+    def find(self, kind: str, index: int = None) -> Iterator[int]:
+        """
+        Find the nodes of the given kind, in pre-order.
+        :param kind: node kind, like 'proc'
+        :param index: root of the subtree. If None, use the root of the tree.
+        :return: iterator of node indices
+        """
+        kind_id = self._kind_ids.get(kind)
+        if kind_id is None:
+            return
+        kinds = self._kinds
+        for i in self.walk(index):
+            if kinds[i] == kind_id:
+                yield i
+
+    def append_arena(self, other: 'AstArena', roots: Sequence[int], shift: int = 0, line_shift: int = 0,
+                     offset_map: Callable[[int], int] = None, lo: int = 0, hi: int = None) -> List[int]:
+        """
+        Copy a range of nodes of another arena into this one (for example, a cached subtree).
+        The children of the nodes in the range must also be in the range.
+        :param other: arena to copy from
+        :param roots: indices (in other) of the nodes whose new indices are wanted
+        :param shift: added to every start and end
+        :param line_shift: added to every line
+        :param offset_map: if given, maps each (shifted) start and end instead
+        :param lo: first node to copy
+        :param hi: node after the last one to copy. If None, copy to the end.
+        :return: the new indices of roots
+        """
+        if hi is None:
+            hi = len(other._kinds)
+        base = len(self._kinds)
+        n = len(other._kinds)
+        child_lo = other._child_offsets[lo] if lo < n else len(other._children)
+        child_hi = other._child_offsets[hi] if hi < n else len(other._children)
+        child_shift = len(self._children) - child_lo
+        node_shift = base - lo
+        kind_map = [self._kind_id(name) for name in other._kind_names]
+        kinds = other._kinds[lo:hi]
+        if kind_map != list(range(len(kind_map))):
+            kinds = array('H', [kind_map[k] for k in kinds])
+        self._kinds.extend(kinds)
+        if offset_map is not None:
+            self._starts.extend(array('q', [offset_map(x + shift) for x in other._starts[lo:hi]]))
+            # Map the last char of the span, so a removed comment just after it is not included.
+            self._ends.extend(array('q', [offset_map(x + shift - 1) + 1 if x + shift else 0 for x in other._ends[lo:hi]]))
+        else:
+            self._starts.extend(self._shifted(other._starts[lo:hi], shift))
+            self._ends.extend(self._shifted(other._ends[lo:hi], shift))
+        self._lines.extend(self._shifted(other._lines[lo:hi], line_shift))
+        self._child_offsets.extend(self._shifted(other._child_offsets[lo:hi], child_shift))
+        self._child_counts.extend(other._child_counts[lo:hi])
+        self._children.extend(self._shifted(other._children[child_lo:child_hi], node_shift))
+        self._values.extend(other._values[lo:hi])
+        return [r + node_shift for r in roots]
+
+    @staticmethod
+    def _shifted(column: array, shift: int) -> array:
+        return column if shift == 0 else array(column.typecode, [x + shift for x in column])
+
+    def nbytes(self) -> int:
+        """
+        Approximate memory used by the arena (the arrays and the values list, not the values themselves).
+        :return: size in bytes
+        """
+        columns = (self._kinds, self._starts, self._ends, self._lines, self._child_offsets, self._child_counts, self._children)
+        return sum(col.itemsize * len(col) for col in columns) + sys.getsizeof(self._values)
+
+    def dump(self, index: int = None) -> List[str]:
+        """
+        Format the subtree, one node per line, indented by depth.
+        :param index: root of the subtree. If None, use the root of the tree.
+        :return: list of lines
+        """
+        if index is None:
+            index = self.root
+        ans = []
+        if index < 0:
+            return ans
+        stack = [(index, 0)]
+        while stack:
+            i, depth = stack.pop()
+            value = self._values[i]
+            suffix = '' if value is None else f' {value!r}'
+            ans.append(f'{"  " * depth}{self.kind(i)}{suffix}')
+            stack.extend((c, depth + 1) for c in reversed(self.children(i)))
+        return ans
+
+
+class AstNode:
+    """
+    Lightweight view of one node in an AstArena.
+    """
+    __slots__ = ('arena', 'index')
+
+    def __init__(self, arena: AstArena, index: int):
+        self.arena = arena
+        self.index = index
+
+    @property
+    def kind(self) -> str:
+        return self.arena.kind(self.index)
+
+    @property
+    def value(self) -> Any:
+        return self.arena.value(self.index)
+
+    @property
+    def span(self) -> Tuple[int, int]:
+        return self.arena.span(self.index)
+
+    @property
+    def lineno(self) -> int:
+        return self.arena.lineno(self.index)
+
+    @property
+    def children(self) -> List['AstNode']:
+        return [AstNode(self.arena, c) for c in self.arena.children(self.index)]
+
+    def __iter__(self) -> Iterator['AstNode']:
+        return iter(self.children)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, AstNode) and self.arena is other.arena and self.index == other.index
+
+    def __hash__(self) -> int:
+        return hash((id(self.arena), self.index))
+
+    def __repr__(self) -> str:
+        return f'AstNode({self.index}, {self.kind!r}, {self.value!r})'
@@ -0,0 +1,400 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from CompilerUtil import PassManager, SasCompilerUtil
+from EmitterUtil import EmitterHelpers, PandasEmitterUtil
+from ParserUtil import ParseTableCache, SasParser
+
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+* Each worker process builds its parser once, in the pool initializer, and reuses it for every file it is given.
+* The workers also keep one EmitterHelpers, so the emitter fragments (banners, preamble) are built once per worker.
+* The parent warms the on-disk parse table cache before starting the pool, so the workers only load tables.
+* CompileCache is content addressed: the file name is a hash of the program, the grammar, the compiler settings and
+*   the emitter settings, so an entry never goes stale and workers can share the dir. Entries are written to a temp file
+*   and moved into place with os.replace; the mtime of an entry is its last use, for LRU eviction.
+* Pool workers only report the bytes they add to the cache; the parent keeps the one size count and evicts,
+*   so N workers cannot each fill the dir up to the bound.
+"""
+
+
+class CompileCache:
+    """
+    On-disk cache of emitted programs, keyed by a hash of the SAS program, the grammar of the parser class,
+    the compiler settings, and the emitter class and options. A hit is copied to the target without parsing or emitting.
+    The dir is bounded to max_bytes by removing the least recently used entries.
+    """
+    env_var = 'COMPILE_CACHE_DIR'
+    # Part of every key. Change it when the format of the entries changes.
+    version = '1'
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = 1 << 30, evict: bool = True):
+        """
+        :param cache_dir: directory for the entries. If None, use $COMPILE_CACHE_DIR or ~/.cache/Compiler/compiled.
+        :param max_bytes: size bound of the dir
+        :param evict: evict in put(). False in a pool worker, whose parent counts the bytes put (see added())
+        """
+        if not cache_dir:
+            cache_dir = os.environ.get(self.env_var) or os.path.join(os.path.expanduser('~'), '.cache', 'Compiler', 'compiled')
+        self._cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.auto_evict = evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None   # bytes in the dir, estimated since the last scan
+
+    @property
+    def cache_dir(self) -> str:
+        return self._cache_dir
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def key(self, source: str, parser_class: type, emitter_class: type, emitter_options: dict = None,
+            compiler_settings: dict = None) -> str:
+        """
+        :param source: path of the .sas file
+        :param parser_class: SasParser or one of its children
+        :param emitter_class: EmitterUtil or one of its children
+        :param emitter_options: keywords for emitter_class
+        :param compiler_settings: SasCompilerUtil.settings of the compiler (passes, fuse, expression options)
+        :return: hex digest
+        """
+        h = hashlib.sha256()
+        h.update(f'{self.version}|{ParseTableCache.grammar_hash(parser_class)}|'
+                 f'{emitter_class.__module__}.{emitter_class.__qualname__}|{sorted((emitter_options or {}).items())!r}|'
+                 f'{json.dumps(compiler_settings or {}, sort_keys=True)}|'.encode())
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.py')
+
+    def get(self, key: str, target: str) -> bool:
+        """
+        Copy the entry to the target, if it is in the cache.
+        :param key: from key()
+        :param target: path of the .py file to write
+        :return: True on a hit
+        """
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            shutil.copyfile(path, target)
+            os.utime(path)
+        except FileNotFoundError:
+            # Not cached, or removed by another worker since.
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def put(self, key: str, emitted: str) -> int:
+        """
+        Add an emitted program to the cache. Readers see the old entry or the whole new one, never a partial file.
+        :param key: from key()
+        :param emitted: path of the emitted .py file
+        :return: bytes added (0 if it could not be written)
+        """
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        except OSError as e:
+            logger.warning(f'Cannot write to the compile cache {self.cache_dir}: {e}.')
+            return 0
+        try:
+            with os.fdopen(fd, 'wb') as f, open(emitted, 'rb') as src:
+                shutil.copyfileobj(src, f)
+            os.replace(tmp, self.path(key))
+            size = os.path.getsize(self.path(key))
+        except OSError as e:
+            logger.warning(f'Cannot write to the compile cache {self.cache_dir}: {e}.')
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            return 0
+        if self.auto_evict:
+            self.added(size)
+        return size
+
+    def added(self, size: int):
+        """
+        Count bytes put in the dir (by this process, or by a worker that does not evict), and evict if over max_bytes.
+        There must be one counting process per dir: each one only sees the bytes it is told about.
+        :param size: bytes added
+        """
+        if self._size is None:
+            # The scan sees the new entries too.
+            self._size = self.scan()[1] if os.path.isdir(self.cache_dir) else 0
+        else:
+            self._size += size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def scan(self) -> tuple:
+        """
+        :return: tuple of (list of (mtime, size, path) of the entries, oldest first; total bytes)
+        """
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.py'):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        return entries, sum(e[1] for e in entries)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the dir is within max_bytes.
+        """
+        entries, size = self.scan()
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass    # Evicted by another worker.
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        for _, _, path in self.scan()[0]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._size = 0
+
+# The warm parser, emitter helpers and compile cache of this worker process. Set by _init_worker.
+_worker_parser = None
+_worker_helpers = None
+_worker_cache = None
+
+
+def _init_worker(parser_class: type, table_dir: str, cache_dir: str = None, cache_max_bytes: int = None, cache_evict: bool = True):
+    global _worker_parser, _worker_helpers, _worker_cache
+    _worker_parser = parser_class(table_dir=table_dir)
+    _worker_helpers = EmitterHelpers()
+    _worker_cache = CompileCache(cache_dir, max_bytes=cache_max_bytes, evict=cache_evict) if cache_dir else None
+
+
+def _init_pool_worker(*initargs):
+    # Only in a pool process: the INFO and DEBUG records of every file would flood the parent's log.
+    # (Run in the caller's process, this would silence its logging for good.)
+    logging.disable(logging.INFO)
+    # The parent evicts, from the cache_bytes of the records.
+    _init_worker(*initargs, cache_evict=False)
+
+
+def compile_file(source: str, target: str, parser: SasParser, emitter_class: type = PandasEmitterUtil, emitter_options: dict = None,
+                 helpers: EmitterHelpers = None, cache: Optional[CompileCache] = None, compiler_options: dict = None) -> dict:
+    """
+    Compile one SAS program with SasCompilerUtil and write the emitted Python program.
+    :param source: path of the .sas file
+    :param target: path of the .py file to write
+    :param parser: a (warm) parser instance
+    :param emitter_class: EmitterUtil child for the emit pass
+    :param emitter_options: keywords for emitter_class
+    :param helpers: emitter helpers shared by the batch
+    :param cache: if given, a program compiled before with the same settings is copied from here
+    :param compiler_options: keywords for SasCompilerUtil, like {'fuse': False}
+    :return: manifest record with the status and timings (and cache_bytes, the bytes added to the cache)
+    """
+    record = {'source': source, 'target': target, 'status': 'ok', 'error': None}
+    start = time.perf_counter()
+    try:
+        # A compiler per file, so nothing of one program (like its interned expressions) outlives it.
+        compiler = SasCompilerUtil(parser=parser, emitter_class=emitter_class, emitter_options=emitter_options, helpers=helpers,
+                                   **(compiler_options or {}))
+        if cache is not None:
+            key = cache.key(source, type(parser), emitter_class, emitter_options, compiler_settings=compiler.settings)
+            if cache.get(key, target):
+                record['cache'] = 'hit'
+                record['total_seconds'] = time.perf_counter() - start
+                return record
+            record['cache'] = 'miss'
+        with open(source, encoding='utf-8') as f:
+            text = f.read()
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        # The emit pass streams the program to the target.
+        unit = compiler.compile(text, name=source, target=target)
+        totals = PassManager.totals(unit.stats)
+        record['parse_seconds'] = sum(totals[name]['wall_seconds'] for name in ('lex', 'parse'))
+        record['emit_seconds'] = totals['emit']['wall_seconds']
+        if unit.diagnostics:
+            # Every syntax error of the file, from one parse. Nothing is written (or cached) for it.
+            record['status'] = 'error'
+            record['error'] = f'{len(unit.diagnostics)} syntax error(s)'
+            record['diagnostics'] = [str(d) for d in unit.diagnostics]
+            del record['emit_seconds']
+        elif cache is not None:
+            record['cache_bytes'] = cache.put(key, target)
+    except Exception as e:
+        logger.error(f'Could not compile {source}: {e}')
+        record['status'] = 'error'
+        record['error'] = f'{type(e).__name__}: {e}'
+    record['total_seconds'] = time.perf_counter() - start
+    return record
+
+
+def _compile_in_worker(job: tuple) -> dict:
+    source, target, emitter_class, emitter_options, compiler_options = job
+    return compile_file(source, target, _worker_parser, emitter_class=emitter_class, emitter_options=emitter_options,
+                        helpers=_worker_helpers, cache=_worker_cache, compiler_options=compiler_options)
+
+
+class BatchCompiler:
+    """
+    Compile a directory of SAS programs on a process pool.
+    Writes one .py file per .sas file, plus a manifest of the status and timing of each file.
+    """
+    manifest_name = 'manifest.json'
+
+    def __init__(self, out_dir: str, workers: int = None, parser_class: type = SasParser, emitter_class: type = PandasEmitterUtil,
+                 emitter_options: dict = None, table_dir: str = None, pattern: str = '*.sas', chunksize: int = 8,
+                 cache_dir: str = None, cache_max_bytes: int = 1 << 30, compiler_options: dict = None):
+        """
+        :param out_dir: directory for the emitted programs and the manifest
+        :param workers: number of worker processes. If None, use os.cpu_count().
+        :param parser_class: SasParser or one of its children
+        :param emitter_class: EmitterUtil child for the emit pass
+        :param emitter_options: keywords for emitter_class
+        :param table_dir: directory for the cached parse tables (see ParseTableCache)
+        :param pattern: glob for the programs to compile
+        :param chunksize: files sent to a worker at a time
+        :param cache_dir: directory of the compile cache (see CompileCache). If None, every file is compiled.
+        :param cache_max_bytes: size bound of the compile cache
+        :param compiler_options: keywords for SasCompilerUtil, like {'fuse': False}
+        """
+        self.out_dir = out_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.parser_class = parser_class
+        self.emitter_class = emitter_class
+        self.emitter_options = emitter_options or {}
+        self.table_dir = ParseTableCache(table_dir).table_dir
+        self.pattern = pattern
+        self.chunksize = chunksize
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.compiler_options = compiler_options or {}
+
+    def find_sources(self, src_dir: str) -> List[str]:
+        """
+        Find the programs to compile, recursively and in sorted order.
+        :param src_dir: root dir of the SAS programs
+        :return: list of paths
+        """
+        return sorted(str(p) for p in Path(src_dir).rglob(self.pattern) if p.is_file())
+
+    def target_for(self, source: str, src_dir: str) -> str:
+        """
+        Map a source path to its output path, keeping the relative dir structure.
+        :param source: path of the .sas file
+        :param src_dir: root dir of the SAS programs
+        :return: path of the .py file
+        """
+        rel = Path(source).relative_to(src_dir).with_suffix('.py')
+        return str(Path(self.out_dir) / rel)
+
+    def compile_dir(self, src_dir: str) -> List[dict]:
+        """
+        Compile every matching program under src_dir and write the manifest.
+        :param src_dir: root dir of the SAS programs
+        :return: list of manifest records, in source order
+        """
+        sources = self.find_sources(src_dir)
+        jobs = [(src, self.target_for(src, src_dir), self.emitter_class, self.emitter_options, self.compiler_options)
+                for src in sources]
+        # Build the tables once here, so no worker has to.
+        self.parser_class(table_dir=self.table_dir)
+        start = time.perf_counter()
+        initargs = (self.parser_class, self.table_dir, self.cache_dir, self.cache_max_bytes)
+        if self.workers == 1 or len(jobs) <= 1:
+            _init_worker(*initargs)
+            records = [_compile_in_worker(job) for job in jobs]
+        else:
+            # The workers do not evict: each would only count its own writes. This one cache counts them all.
+            cache = CompileCache(self.cache_dir, max_bytes=self.cache_max_bytes) if self.cache_dir else None
+            if cache is not None:
+                cache.added(0)  # Take the size of the dir before the workers add to it.
+            records = []
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_pool_worker, initargs=initargs) as pool:
+                for record in pool.map(_compile_in_worker, jobs, chunksize=self.chunksize):
+                    records.append(record)
+                    if cache is not None and record.get('cache_bytes'):
+                        cache.added(record['cache_bytes'])
+        elapsed = time.perf_counter() - start
+        self.write_manifest(records, elapsed)
+        failed = sum(1 for r in records if r['status'] != 'ok')
+        logger.info(f'Compiled {len(records)} programs ({failed} failed) in {elapsed:.3f} s with {self.workers} workers.')
+        return records
+
+    def write_manifest(self, records: List[dict], elapsed: float) -> str:
+        """
+        Write the manifest as JSON.
+        :param records: list of manifest records
+        :param elapsed: wall time of the whole batch
+        :return: path of the manifest
+        """
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, self.manifest_name)
+        manifest = {
+            'workers': self.workers,
+            'files': len(records),
+            'failed': sum(1 for r in records if r['status'] != 'ok'),
+            'cache_hits': sum(1 for r in records if r.get('cache') == 'hit'),
+            'cache_misses': sum(1 for r in records if r.get('cache') == 'miss'),
+            'elapsed_seconds': elapsed,
+            'results': records,
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        return path
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description='Compile a directory of SAS programs to Python.')
+    ap.add_argument('src_dir', help='directory of .sas files')
+    ap.add_argument('out_dir', help='directory for the .py files and manifest.json')
+    ap.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    ap.add_argument('--table-dir', default=None, help='directory for the cached parse tables')
+    ap.add_argument('--pattern', default='*.sas', help='glob of the programs to compile')
+    ap.add_argument('--cache-dir', default=None, help='directory of the compile cache (default: no cache)')
+    ap.add_argument('--cache-max-mb', type=int, default=1024, help='size bound of the compile cache')
+    args = ap.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    bc = BatchCompiler(out_dir=args.out_dir, workers=args.workers, table_dir=args.table_dir, pattern=args.pattern,
+                       cache_dir=args.cache_dir, cache_max_bytes=args.cache_max_mb << 20)
+    records = bc.compile_dir(args.src_dir)
+    return 1 if any(r['status'] != 'ok' for r in records) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
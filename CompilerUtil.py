@@ -1,7 +1,13 @@
 import logging
+import time
 from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from AstUtil import AstArena
+from EmitterUtil import EmitterHelpers, PandasEmitterUtil, Target
+from ExpressionUtil import Expr, ExpressionUtil
+from ParserUtil import SasParser
 
-logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 """
@@ -11,8 +17,196 @@ Interesting Python features:
 *
 * These classes are also following an Adapter Design Pattern.    
 *   This is paired with ParserUtil for parsing source text and EmitterUtil for generating target text.
+*
+* PassManager runs the registered passes in order on a CompilationUnit, and records the wall time (perf_counter),
+*   CPU time (process_time), and input and output sizes of each pass, so the slow phase can be measured, not guessed.
+* The parser recovers from syntax errors, so one compile lists all of them in unit.diagnostics.
+*   The analyze pass leaves out the statements and steps that hold an 'error' node; the rest is still emitted.
+* The fuse pass merges back-to-back PROC MEANS steps of one dataset, so the emitted program reads it once
+*   for all of them, and then takes the output of each step from that one aggregation.
+* The dependencies pass builds a StepGraph: the DAG of the steps from the datasets they read and write.
+*   An emitter with parallel=True uses it to run the independent steps of the program at the same time.
 """
 
+# A pass takes the unit and returns its (input size, output size).
+CompilerPass = Callable[['CompilationUnit'], Tuple[int, int]]
+
+
+class CompilationUnit:
+    """
+    One program on its way through the passes. Each pass reads what the one before it left here.
+    """
+    def __init__(self, source: str, name: str = '<string>', target: Target = None):
+        """
+        :param source: SAS program text
+        :param name: name of the unit in the statistics, like its path
+        :param target: path or text stream. If given, the emit pass writes the program there (see EmitterUtil.emit_to)
+          instead of keeping it in lines. Nothing is written for a program with diagnostics.
+        """
+        self.name = name
+        self.source = source
+        self.target = target
+        self.tokens = []
+        self.ast = None
+        self.procs = []         # list of (proc_type, options); the options of fused steps are under 'STEPS'
+        self.expressions = []   # list of Expr
+        self.lines = []
+        self.stats = []
+        self.diagnostics = []   # list of Diagnostic, from the lex and parse passes
+        self.graph = None       # StepGraph of the procs, then (if any) the expressions
+
+
+class PassManager:
+    """
+    An ordered list of named compiler passes, with timing of each pass.
+    """
+    def __init__(self):
+        self._passes = []
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _ in self._passes]
+
+    def register(self, name: str, compiler_pass: CompilerPass, before: str = None, after: str = None):
+        """
+        Add a pass. It goes at the end, unless before or after names a registered pass.
+        A pass with the name of a registered pass replaces it, in its place.
+        :param name: pass name, like 'parse'
+        :param compiler_pass: function of the unit that returns its (input size, output size)
+        :param before: name of the pass to run this one before
+        :param after: name of the pass to run this one after
+        """
+        names = self.names
+        if name in names:
+            self._passes[names.index(name)] = (name, compiler_pass)
+            return
+        if before is not None:
+            position = names.index(before)
+        elif after is not None:
+            position = names.index(after) + 1
+        else:
+            position = len(names)
+        self._passes.insert(position, (name, compiler_pass))
+
+    def remove(self, name: str):
+        self._passes = [(n, p) for n, p in self._passes if n != name]
+
+    def run(self, unit: CompilationUnit) -> List[dict]:
+        """
+        Run the passes in order on the unit.
+        :param unit: CompilationUnit
+        :return: one record per pass (also appended to unit.stats)
+        """
+        for name, compiler_pass in self._passes:
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            input_size, output_size = compiler_pass(unit)
+            record = {
+                'unit': unit.name,
+                'pass': name,
+                'wall_seconds': time.perf_counter() - wall,
+                'cpu_seconds': time.process_time() - cpu,
+                'input_size': input_size,
+                'output_size': output_size,
+            }
+            unit.stats.append(record)
+            logger.debug(f'{unit.name}: pass {name} took {record["wall_seconds"]:.6f} s ({input_size} -> {output_size})')
+        return unit.stats
+
+    @staticmethod
+    def totals(records: List[dict]) -> Dict[str, dict]:
+        """
+        Sum the records of many units by pass.
+        :param records: records from run()
+        :return: dict of pass name -> {'wall_seconds', 'cpu_seconds', 'input_size', 'output_size', 'units'}, in pass order
+        """
+        ans = {}
+        for record in records:
+            total = ans.setdefault(record['pass'], {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'input_size': 0,
+                                                    'output_size': 0, 'units': 0})
+            for key in ('wall_seconds', 'cpu_seconds', 'input_size', 'output_size'):
+                total[key] += record[key]
+            total['units'] += 1
+        return ans
+
+
+class StepGraph:
+    """
+    The DAG of the steps of a program, from the datasets each step reads and writes.
+    A step depends on an earlier one that writes what it reads (read after write), reads what it writes
+    (write after read), or writes what it writes (write after write). Steps with no path between them may run at once.
+    Typical use:
+      graph = StepGraph()
+      graph.add(reads={'cars'}, writes={'stats'})  # step 0
+      graph.add(reads={'trucks'})                  # step 1: independent of step 0
+      graph.add(reads={'stats'})                   # step 2: after step 0
+      graph.levels()                               # [[0, 1], [2]]
+    """
+    def __init__(self):
+        self.reads = []     # list of set of dataset names, by step
+        self.writes = []
+        self.deps = []      # list of set of earlier steps, by step
+        self._writer = {}   # dataset -> last step that wrote it
+        self._readers = {}  # dataset -> steps that read it since it was last written
+
+    def __len__(self) -> int:
+        return len(self.deps)
+
+    @staticmethod
+    def key(dataset: str) -> str:
+        # SAS names are not case sensitive.
+        return dataset.upper()
+
+    def add(self, reads: Iterable[str] = (), writes: Iterable[str] = ()) -> int:
+        """
+        Add the next step of the program. Only the last writer and the readers since then are compared,
+        so adding n steps takes time linear in n (and their datasets), not quadratic.
+        :param reads: datasets the step reads
+        :param writes: datasets the step writes
+        :return: index of the step
+        """
+        step = len(self.deps)
+        reads = {self.key(d) for d in reads}
+        writes = {self.key(d) for d in writes}
+        deps = set()
+        for dataset in reads | writes:
+            if dataset in self._writer:
+                deps.add(self._writer[dataset])
+        for dataset in writes:
+            deps.update(self._readers.get(dataset, ()))
+        deps.discard(step)
+        for dataset in reads:
+            self._readers.setdefault(dataset, set()).add(step)
+        for dataset in writes:
+            self._writer[dataset] = step
+            self._readers[dataset] = set()
+        self.reads.append(reads)
+        self.writes.append(writes)
+        self.deps.append(deps)
+        return step
+
+    def levels(self) -> List[List[int]]:
+        """
+        :return: the steps by level: each step is one level after the latest step it depends on.
+        The steps of a level are independent, and the number of levels is the longest chain of dependencies.
+        """
+        level = []
+        ans = []
+        for deps in self.deps:
+            n = max((level[d] + 1 for d in deps), default=0)
+            level.append(n)
+            if n == len(ans):
+                ans.append([])
+            ans[n].append(len(level) - 1)
+        return ans
+
+    def edges(self) -> List[Tuple[int, int]]:
+        """
+        :return: sorted list of (step, later step that depends on it)
+        """
+        return sorted((d, step) for step, deps in enumerate(self.deps) for d in deps)
+
+
 class CompilerUtil:
     """
     Base class for a compiler.
@@ -22,13 +216,243 @@ class CompilerUtil:
         self.names = []
 
 class SasCompilerUtil(CompilerUtil):
-    def __init__(self, **kw):
+    def __init__(self, parser: SasParser = None, emitter_class: type = PandasEmitterUtil, emitter_options: dict = None,
+                 helpers: EmitterHelpers = None, expressions: ExpressionUtil = None, fuse: bool = True, **kw):
+        """
+        :param parser: a (warm) parser. If None, one is made on the first compile().
+        :param emitter_class: EmitterUtil child for the emit pass
+        :param emitter_options: keywords for emitter_class
+        :param helpers: emitter helpers shared by a batch
+        :param expressions: ExpressionUtil for the analyze and optimize passes
+        :param fuse: run the fuse pass (see fuse_procs)
+        """
+        super().__init__(**kw)
         self._proc_options = {}
+        self.proc_type = None
+        self._parser = parser
+        self.emitter_class = emitter_class
+        self.emitter_options = emitter_options or {}
+        self._helpers = helpers
+        self._expressions = expressions or ExpressionUtil()
+        self.passes = PassManager()
+        self.passes.register('lex', self.lex_pass)
+        self.passes.register('parse', self.parse_pass)
+        self.passes.register('analyze', self.analyze_pass)
+        if fuse:
+            self.passes.register('fuse', self.fuse_pass)
+        self.passes.register('optimize', self.optimize_pass)
+        self.passes.register('dependencies', self.dependencies_pass)
+        self.passes.register('emit', self.emit_pass)
+
+    @property
+    def parser(self) -> SasParser:
+        if self._parser is None:
+            self._parser = SasParser()
+        return self._parser
+
+    @property
+    def settings(self) -> dict:
+        """
+        :return: what decides the output besides the program, the grammar and the emitter: the compiler class,
+                 the pass pipeline and the expression options (for a cache key, like CompileCache.key)
+        """
+        e = self._expressions
+        return {'compiler': f'{type(self).__module__}.{type(self).__qualname__}', 'passes': self.passes.names,
+                'expressions': {'fold': e.fold, 'reduce_strength': e.strength, 'eliminate_cse': e.cse,
+                                'max_fold_exponent': e.max_fold_exponent, 'max_unroll_exponent': e.max_unroll_exponent,
+                                'max_fold_bits': e.max_fold_bits}}
+
+    def compile(self, source: str, name: str = '<string>', target: Target = None) -> CompilationUnit:
+        """
+        Run the passes on one program.
+        :param source: SAS program text
+        :param name: name of the unit in the statistics
+        :param target: path or text stream to write the program to (see CompilationUnit)
+        :return: the unit, with the emitted program in lines (unless target is given) and the pass records in stats
+        """
+        unit = CompilationUnit(source, name=name, target=target)
+        self.passes.run(unit)
+        return unit
+
+    def lex_pass(self, unit: CompilationUnit) -> Tuple[int, int]:
+        """ chars -> tokens """
+        unit.tokens = self.parser.tokenize(unit.source)
+        return len(unit.source), len(unit.tokens)
+
+    def parse_pass(self, unit: CompilationUnit) -> Tuple[int, int]:
+        """ tokens -> AST nodes """
+        self.parser.parse_tokens(unit.tokens)
+        unit.ast = self.parser.ast
+        unit.diagnostics = list(self.parser.diagnostics)
+        return len(unit.tokens), len(unit.ast)
+
+    def analyze_pass(self, unit: CompilationUnit) -> Tuple[int, int]:
+        """ AST nodes -> proc steps and expressions """
+        ast = unit.ast
+        unit.procs = []
+        unit.expressions = []
+        # Interned nodes are shared within a unit only; keeping them all would grow with every program compiled.
+        self._expressions.clear()
+        if ast.root >= 0:
+            for index in ast.children(ast.root) if ast.kind(ast.root) == 'program' else [ast.root]:
+                kind = ast.kind(index)
+                if kind == 'error' or (kind == 'proc' and any(ast.kind(c) == 'error' for c in ast.children(index))):
+                    # Reported in unit.diagnostics.
+                    continue
+                if kind == 'proc':
+                    options = self.add_proc(ast, index)
+                    unit.procs.append((self.proc_type, options))
+                else:
+                    unit.expressions.append(self._expressions.lower(ast, index))
+        return len(ast), len(unit.procs) + len(unit.expressions)
+
+    def fuse_pass(self, unit: CompilationUnit) -> Tuple[int, int]:
+        """ proc steps -> proc steps, with back-to-back PROC MEANS steps of one dataset fused """
+        before = len(unit.procs)
+        unit.procs = self.fuse_procs(unit.procs)
+        return before, len(unit.procs)
+
+    @staticmethod
+    def fuse_procs(procs: List[Tuple[str, dict]]) -> List[Tuple[str, dict]]:
+        """
+        Fuse each run of back-to-back PROC MEANS steps that read the same DATA= with the same CLASS variables,
+        and either all or none give VAR, into one step. Its options are DATA, CLASS, VAR (the variables of all the steps,
+        in order) and STEPS (the options of each step), so the emitter aggregates once and takes each output from it.
+        A step that writes its own DATA= (OUTPUT OUT= the same dataset) ends the run: the next step reads what it wrote.
+        :param procs: list of (proc_type, options)
+        :return: list of (proc_type, options), with one entry per run
+        """
+        def fusion_key(proc_type: str, options: dict) -> tuple:
+            if proc_type != 'MEANS' or not options.get('DATA'):
+                return None
+            class_vars = tuple(c.upper() for c in options.get('CLASS') or [])
+            return options['DATA'].upper(), class_vars, bool(options.get('VAR'))
+
+        runs = []
+        last_key = None
+        for proc_type, options in procs:
+            key = fusion_key(proc_type, options)
+            if key is not None and key == last_key:
+                runs[-1][1].append(options)
+            else:
+                runs.append((proc_type, [options]))
+            writes_data = key is not None and str(options.get('OUT') or '').upper() == key[0]
+            last_key = None if writes_data else key
+        ans = []
+        for proc_type, run in runs:
+            if len(run) == 1:
+                ans.append((proc_type, run[0]))
+                continue
+            var_vars = {}
+            for options in run:
+                var_vars.update(dict.fromkeys(options.get('VAR') or []))
+            fused = defaultdict(lambda: None, DATA=run[0]['DATA'], CLASS=run[0].get('CLASS'), VAR=list(var_vars) or None,
+                                STEPS=list(run))
+            logger.debug(f'Fused {len(run)} PROC MEANS steps of {fused["DATA"]}.')
+            ans.append((proc_type, fused))
+        return ans
+
+    def optimize_pass(self, unit: CompilationUnit) -> Tuple[int, int]:
+        """ IR nodes -> IR nodes """
+        before = self.ir_size(unit.expressions)
+        unit.expressions = [self._expressions.optimize(e) for e in unit.expressions]
+        return before, self.ir_size(unit.expressions)
+
+    def dependencies_pass(self, unit: CompilationUnit) -> Tuple[int, int]:
+        """ proc steps and expressions -> dependencies between them """
+        unit.graph = StepGraph()
+        for proc_type, options in unit.procs:
+            unit.graph.add(*self.step_datasets(proc_type, options))
+        if unit.expressions:
+            # The expressions are one step: their names may be datasets (frames) written by the procs.
+            targets = [f'expr_{i}' for i in range(len(unit.expressions))]
+            unit.graph.add(reads=self._expressions.names(unit.expressions), writes=targets)
+        return len(unit.graph), len(unit.graph.edges())
+
+    @staticmethod
+    def step_datasets(proc_type: str, options: dict) -> Tuple[List[str], List[str]]:
+        """
+        :param proc_type: like 'MEANS'
+        :param options: proc options
+        :return: tuple of (datasets the step reads, datasets it writes), like (['cars'], ['stats']) for
+          PROC MEANS DATA=cars; OUTPUT OUT=stats; RUN;
+        """
+        steps = options.get('STEPS') or [options]
+        reads = [step[name] for step in steps for name in ('DATA',) if step.get(name)]
+        writes = [step[name] for step in steps for name in ('OUT',) if step.get(name)]
+        return reads, writes
+
+    def emit_pass(self, unit: CompilationUnit) -> Tuple[int, int]:
+        """ proc steps and expressions -> lines """
+        emitter = self.emitter_class(helpers=self._helpers, **self.emitter_options)
+        for proc_type, options in unit.procs:
+            self.proc_type = proc_type
+            self._proc_options = options
+            emitter.add_proc(self)
+        if unit.expressions:
+            targets = [f'expr_{i}' for i in range(len(unit.expressions))]
+            emitter.add_step(self._expressions.to_python(unit.expressions, targets), label='expressions')
+        if emitter.parallel:
+            emitter.add_schedule(unit.graph.deps if unit.graph is not None else None)
+        if unit.target is None:
+            unit.lines = list(emitter.iter_program())
+            return len(unit.procs) + len(unit.expressions), len(unit.lines)
+        if unit.diagnostics:
+            return len(unit.procs) + len(unit.expressions), 0
+        return len(unit.procs) + len(unit.expressions), emitter.emit_to(unit.target)
+
+    @staticmethod
+    def ir_size(exprs: List[Expr]) -> int:
+        """
+        :param exprs: list of Expr
+        :return: number of distinct IR nodes (a shared subexpression counts once)
+        """
+        seen = set()
+        stack = list(exprs)
+        while stack:
+            e = stack.pop()
+            if e not in seen:
+                seen.add(e)
+                stack.extend(e.args)
+        return len(seen)
 
     @property
     def proc_options(self):
         return self._proc_options
 
+    def add_proc(self, arena: AstArena, index: int) -> dict:
+        """
+        Load the options of a parsed proc step (a 'proc' node of the SasParser AST).
+        An option with a value (DATA=cars) is stored under its name; keyword options (like the statistics MEAN STD)
+        are collected in a list under 'STATS'; statements (like CLASS a b;) are stored as a list of names;
+        and the options of a statement (OUTPUT OUT=stats;) are stored under their names, like the options of the step.
+        :param arena: AST from SasParser
+        :param index: index of the 'proc' node
+        :return: the options dictionary
+        """
+        self.proc_type = arena.value(index)
+        self.init_options(default=None)
+        stats = []
+        for child in arena.children(index):
+            if arena.kind(child) == 'error':
+                continue
+            option = arena.value(child)
+            names = [arena.value(c) for c in arena.children(child)]
+            statement_options = [c for c in arena.children(child) if arena.kind(c) == 'option']
+            if statement_options:
+                # A statement with dataset options, like OUTPUT OUT=stats; stores OUT.
+                for c in statement_options:
+                    self.add_option(arena.value(c), arena.value(arena.children(c)[0]))
+            elif arena.kind(child) == 'statement':
+                self.add_option(option, names)
+            elif names:
+                self.add_option(option, names[0])
+            else:
+                stats.append(option)
+        if stats:
+            self.add_option('STATS', stats)
+        return self._proc_options
+
     def init_options(self, default: str = '<not assigned>') -> dict:
         """
         Initialize the dictionary of options for a given proc_type
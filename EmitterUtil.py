@@ -1,78 +1,975 @@
+from __future__ import annotations
+
+import itertools
 import logging
-from Add_path import Add_path
-from typing import Union, List
+import os
+from typing import Callable, IO, Iterable, Iterator, Sequence, Set, Tuple, Union, List
+
+from LazyImport import LazyModule
+from PythonImport import PandasStyleImport, PythonImport, PythonStyleImport, emit_imports as import_lines
 
-Add_path.add_path('../../Utilities')
-from StringUtil import LineAccumulator, StringUtil
-from DateUtil import DateUtil
+# The Utilities helpers are imported when the first emitter is made, not when this module is imported.
+string_util = LazyModule('StringUtil', path='../../Utilities')
+date_util = LazyModule('DateUtil', path='../../Utilities')
+ast = LazyModule('ast')
+tempfile = LazyModule('tempfile')
 
-logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 Strings = List[str]
+Target = Union[str, os.PathLike, IO]
 
 """
 Interesting Python features:
 * This is a Bridge Design Pattern.
 * The base class, EmitterUtil, is abstract; while the child classes, such as PandasEmitterUtil, are the implementation.  
+* EmitterHelpers holds the StringUtil and DateUtil of a run, and memoizes the static fragments
+*   (banners, preamble) as tuples. Emitters that share one EmitterHelpers build each fragment once.
+* emit_to chains the sections as generators and writes them in blocks of joined lines,
+*   so only one block of the program is in memory at a time.
+* PandasEmitterUtil turns PROC MEANS into a single groupby(...).agg([...]) call: the keys are factorized once,
+*   and each statistic is a vectorized aggregation, with no loops over rows or scans per statistic.
+* PySparkEmitterUtil emits only Spark built-in functions (no Python UDFs) in one groupBy().agg(),
+*   so Spark combines partial aggregates on the executors before the shuffle.
+* ChunkedPandasEmitterUtil emits a loop over read_csv chunks that keeps a mergeable state per group
+*   (count, sum, mean, M2, min, max), so the generated program needs memory for the groups, not the rows.
+* Each emitter declares the imports its body may use (declare_imports). The program gets only those the body uses,
+*   and with lazy_imports, heavy libraries are imported on first use (see PythonImport).
+*   iter_program (and so emit_to) spools the body to a SpooledTemporaryFile while collecting its names,
+*   and then writes the imports and replays the body, so minimizing does not hold the body in memory.
+* With parallel=True, each step becomes a function, and the generated program runs each one on a
+*   concurrent.futures thread pool as soon as the steps it depends on are done (see StepGraph in CompilerUtil).
+*   The prints are held back to the end, so the output is in program order.
+* With instrument='steps.jsonl', each step runs in a `with _StepProbe(...)` block that appends its wall and CPU time,
+*   rows in and out, and peak memory to that JSON-lines report. Without it, no probe code is emitted at all.
 """
 
+class EmitterHelpers:
+    """
+    Helper objects and memoized fragments for one run of one or more emitters.
+    Pass the same instance to every emitter of a batch, so the helpers are made,
+    and the year and the banners are computed, only once.
+    """
+    def __init__(self, tz_str: str = 'US/Eastern'):
+        """
+        :param tz_str: time zone of the copyright year
+        """
+        self.su = string_util.StringUtil()
+        self.du = date_util.DateUtil()
+        self.tz_str = tz_str
+        self._year = None
+        self._fragments = {}
+
+    @property
+    def year(self) -> str:
+        """
+        :return: the current year, computed on first use
+        """
+        if self._year is None:
+            today = self.du.now(tz_str=self.tz_str)
+            self._year = self.du.asFormattedStr(myDate=today, myFormat="%Y")
+        return self._year
+
+    def fragment(self, key: tuple, build: Callable[[], Iterable[str]]) -> Tuple[str, ...]:
+        """
+        Get a memoized fragment, building it on first use.
+        :param key: hashable key, like (emitter class, 'preamble')
+        :param build: makes the lines of the fragment
+        :return: tuple of lines
+        """
+        ans = self._fragments.get(key)
+        if ans is None:
+            ans = tuple(build())
+            self._fragments[key] = ans
+        return ans
+
+
 class EmitterUtil:
     """
     Base class for a Python emitter.
     This is paired with ParserUtil and CompilerUtil.
     """
-    def __init__(self, **kw):
-        self._program = LineAccumulator()
-        self._su = StringUtil()
-        self._du = DateUtil()
+    # Bytes of body that iter_program keeps in memory while minimizing the imports, before its spool file moves to disk.
+    spool_size = 1 << 22
+
+    def __init__(self, helpers: EmitterHelpers = None, minimize_imports: bool = True, lazy_imports: bool = False,
+                 parallel: bool = False, max_workers: int = None, instrument: str = None, **kw):
+        """
+        :param helpers: shared helpers of the run. If None, this emitter makes its own.
+        :param minimize_imports: leave out the imports the body does not use. The whole body is read before the imports are emitted
+          (by iter_program and emit_to, into a spool file that moves to disk past spool_size).
+        :param lazy_imports: emit the imports of heavy libraries (pandas, pyspark) as stand-ins that import on first use
+        :param parallel: run the independent steps at the same time, on a thread pool of the generated program.
+          The steps are held until add_schedule.
+        :param max_workers: threads of that pool. If None, the concurrent.futures default.
+        :param instrument: path of the JSON-lines report of the generated program, with one record per step (see probe_step).
+          If None, the program has no probes.
+        """
+        self._helpers = helpers or EmitterHelpers()
+        self.minimize_imports = minimize_imports
+        self.lazy_imports = lazy_imports
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self._steps = []    # lines of each step held for add_schedule
+        self._shows = []    # prints held for add_schedule
+        self._outputs = set()
+        self.instrument = instrument
+        self._probes = 0
+        self._step_outputs = []     # output frames of the step being translated
+        self._program = string_util.LineAccumulator()
+        self._su = self._helpers.su
+        self._du = self._helpers.du
         self._dataframes = set()
-        self._body = LineAccumulator()
+        self._body = string_util.LineAccumulator()
+
+    @property
+    def program(self) -> Strings:
+        """
+        (Call emit() first.)
+        :return: lines of the emitted program
+        """
+        return self._program.contents
 
     def emit(self):
+        self.flush_steps()
         self._program.add_lines(self.preamble())
-        self._program.add_lines(self.emit_imports())
+        self._program.add_lines(self.emit_imports(self.body_lines() if self.minimize_imports else None))
         self._program.add_lines(self.emit_body())
         self._program.add_lines(self.emit_close())
-        logger.debug(f'Python program to be emitted:\n\n{self._program.contents}')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Python program to be emitted:\n\n{self._program.contents}')
+
+    def emit_to(self, target: Target, body: Iterable[str] = None, buffer_size: int = 1 << 16, encoding: str = 'utf-8') -> int:
+        """
+        Write the program straight to a file or text stream, section by section.
+        Unlike emit(), the program is not kept (or logged), and body may be a generator: memory does not grow with its size.
+        (With minimize_imports, the body goes through a spool file; see iter_program.)
+        :param target: path, or text stream like sys.stdout
+        :param body: more body lines, after the ones added with add_to_body. May be a generator.
+        :param buffer_size: chars joined before each write
+        :param encoding: used if target is a path
+        :return: number of lines written
+        """
+        if isinstance(target, (str, os.PathLike)):
+            with open(target, 'w', encoding=encoding, buffering=buffer_size) as f:
+                return self.emit_to(f, body=body, buffer_size=buffer_size)
+        block = []
+        block_size = 0
+        count = 0
+        for line in self.iter_program(body):
+            block.append(line)
+            block_size += len(line) + 1
+            count += 1
+            if block_size >= buffer_size:
+                block.append('')
+                target.write('\n'.join(block))
+                block = []
+                block_size = 0
+        if block:
+            block.append('')
+            target.write('\n'.join(block))
+        logger.debug(f'Wrote {count} lines.')
+        return count
+
+    def iter_program(self, body: Iterable[str] = None) -> Iterator[str]:
+        """
+        Generate the lines of the program, one section after another.
+        :param body: more body lines, after the ones added with add_to_body
+        :return: iterator of lines
+        """
+        self.flush_steps()
+        yield from self.preamble()
+        if self.minimize_imports:
+            # The imports depend on the whole body, so it is read first: into a spool file, while its names are collected.
+            lines = self.body_lines() if body is None else itertools.chain(self.body_lines(), body)
+            with tempfile.SpooledTemporaryFile(max_size=self.spool_size, mode='w+', encoding='utf-8', newline='\n') as spool:
+                used = PythonImport.collect_used_names(lines, sink=lambda line: spool.write(line + '\n'))
+                spool.seek(0)
+                yield from self.emit_imports(used=used)
+                yield from self.gen_header(header="body")
+                for line in spool:
+                    yield line[:-1]
+        else:
+            yield from self.emit_imports()
+            yield from self.gen_header(header="body")
+            yield from self.body_lines()
+            if body is not None:
+                yield from body
+        yield from self.emit_close()
 
     def preamble(self):
-        today = self._du.now(tz_str='US/Eastern')
-        year = self._du.asFormattedStr(myDate=today, myFormat="%Y")
+        return list(self._helpers.fragment((type(self), 'preamble'), self.build_preamble))
+
+    def build_preamble(self) -> Strings:
         ans = [
             '"""',
             'Generated by SasParser.py',
-            f'Copyright {year}',
+            f'Copyright {self._helpers.year}',
             '"""',
         ]
         return ans
 
     def gen_header(self, header:str) -> list:
+        return list(self._helpers.fragment(('header', header), lambda: self.build_header(header)))
+
+    def build_header(self, header: str) -> Strings:
         header = self._su.fill_string(my_str = header, fill_str = '-', fill_width = 80, alignment = 'center')
         ans = ['"""', ' ', header, ' ', '"""',]
         return ans
 
-    def emit_imports(self):
-        return self.gen_header(header="imports")
+    def emit_imports(self, body: Iterable[str] = None, used: Set[str] = None) -> Strings:
+        """
+        :param body: lines of the body. If given, the imports it does not use are left out.
+        :param used: names used by the body, instead of the body (see PythonImport.collect_used_names)
+        :return: the imports section
+        """
+        if used is not None:
+            return self.build_imports(used=used)
+        if body is None:
+            # Keyed on what is declared, since that depends on the options (parallel, instrument) as well as the class.
+            imports = self.declare_imports()
+            key = (type(self), 'imports', self.lazy_imports, tuple(i.key() for i in imports))
+            return list(self._helpers.fragment(key, lambda: self.build_imports(imports=imports)))
+        return self.build_imports(body)
+
+    def build_imports(self, body: Iterable[str] = None, imports: List[PythonImport] = None, used: Set[str] = None) -> Strings:
+        """
+        :param body: lines of the body. If given, the imports it does not use are left out.
+        :param imports: from declare_imports. If None, it is called.
+        :param used: names used by the body, instead of the body
+        :return: the imports section
+        """
+        ans = self.gen_header(header="imports")
+        imports = self.declare_imports() if imports is None else imports
+        ans.extend(import_lines(imports, body=body, deferred=self.lazy_imports, used=used))
+        return ans
+
+    def declare_imports(self) -> List[PythonImport]:
+        """
+        The imports the body may use. Child classes extend this.
+        :return: list of PythonImport, made anew on each call (they are pruned in place)
+        """
+        imports = PythonStyleImport()
+        if self.parallel:
+            for method in ('FIRST_COMPLETED', 'ThreadPoolExecutor', 'wait'):
+                imports.add_lib_method(lib='concurrent.futures', method=method)
+        if self.instrument:
+            for lib in ('json', 'sys', 'threading', 'time'):
+                imports.add_lib_method(lib=lib)
+        return [imports] if imports.libs else []
 
     def emit_body(self):
         ans = self.gen_header(header="body")
-        body_lines = self._body.contents
-        ans.extend(body_lines)
+        ans.extend(self.body_lines())
         return ans
 
+    def body_lines(self) -> Iterable[str]:
+        """
+        Lines of the body, without the header. Child classes may override this with a generator.
+        """
+        return self._body.contents
+
     def emit_close(self):
         return self.gen_header(header="close")
 
     def add_to_body(self, lines: Union[str, Strings]):
         self.add_lines(self._body, lines)
 
-    def add_lines(self, accumulator: LineAccumulator, lines: Union[str, Strings]):
+    def add_lines(self, accumulator: string_util.LineAccumulator, lines: Union[str, Strings]):
         accumulator.add_line_or_lines(lines)
 
+    # SAS statistic keyword -> aggregation of the target. Child classes fill this in.
+    stat_functions = {}
+    # Statistics of PROC MEANS if none are given
+    default_stats = ('N', 'MEAN', 'STD', 'MIN', 'MAX')
+    # Keyword options that are not statistics. (NWAY is what a group by does anyway.)
+    print_options = {'NOPRINT', 'NWAY', 'PRINT'}
+
+    def add_proc(self, compiler) -> Strings:
+        """
+        Add the body lines of the proc step loaded in the compiler (see SasCompilerUtil.add_proc).
+        PROC MEANS is translated by proc_means, and so on.
+        :param compiler: SasCompilerUtil with the proc_type and proc_options of the step
+        :return: lines added
+        """
+        translate = getattr(self, f'proc_{str(compiler.proc_type).lower()}', None)
+        if translate is None:
+            raise NotImplementedError(f'PROC {compiler.proc_type} is not supported by {type(self).__name__}')
+        options = compiler.proc_options
+        self._step_outputs = []
+        lines = translate(options)
+        label = f'PROC {compiler.proc_type} DATA={options.get("DATA")}'
+        if options.get('STEPS'):
+            label += f' ({len(options["STEPS"])} steps fused)'
+        inputs = [self.frame_name(options['DATA'])] if options.get('DATA') and self.in_memory else []
+        return self.add_step(lines, label=label, inputs=inputs, outputs=self._step_outputs)
+
+    def add_step(self, lines: Strings, label: str = 'step', inputs: Strings = (), outputs: Strings = ()) -> Strings:
+        """
+        Add the lines of one step: to the body, or with parallel=True, to the steps held for add_schedule.
+        :param lines: lines of Python
+        :param label: name of the step in the report of instrument, like 'PROC MEANS DATA=cars'
+        :param inputs: frames the step reads, counted in the report
+        :param outputs: frames the step makes, counted in the report
+        :return: lines added (with the probe, if instrument is set)
+        """
+        if self.instrument:
+            lines = self.probe_step(lines, label, inputs, outputs)
+        if self.parallel:
+            self._steps.append(lines)
+        else:
+            self.add_to_body(lines)
+        return lines
+
+    # The DATA= frames are in the generated program (not read from files), so their rows can be counted.
+    in_memory = True
+
+    # Measures the steps of the generated program. Emitted once per program, before the first step.
+    probe_source = '''
+class _StepProbe:
+    """Time, rows and peak memory of one step of the program, appended to a JSON-lines report when the step ends."""
+    lock = threading.Lock()
+
+    def __init__(self, step, label, report):
+        self.step = step
+        self.label = label
+        self.report = report
+        self.rows_in = {}
+        self.rows_out = {}
+
+    def __enter__(self):
+        self.started = time.time()
+        self.peak_before = _StepProbe.peak_rss()
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        peak = _StepProbe.peak_rss()
+        record = {'step': self.step, 'label': self.label, 'status': 'ok' if exc_type is None else 'error',
+                  'started': self.started, 'wall_seconds': wall, 'cpu_seconds': cpu,
+                  'rows_in': self.rows_in, 'rows_out': self.rows_out, 'peak_rss_bytes': peak,
+                  'peak_rss_growth_bytes': None if peak is None else peak - self.peak_before,
+                  'thread': threading.current_thread().name}
+        if exc_type is not None:
+            record['error'] = f'{exc_type.__name__}: {exc}'
+        line = json.dumps(record, default=str) + '\\n'
+        with _StepProbe.lock, open(self.report, 'a', encoding='utf-8') as f:
+            f.write(line)
+        return False
+
+    @staticmethod
+    def peak_rss():
+        """Peak resident memory of the process so far, in bytes; None where there is no resource module."""
+        try:
+            import resource
+        except ImportError:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+'''
+
+    def build_probe_lines(self) -> Strings:
+        return self.probe_source.strip('\n').split('\n') + ['', '']
+
+    def probe_step(self, lines: Strings, label: str, inputs: Strings = (), outputs: Strings = ()) -> Strings:
+        """
+        Wrap the lines of a step in a _StepProbe block. When the step ends (or fails), the generated program appends
+        a record to the report (instrument): step, label, status, wall_seconds, cpu_seconds (of the thread),
+        rows_in and rows_out (by frame), and the peak resident memory of the process and its growth during the step.
+        The defs of the step stay outside the block.
+        :param lines: lines of the step
+        :param label: name of the step in the report
+        :param inputs: frames the step reads
+        :param outputs: frames the step makes
+        :return: lines of Python
+        """
+        hoisted, kept, _ = self.split_step(lines)
+        ans = hoisted + ['', ''] if hoisted else []
+        if self._probes == 0:
+            ans.extend(self._helpers.fragment(('probe',), self.build_probe_lines))
+        ans.append(f'with _StepProbe({self._probes}, {label!r}, {self.instrument!r}) as _probe:')
+        self._probes += 1
+        ans.extend(f'    _probe.rows_in[{frame!r}] = {self.row_count(frame)}' for frame in inputs if self.row_count(frame))
+        ans.extend(f'    {line}' if line.strip() else '' for line in kept)
+        ans.extend(f'    _probe.rows_out[{frame!r}] = {self.row_count(frame)}' for frame in outputs if self.row_count(frame))
+        return ans
+
+    def row_count(self, frame: str) -> str:
+        """
+        :param frame: variable of a frame
+        :return: code of its number of rows, or None if counting is not cheap
+        """
+        return f'len({frame})'
+
+    # Runs the steps of the generated program. Emitted once per program, before the steps.
+    run_steps_source = '''
+def _run_steps(steps, max_workers=None):
+    """Run each step on a thread pool as soon as the steps it depends on are done. A failed step stops the run.
+    steps is a list of (function, set of the indices of the steps it depends on)."""
+    waiting = [len(deps) for _, deps in steps]
+    after = [[] for _ in steps]
+    for step, (_, deps) in enumerate(steps):
+        for before in deps:
+            after[before].append(step)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = {pool.submit(steps[step][0]): step for step, count in enumerate(waiting) if count == 0}
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                future.result()
+                for step in after[running.pop(future)]:
+                    waiting[step] -= 1
+                    if waiting[step] == 0:
+                        running[pool.submit(steps[step][0])] = step
+'''
+
+    def add_schedule(self, deps: Sequence[Set[int]] = None):
+        """
+        Emit the steps held with parallel=True (see add_step). Each step becomes a function, and _run_steps calls each
+        one on a thread pool as soon as the steps it depends on are done. Then come the prints held by show, in program order.
+        If no two steps can run at once, the steps are emitted in order, as without parallel.
+        :param deps: for each step, the earlier steps it depends on (StepGraph.deps). If None, each step depends on the one before.
+        """
+        steps, self._steps = self._steps, []
+        shows, self._shows = self._shows, []
+        if deps is None:
+            deps = [{i - 1} if i else set() for i in range(len(steps))]
+        if len(deps) != len(steps):
+            raise ValueError(f'{len(deps)} dependency sets for {len(steps)} steps')
+        if all(i - 1 in step_deps for i, step_deps in enumerate(deps) if i):
+            # A chain: nothing to run at the same time.
+            for lines in steps:
+                self.add_to_body(lines)
+        else:
+            functions = []
+            calls = []
+            for i, lines in enumerate(steps):
+                hoisted, function = self.step_function(f'_step_{i}', lines)
+                if hoisted:
+                    self.add_to_body(hoisted + ['', ''])
+                functions.extend(function + ['', ''])
+                calls.append(f'    (_step_{i}, {self.set_literal(deps[i])}),')
+            self.add_to_body(list(self._helpers.fragment(('run_steps',), self.build_run_steps_lines)))
+            self.add_to_body(functions)
+            self.add_to_body(['# Each step runs when the steps that write its inputs are done.', '_run_steps(['] + calls +
+                             [f'], max_workers={self.max_workers})'])
+        self.add_to_body(shows)
+
+    def build_run_steps_lines(self) -> Strings:
+        return self.run_steps_source.strip('\n').split('\n') + ['', '']
+
+    def flush_steps(self):
+        """
+        Emit the steps still held (add_schedule was not called), in order.
+        """
+        if self._steps or self._shows:
+            self.add_schedule()
+
+    @staticmethod
+    def set_literal(numbers: Iterable[int]) -> str:
+        numbers = sorted(numbers)
+        return '{' + ', '.join(map(str, numbers)) + '}' if numbers else 'set()'
+
+    @staticmethod
+    def step_function(name: str, lines: Strings) -> Tuple[Strings, Strings]:
+        """
+        Wrap the lines of a step in a function. The names the step assigns at the top level are declared global,
+        except private ones (like the temporaries _t0), so later steps and the prints see them.
+        The defs, classes and imports of the step stay at the top level, where the other steps can use them.
+        :param name: function name, like _step_0
+        :param lines: lines of Python
+        :return: tuple of (lines to keep at the top level, lines of the function)
+        """
+        hoisted, kept, names = EmitterUtil.split_step(lines)
+        function = [f'def {name}():']
+        if names:
+            function.append(f'    global {", ".join(names)}')
+        function.extend(f'    {line}' if line.strip() else '' for line in kept)
+        if not names and not any(line.strip() and not line.lstrip().startswith('#') for line in kept):
+            function.append('    pass')
+        return hoisted, function
+
+    @staticmethod
+    def split_step(lines: Strings) -> Tuple[Strings, Strings, Strings]:
+        """
+        :param lines: lines of Python
+        :return: tuple of (the defs, classes and imports, the other lines, and the public names that those
+          assign at the top level or in a with block)
+        """
+        lines = '\n'.join(lines).split('\n')
+        tree = ast.parse('\n'.join(lines))
+        hoisted = []
+        kept = []
+        names = {}
+        start = 0
+        for node in tree.body:
+            end = node.end_lineno
+            block = lines[start:end]
+            start = end
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Import, ast.ImportFrom)):
+                hoisted.extend(block)
+                continue
+            kept.extend(block)
+            statements = [node]
+            while statements:
+                statement = statements.pop()
+                if isinstance(statement, ast.Assign):
+                    targets = statement.targets
+                elif isinstance(statement, (ast.AugAssign, ast.AnnAssign)):
+                    targets = [statement.target]
+                else:
+                    # Like the variable of a for loop: local to the step. A with block (a probe) is still the top level.
+                    targets = []
+                    if isinstance(statement, ast.With):
+                        statements.extend(reversed(statement.body))
+                for target in targets:
+                    for n in ast.walk(target):
+                        if isinstance(n, ast.Name) and not n.id.startswith('_'):
+                            names[n.id] = None
+        kept.extend(lines[start:])
+        return EmitterUtil.strip_blank_lines(hoisted), EmitterUtil.strip_blank_lines(kept), list(names)
+
+    @staticmethod
+    def strip_blank_lines(lines: Strings) -> Strings:
+        """
+        :return: the lines without the blank lines at the start and the end
+        """
+        start = 0
+        end = len(lines)
+        while start < end and not lines[start].strip():
+            start += 1
+        while end > start and not lines[end - 1].strip():
+            end -= 1
+        return lines[start:end]
+
+    def show(self, frame: str) -> Strings:
+        """
+        :param frame: variable of a frame to print
+        :return: the line that prints it; or with parallel=True, no line: it is held for add_schedule
+        """
+        line = self.show_line(frame)
+        if self.parallel:
+            self._shows.append(line)
+            return []
+        return [line]
+
+    def show_line(self, frame: str) -> str:
+        return f'print({frame})'
+
+    def output_name(self, name: str) -> str:
+        """
+        :param name: variable for the output of a step, like means_cars
+        :return: name; or if an earlier step of the program has it, name_2, name_3 and so on
+        """
+        ans = name
+        n = 1
+        while ans in self._outputs:
+            n += 1
+            ans = f'{name}_{n}'
+        self._outputs.add(ans)
+        return ans
+
+    def means_output(self, options: dict, out: str) -> Strings:
+        """
+        The lines after the aggregation of a PROC MEANS step.
+        :param options: proc options
+        :param out: variable of the statistics
+        :return: the OUTPUT OUT= dataset, if any, then the print, unless NOPRINT
+        """
+        ans = []
+        self._step_outputs.append(out)
+        if options.get('OUT'):
+            target = self.frame_name(options['OUT'])
+            self._dataframes.add(target)
+            ans.append(f'{target} = {out}')
+        if 'NOPRINT' not in (options.get('STATS') or []):
+            ans.extend(self.show(out))
+        return ans
+
+    def means_stats(self, options: dict) -> Strings:
+        """
+        The statistics of a PROC MEANS step, in order and without repeats.
+        :param options: proc options; the keywords are under 'STATS'
+        :return: SAS statistic keywords, like ['N', 'MEAN']
+        """
+        ans = []
+        functions = set()
+        for stat in options.get('STATS') or []:
+            if stat in self.print_options:
+                continue
+            function = self.stat_functions.get(stat)
+            if function is None:
+                raise ValueError(f'Unsupported PROC MEANS statistic: {stat}')
+            if function not in functions:
+                functions.add(function)
+                ans.append(stat)
+        return ans or list(self.default_stats)
+
+    def fused_stats(self, steps: List[dict]) -> Strings:
+        """
+        :param steps: options of PROC MEANS steps, like the STEPS of fused steps (see SasCompilerUtil.fuse_procs)
+        :return: the statistics of all the steps, in order and without repeats
+        """
+        return list(dict.fromkeys(stat for step in steps for stat in self.means_stats(step)))
+
+    def means_functions(self, options: dict) -> Strings:
+        """
+        :param options: proc options
+        :return: the aggregations of the statistics, in order and without repeats, like ['count', 'mean']
+        """
+        return list(dict.fromkeys(self.stat_functions[stat] for stat in self.fused_stats(options.get('STEPS') or [options])))
+
+    def means_data(self, options: dict) -> Tuple[str, str]:
+        """
+        :param options: proc options
+        :return: the DATA= dataset and its frame variable
+        """
+        data = options.get('DATA')
+        if not data:
+            raise ValueError('PROC MEANS needs a DATA= option')
+        df = self.frame_name(data)
+        self._dataframes.add(df)
+        return data, df
+
+    @staticmethod
+    def frame_name(dataset: str) -> str:
+        """
+        Python variable for a SAS dataset, like lib_cars for lib.cars.
+        :param dataset: SAS dataset name
+        :return: identifier
+        """
+        return dataset.replace('.', '_')
+
 class PandasEmitterUtil(EmitterUtil):
-    def __init__(self, **kw):
-        pass
+    """
+    Emitter for a Pandas program.
+    A PROC MEANS step becomes one groupby(...).agg(...) call, so every statistic is computed in one pass over the frame.
+    """
+    stat_functions = {
+        'N': 'count',
+        'MEAN': 'mean',
+        'STD': 'std',
+        'STDDEV': 'std',
+        'STDERR': 'sem',
+        'MIN': 'min',
+        'MAX': 'max',
+        'SUM': 'sum',
+        'VAR': 'var',
+        'MEDIAN': 'median',
+    }
+
+    def __init__(self, helpers: EmitterHelpers = None, **kw):
+        super().__init__(helpers=helpers, **kw)
+
+    def declare_imports(self) -> List[PythonImport]:
+        pandas = PandasStyleImport()
+        pandas.add_lib_method(lib='pandas', alias='pd')
+        return super().declare_imports() + [pandas]
+
+    def proc_means(self, options: dict) -> Strings:
+        """
+        Translate PROC MEANS into one vectorized aggregation.
+          PROC MEANS DATA=cars MEAN STD; CLASS origin; VAR mpg; RUN;
+        becomes
+          means_cars = cars.groupby(['origin'], sort=True, observed=True)[['mpg']].agg(['mean', 'std'])
+        Fused steps (see SasCompilerUtil.fuse_procs) are one aggregation of all their variables and statistics,
+        and each step selects its columns from it:
+          _means_cars = cars.groupby(['origin'], sort=True, observed=True)[['mpg', 'weight']].agg(['mean', 'max'])
+          means_cars = _means_cars[[('mpg', 'mean')]]
+        :param options: proc options, like {'DATA': 'cars', 'CLASS': ['origin'], 'VAR': ['mpg'], 'STATS': ['MEAN', 'STD']}
+        :return: lines of Python
+        """
+        data, df = self.means_data(options)
+        functions = self.means_functions(options)
+        class_vars = options.get('CLASS') or []
+        var_vars = options.get('VAR')
+        # Without VAR, SAS analyzes every numeric column that is not a CLASS variable.
+        if var_vars:
+            columns = repr(list(var_vars))
+        elif class_vars:
+            columns = f'{df}.select_dtypes("number").columns.difference({class_vars!r})'
+        else:
+            columns = None
+        if class_vars:
+            selected = f'[{columns}]' if columns else ''
+            expr = f'{df}.groupby({list(class_vars)!r}, sort=True, observed=True){selected}.agg({functions!r})'
+        else:
+            # One group: the statistics are rows, so transpose to one row per variable, as SAS prints them.
+            frame = f'{df}[{columns}]' if columns else f'{df}.select_dtypes("number")'
+            expr = f'{frame}.agg({functions!r}).T'
+        steps = options.get('STEPS')
+        if not steps:
+            out = self.output_name(f'means_{df}')
+            return [f'# PROC MEANS DATA={data}', f'{out} = {expr}'] + self.means_output(options, out)
+        fused = self.output_name(f'_means_{df}')
+        ans = [f'# PROC MEANS DATA={data}: {len(steps)} steps in one pass', f'{fused} = {expr}']
+        for step in steps:
+            out = self.output_name(f'means_{df}')
+            ans.append(f'{out} = {self.means_select(fused, step)}')
+            ans.extend(self.means_output(step, out))
+        return ans
+
+    def means_select(self, fused: str, options: dict) -> str:
+        """
+        :param fused: variable of the aggregation of fused steps
+        :param options: options of one of the steps
+        :return: code of the output of that step: its variables and statistics, in its order
+        """
+        functions = self.means_functions(options)
+        var_vars = options.get('VAR')
+        if options.get('CLASS'):
+            if var_vars:
+                return f'{fused}[{[(var, function) for var in var_vars for function in functions]!r}]'
+            return f'{fused}[[(c, f) for c in {fused}.columns.get_level_values(0).unique() for f in {functions!r}]]'
+        rows = repr(list(var_vars)) if var_vars else ':'
+        return f'{fused}.loc[{rows}, {functions!r}]'
+
+
+class ChunkedPandasEmitterUtil(PandasEmitterUtil):
+    """
+    Emitter for a Pandas program that reads the DATA= dataset in chunks, for datasets larger than memory.
+    Each chunk is reduced to a mergeable state per group (count, sum, mean, M2, min, max), and the states are combined
+    with the parallel update of Chan et al., so the statistics are exact and memory is bounded by the number of groups.
+    """
+    # MEDIAN is not mergeable, so it is left out.
+    stat_functions = {stat: function for stat, function in PandasEmitterUtil.stat_functions.items() if stat != 'MEDIAN'}
+    # Emitted once per program, before the first step that uses them.
+    helper_source = '''
+def _means_partial(chunk, keys, columns):
+    """Mergeable PROC MEANS state of one chunk: n, sum, mean, m2 (sum of squared deviations), min and max per group."""
+    by = keys if keys else pd.Series(0, index=chunk.index)
+    part = chunk.groupby(by, sort=False, observed=True)[columns].agg(['count', 'sum', 'mean', 'var', 'min', 'max'])
+    part = part.swaplevel(axis=1)
+    n = part['count']
+    m2 = (part['var'] * (n - 1)).fillna(0)
+    return pd.concat({'n': n, 'sum': part['sum'], 'mean': part['mean'], 'm2': m2,
+                      'min': part['min'], 'max': part['max']}, axis=1)
+
+
+def _means_merge(state, part):
+    """Combine two states. The mean and m2 use the parallel update of Chan et al."""
+    if state is None:
+        return part
+    both = pd.concat([state, part])
+    levels = list(range(both.index.nlevels))
+    n = both['n'].groupby(level=levels).sum()
+    mean = (both['mean'] * both['n']).fillna(0).groupby(level=levels).sum() / n
+    dev = (both['mean'] - mean.reindex(both.index)).fillna(0)
+    m2 = (both['m2'] + both['n'] * dev ** 2).groupby(level=levels).sum()
+    return pd.concat({'n': n, 'sum': both['sum'].groupby(level=levels).sum(), 'mean': mean, 'm2': m2,
+                      'min': both['min'].groupby(level=levels).min(),
+                      'max': both['max'].groupby(level=levels).max()}, axis=1)
+
+
+def _means_finish(state, functions):
+    """The statistics from a merged state, with the columns of groupby(...).agg(functions)."""
+    n = state['n']
+    var = (state['m2'] / (n - 1)).where(n > 1)
+    std = var ** 0.5
+    stats = {'count': n, 'sum': state['sum'], 'mean': state['mean'], 'var': var, 'std': std, 'sem': std / n ** 0.5,
+             'min': state['min'], 'max': state['max']}
+    ans = pd.concat({function: stats[function] for function in functions}, axis=1).swaplevel(axis=1)
+    return ans.reindex(columns=pd.MultiIndex.from_product([n.columns, functions]))
+'''
+
+    # The DATA= datasets are read from files, a chunk at a time.
+    in_memory = False
+
+    def __init__(self, helpers: EmitterHelpers = None, chunksize: int = 1000000, source: str = '{data}.csv', **kw):
+        """
+        :param helpers: shared helpers of the run. If None, this emitter makes its own.
+        :param chunksize: rows read at a time by the generated program
+        :param source: path of the CSV file of a dataset; {data} is the SAS dataset name
+        """
+        super().__init__(helpers=helpers, **kw)
+        self.chunksize = chunksize
+        self.source = source
+        self._helpers_added = False
+
+    def build_helper_lines(self) -> Strings:
+        return self.helper_source.strip('\n').split('\n') + ['', '']
+
+    def proc_means(self, options: dict) -> Strings:
+        """
+        Translate PROC MEANS into a loop over chunks of the input. Each chunk is one groupby(...).agg(...).
+          PROC MEANS DATA=cars MEAN; CLASS origin; VAR mpg; RUN;
+        becomes
+          means_cars = None
+          for chunk in pd.read_csv('cars.csv', chunksize=1000000):
+              means_cars = _means_merge(means_cars, _means_partial(chunk, ['origin'], ['mpg']))
+          means_cars = _means_finish(means_cars, ['mean']).sort_index()
+        Fused steps (see SasCompilerUtil.fuse_procs) share one loop over the file, and each step finishes its statistics
+        from the merged state.
+        :param options: proc options, like {'DATA': 'cars', 'CLASS': ['origin'], 'VAR': ['mpg'], 'STATS': ['MEAN']}
+        :return: lines of Python
+        """
+        data, df = self.means_data(options)
+        steps = options.get('STEPS')
+        class_vars = list(options.get('CLASS') or [])
+        var_vars = options.get('VAR')
+        # Without VAR, SAS analyzes every numeric column that is not a CLASS variable.
+        if var_vars:
+            columns = repr(list(var_vars))
+        else:
+            columns = f'chunk.select_dtypes("number").columns.difference({class_vars!r})'
+        ans = []
+        if not self._helpers_added:
+            ans.extend(self._helpers.fragment((type(self), 'helpers'), self.build_helper_lines))
+            self._helpers_added = True
+        path = self.source.format(data=data)
+        state = self.output_name(f'_means_{df}' if steps else f'means_{df}')
+        fused = f': {len(steps)} steps in one pass' if steps else ''
+        ans.extend([
+            f'# PROC MEANS DATA={data}, in chunks of {self.chunksize} rows{fused}',
+            f'{state} = None',
+            f'for chunk in pd.read_csv({path!r}, chunksize={self.chunksize}):',
+            f'    {state} = _means_merge({state}, _means_partial(chunk, {class_vars!r}, {columns}))',
+        ])
+        if not steps:
+            ans.append(f'{state} = {self.means_finish(state, self.means_functions(options), class_vars)}')
+            return ans + self.means_output(options, state)
+        for step in steps:
+            out = self.output_name(f'means_{df}')
+            functions = self.means_functions(step)
+            expr = self.means_finish(state, functions, class_vars)
+            step_vars = step.get('VAR')
+            if step_vars and class_vars:
+                expr += f'[{[(var, function) for var in step_vars for function in functions]!r}]'
+            elif step_vars:
+                expr += f'.loc[{list(step_vars)!r}]'
+            ans.append(f'{out} = {expr}')
+            ans.extend(self.means_output(step, out))
+        return ans
+
+    @staticmethod
+    def means_finish(state: str, functions: Strings, class_vars: Strings) -> str:
+        """
+        :param state: variable of the merged state
+        :param functions: aggregations, like ['mean']
+        :param class_vars: CLASS variables
+        :return: code of the statistics
+        """
+        if class_vars:
+            return f'_means_finish({state}, {functions!r}).sort_index()'
+        # One group: one row per variable, as SAS prints them.
+        return f'_means_finish({state}, {functions!r}).loc[0].unstack()[{functions!r}]'
+
+    def means_output(self, options: dict, out: str) -> Strings:
+        """
+        Like EmitterUtil.means_output, but the OUTPUT OUT= dataset is also written to its CSV file,
+        where the later steps read it.
+        """
+        ans = super().means_output(options, out)
+        if options.get('OUT'):
+            path = self.source.format(data=options['OUT'])
+            ans.insert(1, f'{self.frame_name(options["OUT"])}.to_csv({path!r})')
+        return ans
+
+
+class PySparkEmitterUtil(EmitterUtil):
+    """
+    Emitter for a PySpark program.
+    A PROC MEANS step becomes one groupBy(...).agg(...) of Spark built-in functions. There are no Python UDFs,
+    so the aggregation runs in the JVM, with partial aggregates on each executor.
+    The generated programs need Spark 3.1 or later (for F.percentile_approx).
+    """
+    # SAS statistic keyword -> Spark column expression; {c} is the column.
+    # MEDIAN is approximate (rank error 1/10000), and is a value of the column: SAS averages the middle two of an even count.
+    # (F.median, which is exact, needs Spark 3.4.)
+    stat_functions = {
+        'N': 'F.count({c})',
+        'MEAN': 'F.mean({c})',
+        'STD': 'F.stddev_samp({c})',
+        'STDDEV': 'F.stddev_samp({c})',
+        'STDERR': '(F.stddev_samp({c}) / F.sqrt(F.count({c})))',
+        'MIN': 'F.min({c})',
+        'MAX': 'F.max({c})',
+        'SUM': 'F.sum({c})',
+        'VAR': 'F.var_samp({c})',
+        'MEDIAN': 'F.percentile_approx({c}, 0.5)',
+    }
+
+    def __init__(self, helpers: EmitterHelpers = None, **kw):
+        super().__init__(helpers=helpers, **kw)
+
+    def declare_imports(self) -> List[PythonImport]:
+        functions = PandasStyleImport()
+        functions.add_lib_method(lib='pyspark.sql.functions', alias='F')
+        types = PythonStyleImport()
+        types.add_lib_method(lib='pyspark.sql.types', method='NumericType')
+        return super().declare_imports() + [functions, types]
+
+    def proc_means(self, options: dict) -> Strings:
+        """
+        Translate PROC MEANS into one aggregation. The output columns are named like SAS AUTONAME (mpg_Mean).
+          PROC MEANS DATA=cars MEAN; CLASS origin; VAR mpg; RUN;
+        becomes
+          means_cars = cars.groupBy('origin').agg(F.mean('mpg').alias('mpg_Mean')).orderBy('origin')
+        Fused steps (see SasCompilerUtil.fuse_procs) are one cached aggregation of all their columns,
+        and each step selects its columns from it.
+        :param options: proc options, like {'DATA': 'cars', 'CLASS': ['origin'], 'VAR': ['mpg'], 'STATS': ['MEAN']}
+        :return: lines of Python
+        """
+        data, df = self.means_data(options)
+        steps = options.get('STEPS')
+        out = self.output_name(f'_means_{df}' if steps else f'means_{df}')
+        stats = self.fused_stats(steps or [options])
+        class_vars = list(options.get('CLASS') or [])
+        var_vars = options.get('VAR')
+        ans = [f'# PROC MEANS DATA={data}: {len(steps)} steps in one pass' if steps else f'# PROC MEANS DATA={data}']
+        if var_vars:
+            aggs = ', '.join(self.stat_column(stat, repr(var), repr(f'{var}_{self.stat_suffix(stat)}'))
+                             for var in var_vars for stat in stats)
+        else:
+            # Without VAR, SAS analyzes every numeric column that is not a CLASS variable. The list is made from the schema.
+            ans.append(f'{out}_vars = [f.name for f in {df}.schema.fields '
+                       f'if isinstance(f.dataType, NumericType) and f.name not in {class_vars!r}]')
+            columns = ', '.join(self.stat_column(stat, 'c', f"c + '_{self.stat_suffix(stat)}'") for stat in stats)
+            aggs = f'*[col for c in {out}_vars for col in ({columns},)]'
+        keys = ', '.join(repr(var) for var in class_vars)
+        if class_vars:
+            expr = f'{df}.groupBy({keys}).agg({aggs}).orderBy({keys})'
+        else:
+            expr = f'{df}.agg({aggs})'
+        if not steps:
+            ans.append(f'{out} = {expr}')
+            return ans + self.means_output(options, out)
+        # Cached, so the selections below do not each run the aggregation again.
+        ans.append(f'{out} = {expr}.cache()')
+        for step in steps:
+            step_out = self.output_name(f'means_{df}')
+            suffixes = [f'_{self.stat_suffix(stat)}' for stat in self.means_stats(step)]
+            if step.get('VAR'):
+                columns = [repr(var + suffix) for var in step['VAR'] for suffix in suffixes]
+            else:
+                columns = [f'*[c + s for c in {out}_vars for s in {suffixes!r}]']
+            ans.append(f'{step_out} = {out}.select({", ".join(([keys] if keys else []) + columns)})')
+            ans.extend(self.means_output(step, step_out))
+        return ans
+
+    def show_line(self, frame: str) -> str:
+        return f'{frame}.show()'
+
+    def row_count(self, frame: str) -> str:
+        # count() would run a Spark job, so the report has no rows.
+        return None
+
+    def stat_column(self, stat: str, column: str, alias: str) -> str:
+        """
+        :param stat: SAS statistic keyword, like 'MEAN'
+        :param column: code of the column, like "'mpg'"
+        :param alias: code of the output name, like "'mpg_Mean'"
+        :return: code of the aliased Spark expression
+        """
+        return f'{self.stat_functions[stat].format(c=column)}.alias({alias})'
+
+    @staticmethod
+    def stat_suffix(stat: str) -> str:
+        return stat if stat == 'N' else stat.capitalize()
+
 
 class PythonEmitterUtil(EmitterUtil):
     def __init__(self, **kw):
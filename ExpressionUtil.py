@@ -0,0 +1,392 @@
+import logging
+import math
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from AstUtil import AstArena
+
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+* The IR is hash-consed: ExpressionUtil.make returns the one shared Expr for each (op, value, args),
+*   so structurally equal subexpressions are the same object. Equality is identity, and a hash is computed once.
+* Because of that, common-subexpression elimination only has to count how many times each object is used.
+* The passes are bottom-up rewrites that rebuild a node only if one of its operands changed.
+* Every walk uses an explicit stack instead of recursion, so a long chain like a + b + ... + z cannot hit the recursion limit.
+"""
+
+Names = Callable[[str], str]
+
+# Python precedence of each op, used to parenthesize only where needed.
+_PRECEDENCE = {'+': 1, '-': 1, '*': 2, '/': 2, 'neg': 3, '**': 4, 'const': 5, 'name': 5, 'temp': 5}
+_BINOPS = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: a / b,
+    '**': lambda a, b: a ** b,
+}
+
+def _is_int(e: 'Expr') -> bool:
+    return e.op == 'const' and type(e.value) is int
+
+class Expr:
+    """
+    One node of the expression IR: an op ('const', 'name', 'neg' or a binary op like '+'),
+    a value (for 'const' and 'name'), and a tuple of operands.
+    Make these with ExpressionUtil.make, never directly.
+    """
+    __slots__ = ('op', 'value', 'args', '_hash')
+
+    def __init__(self, op: str, value: Any, args: Tuple['Expr', ...], key: tuple):
+        self.op = op
+        self.value = value
+        self.args = args
+        self._hash = hash(key)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    @property
+    def is_const(self) -> bool:
+        return self.op == 'const'
+
+    def __repr__(self) -> str:
+        if self.args:
+            return f'Expr({self.op!r}, {", ".join(repr(a) for a in self.args)})'
+        return f'Expr({self.op!r}, {self.value!r})'
+
+
+class ExpressionUtil:
+    """
+    Build, optimize and emit arithmetic expressions.
+    Expressions are lowered from the AST of SasParser ('binop', 'unop', 'number' and 'name' nodes).
+    The passes are constant folding, strength reduction, and common-subexpression elimination (in to_python).
+    """
+    # Largest exponent folded or unrolled. A bigger power stays a call to ** at run time.
+    max_fold_exponent = 64
+    max_unroll_exponent = 4
+    # Largest int a fold may make, in bits. A bigger result (like (9 ** 64) ** 64) is left to run time.
+    max_fold_bits = 4096
+
+    def __init__(self, fold: bool = True, reduce_strength: bool = True, eliminate_cse: bool = True):
+        """
+        :param fold: run constant folding in optimize()
+        :param reduce_strength: run strength reduction in optimize()
+        :param eliminate_cse: in to_python(), compute each repeated subexpression once, into a temporary
+        """
+        self.fold = fold
+        self.strength = reduce_strength
+        self.cse = eliminate_cse
+        self._interned = {}
+
+    def clear(self):
+        """
+        Forget the interned nodes, so they can be freed. SasCompilerUtil does this before each compilation unit.
+        A node made before clear() is not shared with an equal node made after, so do not mix the two.
+        """
+        self._interned.clear()
+
+    # Building
+
+    def make(self, op: str, *args: Expr, value: Any = None) -> Expr:
+        """
+        Get the shared node for (op, value, args).
+        :param op: 'const', 'name', 'neg', or a binary op like '+'
+        :param args: operands
+        :param value: constant value or variable name
+        :return: Expr
+        """
+        # The type is part of the key, so 1 and 1.0 stay different constants.
+        key = (op, type(value), value, tuple(id(a) for a in args))
+        ans = self._interned.get(key)
+        if ans is None:
+            ans = Expr(op, value, args, key)
+            self._interned[key] = ans
+        return ans
+
+    def const(self, value: Any) -> Expr:
+        return self.make('const', value=value)
+
+    def name(self, name: str) -> Expr:
+        return self.make('name', value=name)
+
+    def lower(self, arena: AstArena, index: int) -> Expr:
+        """
+        Convert an expression subtree of the AST to the IR.
+        :param arena: the AST
+        :param index: root of the expression
+        :return: Expr
+        """
+        done = {}
+        # An operator is pushed as ~index once its operands are on the stack, and is built when popped again.
+        stack = [index]
+        while stack:
+            i = stack.pop()
+            if i >= 0:
+                kind = arena.kind(i)
+                if kind == 'number':
+                    done[i] = self.const(arena.value(i))
+                elif kind == 'name':
+                    done[i] = self.name(arena.value(i))
+                else:
+                    stack.append(~i)
+                    stack.extend(reversed(arena.children(i)))
+                continue
+            i = ~i
+            kind = arena.kind(i)
+            args = [done.pop(c) for c in arena.children(i)]
+            if kind == 'unop':
+                done[i] = self.make('neg', *args)
+            elif kind == 'binop':
+                done[i] = self.make(arena.value(i), *args)
+            else:
+                raise ValueError(f'Not an expression node: {kind}')
+        return done[index]
+
+    # Passes
+
+    def optimize(self, expr: Expr) -> Expr:
+        """
+        Run the enabled passes: fold constants, then reduce strength.
+        :param expr: Expr
+        :return: optimized Expr
+        """
+        if self.fold:
+            expr = self.fold_constants(expr)
+        if self.strength:
+            expr = self.reduce_strength(expr)
+        return expr
+
+    def fold_constants(self, expr: Expr) -> Expr:
+        """
+        Evaluate the operations on constants (also x + 1 + 2 with ints), and remove the identities (x + 0, x * 1, - - x, ...).
+        x * 0 and x ** 0 are not folded: that would hide a missing (NaN) or failing x.
+        The identities are only removed with int constants, and x / 1 is kept: x / 1 and x * 1.0 are floats for an int x.
+        Division by zero, overflows and very large results are left to run time.
+        :param expr: Expr
+        :return: folded Expr
+        """
+        return self._rewrite(expr, self._fold_node, {})
+
+    def _fold_node(self, e: Expr) -> Expr:
+        if e.op == 'neg':
+            (a,) = e.args
+            if a.is_const:
+                return self.const(-a.value)
+            if a.op == 'neg':
+                return a.args[0]
+            return e
+        if e.op not in _BINOPS:
+            return e
+        a, b = e.args
+        if a.is_const and b.is_const:
+            if e.op == '/' and b.value == 0:
+                return e
+            if e.op == '**' and (abs(b.value) > self.max_fold_exponent or (a.value == 0 and b.value < 0)
+                                 or (a.value < 0 and not float(b.value).is_integer())
+                                 or (_is_int(a) and _is_int(b) and a.value.bit_length() * b.value > self.max_fold_bits)):
+                return e
+            try:
+                value = _BINOPS[e.op](a.value, b.value)
+            except OverflowError:
+                return e
+            if type(value) is int and value.bit_length() > self.max_fold_bits:
+                return e
+            return self.const(value)
+        if _is_int(b):
+            if (e.op in ('+', '-') and b.value == 0) or (e.op in ('*', '**') and b.value == 1):
+                return a
+        if _is_int(a):
+            if (e.op == '+' and a.value == 0) or (e.op == '*' and a.value == 1):
+                return b
+            if e.op == '-' and a.value == 0:
+                return self._fold_node(self.make('neg', b))
+        if e.op in ('+', '-') and _is_int(b) and a.op in ('+', '-') and _is_int(a.args[1]):
+            # (x + 1) + 2 -> x + 3. Only for ints: with floats, the rounding would change.
+            sign = 1 if a.op == e.op else -1
+            c = a.args[1].value + sign * b.value
+            return self._fold_node(self.make(a.op, a.args[0], self.const(c)))
+        if e.op in ('+', '-') and _is_int(b) and b.value < 0:
+            return self.make('-' if e.op == '+' else '+', a, self.const(-b.value))
+        if e.op == '-' and b.op == 'neg':
+            return self.make('+', a, b.args[0])
+        if e.op == '+' and b.op == 'neg':
+            return self.make('-', a, b.args[0])
+        return e
+
+    def reduce_strength(self, expr: Expr) -> Expr:
+        """
+        Replace costly operations with cheaper ones:
+        x ** 2 -> x * x (and the other integer powers up to max_unroll_exponent), x ** -1 -> 1.0 / x.
+        The repeated x is shared, so to_python computes it only once.
+        :param expr: Expr
+        :return: reduced Expr
+        """
+        return self._rewrite(expr, self._reduce_node, {})
+
+    def _reduce_node(self, e: Expr) -> Expr:
+        if e.op != '**':
+            return e
+        x, n = e.args
+        if not n.is_const or x.is_const:
+            return e
+        p = n.value
+        if isinstance(p, int) and 2 <= p <= self.max_unroll_exponent:
+            # Square and multiply: x**4 is (x*x)*(x*x), with x*x shared.
+            ans = None
+            square = x
+            while p:
+                if p & 1:
+                    ans = square if ans is None else self.make('*', ans, square)
+                p >>= 1
+                if p:
+                    square = self.make('*', square, square)
+            return ans
+        if p == -1:
+            return self.make('/', self.const(1.0), x)
+        return e
+
+    def _rewrite(self, expr: Expr, rule: Callable[[Expr], Expr], done: Dict[int, Expr]) -> Expr:
+        """
+        Apply rule bottom-up. done memoizes the shared nodes by id, so a DAG is visited in linear time.
+        """
+        # An operator is pushed again under a None once its operands are on the stack, and is rebuilt when the None is popped.
+        stack = [expr]
+        while stack:
+            e = stack.pop()
+            if e is None:
+                e = stack.pop()
+                args = tuple([done[id(a)] for a in e.args])
+                # Tuples compare their items by identity first, and Expr equality is identity.
+                node = e if args == e.args else self.make(e.op, *args, value=e.value)
+                done[id(e)] = rule(node)
+            elif id(e) not in done:
+                if e.args:
+                    stack += (e, None)
+                    stack.extend(reversed(e.args))
+                else:
+                    done[id(e)] = rule(e)
+        return done[id(expr)]
+
+    def common_subexpressions(self, exprs: Sequence[Expr]) -> List[Expr]:
+        """
+        Find the operations used more than once in exprs.
+        :param exprs: list of Expr
+        :return: list of the repeated operations, each after the operations it uses
+        """
+        counts = {}
+        order = []
+        for expr in exprs:
+            stack = [(expr, False)]
+            while stack:
+                e, expanded = stack.pop()
+                if expanded:
+                    order.append(e)
+                    continue
+                if not e.args:
+                    continue
+                counts[e] = counts.get(e, 0) + 1
+                if counts[e] == 1:
+                    stack.append((e, True))
+                    stack.extend((a, False) for a in reversed(e.args))
+        return [e for e in order if counts[e] > 1]
+
+    @staticmethod
+    def names(exprs: Sequence[Expr]) -> List[str]:
+        """
+        :param exprs: list of Expr
+        :return: the names the expressions read, in order of first use and without repeats
+        """
+        ans = {}
+        seen = set()
+        stack = list(reversed(exprs))
+        while stack:
+            e = stack.pop()
+            if e in seen:
+                continue
+            seen.add(e)
+            if e.op == 'name':
+                ans[e.value] = None
+            stack.extend(reversed(e.args))
+        return list(ans)
+
+    # Emitting
+
+    def to_python(self, exprs: Sequence[Expr], targets: Sequence[str], names: Names = str, temp_prefix: str = '_t') -> List[str]:
+        """
+        Generate Python assignments for the expressions.
+        With eliminate_cse, each repeated subexpression is assigned to a temporary first.
+        :param exprs: list of Expr (run optimize() first)
+        :param targets: Python target of each expression, like "df['total']"
+        :param names: maps a variable name to Python code, like lambda n: f"df['{n}']"
+        :param temp_prefix: prefix for the temporaries
+        :return: list of lines
+        """
+        temps = {}
+        ans = []
+        if self.cse:
+            for i, e in enumerate(self.common_subexpressions(exprs)):
+                temp = f'{temp_prefix}{i}'
+                ans.append(f'{temp} = {self.to_source(e, names, temps)}')
+                temps[e] = temp
+        for target, e in zip(targets, exprs):
+            ans.append(f'{target} = {self.to_source(e, names, temps)}')
+        return ans
+
+    def to_source(self, expr: Expr, names: Names = str, temps: Dict[Expr, str] = None) -> str:
+        """
+        Format one expression as Python source, with the fewest parentheses.
+        :param expr: Expr
+        :param names: maps a variable name to Python code
+        :param temps: maps a subexpression to the temporary that holds it
+        :return: Python expression
+        """
+        return self._source(expr, names, temps or {})[0]
+
+    def _source(self, expr: Expr, names: Names, temps: Dict[Expr, str]) -> Tuple[str, int]:
+        """
+        :return: tuple of (source, precedence)
+        """
+        # Post-order walk: the (source, precedence) of each finished operand is pushed on out.
+        out = []
+        stack = [(expr, False)]
+        while stack:
+            e, expanded = stack.pop()
+            if not expanded:
+                temp = temps.get(e)
+                if temp is not None:
+                    out.append((temp, _PRECEDENCE['temp']))
+                elif e.op == 'const':
+                    out.append(self._const_source(e.value))
+                elif e.op == 'name':
+                    out.append((names(e.value), _PRECEDENCE['name']))
+                else:
+                    stack.append((e, True))
+                    stack.extend((a, False) for a in reversed(e.args))
+                continue
+            prec = _PRECEDENCE[e.op]
+            if e.op == 'neg':
+                src, p = out.pop()
+                out.append((f'-{self._paren(src, p <= prec)}', prec))
+                continue
+            right, rp = out.pop()
+            left, lp = out.pop()
+            if e.op == '**':
+                # ** is right-associative, and binds tighter than a unary minus on its left.
+                left, right = self._paren(left, lp <= prec), self._paren(right, rp < _PRECEDENCE['neg'])
+                out.append((f'{left} ** {right}', prec))
+            else:
+                left, right = self._paren(left, lp < prec), self._paren(right, rp <= prec)
+                out.append((f'{left} {e.op} {right}', prec))
+        return out[0]
+
+    @staticmethod
+    def _const_source(value: Any) -> Tuple[str, int]:
+        if isinstance(value, float) and not math.isfinite(value):
+            return f'float({str(value)!r})', _PRECEDENCE['const']
+        return repr(value), _PRECEDENCE['neg'] if value < 0 else _PRECEDENCE['const']
+
+    @staticmethod
+    def _paren(src: str, needed: bool) -> str:
+        return f'({src})' if needed else src
@@ -0,0 +1,54 @@
+import importlib
+import logging
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+* LazyModule stands in for a module until one of its attributes is used. Only then is the module imported
+*   (and its directory put on sys.path), so importing the compiler modules does not pay for PLY or the Utilities.
+* Each attribute is copied onto the LazyModule the first time it is read, so later reads are plain attribute
+*   lookups that never reach __getattr__.
+"""
+
+class LazyModule:
+    """
+    A module that is imported on first use.
+    Typical call:
+      lex = LazyModule('ply.lex')
+      lexer = lex.lex(module=parser)  # ply.lex is imported here
+    """
+    def __init__(self, name: str, path: str = None):
+        """
+        :param name: module name, like 'ply.lex'
+        :param path: dir to add to sys.path before the import, like '../../Utilities'
+        """
+        self._name = name
+        self._path = path
+        self._module = None
+
+    @property
+    def module(self):
+        """
+        :return: the module, imported now if it was not yet
+        """
+        if self._module is None:
+            if self._path:
+                from Add_path import Add_path
+                Add_path.add_path(self._path)
+            self._module = importlib.import_module(self._name)
+            logger.debug(f'Imported {self._name} on first use.')
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        # Only called for attributes not found the usual way: the first read of each module attribute.
+        if attr in ('_name', '_path', '_module'):
+            raise AttributeError(attr)
+        value = getattr(self.module, attr)
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self) -> str:
+        state = 'imported' if self._module is not None else 'not imported'
+        return f'<LazyModule {self._name!r} ({state})>'
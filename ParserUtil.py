@@ -1,26 +1,576 @@
+from __future__ import annotations
+
 import logging
 import sys
-sys.path.insert(0, "../..")
-
-import ply.lex as lex
-import ply.yacc as yacc
+import codecs
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+import importlib.util
+import mmap
 import os
+import re
+import threading
+import time
+from types import ModuleType
+from typing import IO, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from AstUtil import AstArena, AstNode
+from LazyImport import LazyModule
+from PreprocessorUtil import SasPreprocessor
+
+# PLY is imported when the first parser is built, not when this module is imported.
+# So are the modules only needed to write the table cache or hash a step.
+lex = LazyModule('ply.lex')
+yacc = LazyModule('ply.yacc')
+hashlib = LazyModule('hashlib')
+shutil = LazyModule('shutil')
+tempfile = LazyModule('tempfile')
+futures = LazyModule('concurrent.futures')
 
-logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+"""
+Interesting Python features:
+* ParseTableCache names the PLY table modules after a hash of the grammar, so a changed grammar never reads stale tables.
+* Table files are written to a temporary dir and moved into place with os.replace, which is atomic.
+* StatementSplitter is an incremental scanner (a SasPreprocessor): it keeps its comment/quote state between blocks,
+*   so a file of any size can be fed to the lexer one statement at a time, with its comments already removed.
+* FastLexer puts every t_* rule into one master regex and dispatches on match.lastgroup with a dict,
+*   instead of PLY's per-token ignore loop and function-table lookup.
+* IncrementalParser caches the AST of each step under a hash of its comment-free text, and copies the cached
+*   arenas into the program's arena with AstArena.append_arena, shifting the spans to where the step is now.
+* The p_* rules build the AST in an AstArena. Spans are carried on PLY's YaccSymbol objects (p.slice[0].span)
+*   so a parent rule can find the source span of a child nonterminal.
+* RuleProfiler wraps the rule functions after PLY has bound them (LRParser.productions[i].callable and the lexer's
+*   function tables), so the grammar, its hash and the cached tables are the same with or without profiling.
+* Each parser instance owns its lexer, LR parser and AST arena, and parses through them (never PLY's module-level
+*   yacc.parse), so instances are independent. The process-wide caches (table modules, FastLexer regexes) and
+*   PLY's table construction are guarded by locks. ParserPool gives each worker thread a parser of its own.
+* Syntax errors are recovered from in panic mode with yacc error productions (statement : error EOL, and so on):
+*   the parser skips to the next ';' or RUN; and goes on, so one parse reports every error, each as a Diagnostic
+*   with its line and column. The rules call errok(), so PLY does not stay quiet for three tokens after each one.
+"""
+
+Source = Union[str, os.PathLike, IO, mmap.mmap]
+
+_newline_re = re.compile(r'\n')
+
+class Diagnostic:
+    """
+    One error found while lexing or parsing, with its place in the source.
+    """
+    __slots__ = ('message', 'offset', 'lineno', 'column')
+
+    def __init__(self, message: str, offset: int, lineno: int, column: int):
+        """
+        :param message: what is wrong, like "Syntax error at '='"
+        :param offset: offset in the source
+        :param lineno: line, from 1
+        :param column: column, from 1
+        """
+        self.message = message
+        self.offset = offset
+        self.lineno = lineno
+        self.column = column
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self) -> str:
+        return f'line {self.lineno}, column {self.column}: {self.message}'
+
+    def __repr__(self) -> str:
+        return f'Diagnostic({self.message!r}, offset={self.offset}, lineno={self.lineno}, column={self.column})'
+
+class StatementSplitter(SasPreprocessor):
+    """
+    Split SAS source into statements at ';' boundaries.
+    Semicolons inside comments and quoted strings do not end a statement.
+    The comments are kept, unless strip_comments is True (see SasPreprocessor).
+    """
+    def __init__(self, strip_comments: bool = False):
+        super(StatementSplitter, self).__init__(strip_comments=strip_comments)
+
+    def statements(self, blocks: Iterator[str]) -> Iterator[str]:
+        """
+        Split blocks of source text into statements. Only the current (incomplete) statement is buffered.
+        :param blocks: iterator of str blocks, of any size
+        :return: iterator of statements
+        """
+        for block in blocks:
+            yield from self.feed(block)
+        rest = self.close()
+        if rest is not None:
+            yield rest
+
+    @classmethod
+    def read_blocks(cls, source: Source, block_size: int = 1 << 20, encoding: str = 'utf-8') -> Iterator[str]:
+        """
+        Read the source in blocks of text.
+        :param source: path, text or binary file object, or mmap
+        :param block_size: size of each read
+        :param encoding: used to decode binary files and mmaps
+        :return: iterator of str blocks
+        """
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'r', encoding=encoding, newline='') as f:
+                yield from cls.read_blocks(f, block_size=block_size, encoding=encoding)
+            return
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            if isinstance(block, str):
+                yield block
+            else:
+                yield decoder.decode(block)
+        final = decoder.decode(b'', final=True)
+        if final:
+            yield final
+
+    @classmethod
+    def split(cls, source: Source, block_size: int = 1 << 20, encoding: str = 'utf-8') -> Iterator[str]:
+        """
+        Split the source into statements.
+        :param source: path, text or binary file object, or mmap
+        :param block_size: size of each read
+        :param encoding: used to decode binary files and mmaps
+        :return: iterator of statements
+        """
+        return cls().statements(cls.read_blocks(source, block_size=block_size, encoding=encoding))
+
+
+class FastLexer:
+    """
+    Drop-in replacement for the PLY lexer, for production runs.
+    It reads the same t_* rules, in the same order as PLY, but matches them with one master regex.
+    It makes PLY LexTokens, so the PLY parser (and the t_* functions) can use it unchanged.
+    """
+    # Per (parser class, reflags): see compile()
+    _compiled = {}
+    _lock = threading.Lock()
+
+    def __init__(self, parser, reflags: int = int(re.VERBOSE)):
+        """
+        :param parser: instance of ParserUtil (or a child class). Its t_* functions are called as needed.
+        :param reflags: regex flags (PLY's default is re.VERBOSE)
+        """
+        master, actions, skip_re = self.compile(type(parser), reflags)
+        self._match = master.match
+        self._skip_match = skip_re.match if skip_re else None
+        self._actions = [(a[0], getattr(parser, a[1]) if a[1] else None) if a else None for a in actions]
+        self._errorf = getattr(parser, 't_error', None)
+        self.lineno = 1
+        self.input('')
+
+    @classmethod
+    def compile(cls, parser_class: type, reflags: int = int(re.VERBOSE)) -> tuple:
+        """
+        Build (once per class) the master regex and the actions for each rule group.
+        The t_ignore_* rules have the token type None.
+        :param parser_class: a subclass of ParserUtil
+        :param reflags: regex flags
+        :return: tuple of (master regex, list of (token type, function rule name) by group number, regex for the ignored chars)
+        """
+        key = (parser_class, reflags)
+        with cls._lock:
+            if key not in cls._compiled:
+                cls._compiled[key] = cls._compile(parser_class, reflags)
+            return cls._compiled[key]
+
+    @staticmethod
+    def _compile(parser_class: type, reflags: int) -> tuple:
+        ldict = {k: getattr(parser_class, k) for k in dir(parser_class) if k.startswith('t_')}
+        linfo = lex.LexerReflect(ldict, log=lex.NullLogger(), reflags=reflags)
+        linfo.get_all()
+        rules = []
+        # Function rules first, in definition order; then string rules, longest regex first (as PLY does).
+        for fname, f in linfo.funcsym['INITIAL']:
+            rules.append((fname, getattr(f, 'regex', f.__doc__), fname))
+        for name, regex in linfo.strsym['INITIAL']:
+            rules.append((name, regex, None))
+        ignore = linfo.ignore.get('INITIAL', '')
+        # The ignored chars are skipped by the same match as the token that follows them.
+        prefix = '[%s]*' % re.escape(ignore) if ignore else ''
+        master = re.compile(prefix + '(?:' + '|'.join('(?P<%s>%s)' % (name, regex) for name, regex, _ in rules) + ')', reflags)
+        # Index the actions by group number, so the scanner can use match.lastindex.
+        actions = [None] * (master.groups + 1)
+        for name, _, rule in rules:
+            tokname = linfo.toknames[name]
+            if rule is None and tokname.startswith('ignore_'):
+                tokname = None
+            actions[master.groupindex[name]] = (tokname, rule)
+        skip_re = re.compile(prefix, reflags) if ignore else None
+        return master, actions, skip_re
+
+    def input(self, data: str):
+        self.lexdata = data
+        self.lexpos = 0
+        self.lexlen = len(data)
+        self._tokens = self._scan()
+
+    def skip(self, n: int):
+        self.lexpos += n
+
+    def token(self) -> Optional[lex.LexToken]:
+        return next(self._tokens, None)
+
+    def __iter__(self) -> Iterator[lex.LexToken]:
+        return self._tokens
+
+    def _scan(self) -> Iterator[lex.LexToken]:
+        """
+        Tokenize lexdata. State is kept in locals; self.lexpos is synced only around calls to the t_* functions.
+        :return: iterator of tokens
+        """
+        data = self.lexdata
+        n = self.lexlen
+        match = self._match
+        actions = self._actions
+        LexToken = lex.LexToken
+        pos = self.lexpos
+        while pos < n:
+            m = match(data, pos)
+            if m is None:
+                if self._skip_match:
+                    pos = self._skip_match(data, pos).end()
+                    if pos >= n:
+                        break
+                pos, tok = self._error(pos)
+                if tok:
+                    yield tok
+                continue
+            end = m.end()
+            group = m.lastindex
+            toktype, func = actions[group]
+            if toktype is None and func is None:
+                pos = end
+                continue
+            tok = LexToken()
+            tok.type = toktype
+            tok.value = m.group(group)
+            tok.lineno = self.lineno
+            tok.lexpos = m.start(group)
+            if func is not None:
+                self.lexpos = end
+                tok.lexer = self
+                tok = func(tok)
+                end = self.lexpos
+            pos = end
+            if tok is not None:
+                self.lexpos = pos
+                yield tok
+        self.lexpos = pos
+
+    def _error(self, pos: int) -> tuple:
+        """
+        Call t_error for the illegal input at pos. (t_error is expected to call skip().)
+        :param pos: offset of the illegal char
+        :return: tuple of (new position, token returned by t_error or None)
+        """
+        data = self.lexdata
+        if self._errorf is None:
+            raise lex.LexError(f'Illegal character {data[pos]!r} at index {pos}', data[pos:])
+        tok = lex.LexToken()
+        tok.type = 'error'
+        tok.value = data[pos:]
+        tok.lineno = self.lineno
+        tok.lexpos = pos
+        tok.lexer = self
+        self.lexpos = pos
+        newtok = self._errorf(tok)
+        if self.lexpos == pos:
+            raise lex.LexError(f'Scanning error. Illegal character {data[pos]!r}', data[pos:])
+        return self.lexpos, newtok
+
+
+class ParseTableCache:
+    """
+    On-disk cache of the PLY lexer and LALR tables.
+    The tables are keyed by a hash of the token and p_* rule definitions of each ParserUtil subclass.
+    They are loaded in PLY's optimized mode and are rebuilt only when the grammar changes.
+    """
+    env_var = 'PARSER_TABLE_DIR'
+    # Table modules already loaded in this process, keyed by file path.
+    _loaded = {}
+    # PLY sets module globals (lex.lexer, yacc.parse) while it builds, so one build runs at a time.
+    _lock = threading.RLock()
+
+    def __init__(self, table_dir: str = None):
+        """
+        :param table_dir: directory for the table files. If None, use $PARSER_TABLE_DIR or ~/.cache/Compiler/parsetab.
+        """
+        if not table_dir:
+            table_dir = os.environ.get(self.env_var) or os.path.join(os.path.expanduser('~'), '.cache', 'Compiler', 'parsetab')
+        self._table_dir = table_dir
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def table_dir(self) -> str:
+        return self._table_dir
+
+    @classmethod
+    def grammar_hash(cls, parser_class: type) -> str:
+        """
+        Hash everything that PLY reads to build the tables: tokens, precedence, start, and the t_* and p_* rules.
+        The rule order is part of the hash (it decides lexer priority and the start symbol), but line numbers are not.
+        :param parser_class: a subclass of ParserUtil
+        :return: hex digest
+        """
+        h = hashlib.sha256()
+        h.update(f'{lex.__version__}|{yacc.__tabversion__}|{parser_class.__name__}'.encode())
+        for attr in ('tokens', 'literals', 'precedence', 'start', 'states'):
+            h.update(f'{attr}={getattr(parser_class, attr, None)!r}'.encode())
+        rules = []
+        for name in dir(parser_class):
+            if not (name.startswith('t_') or name.startswith('p_')):
+                continue
+            rule = getattr(parser_class, name)
+            if callable(rule):
+                func = getattr(rule, '__func__', rule)
+                line = func.__code__.co_firstlineno if hasattr(func, '__code__') else 0
+                regex = getattr(func, 'regex', func.__doc__)
+                rules.append((line, name, regex))
+            else:
+                rules.append((0, name, rule))
+        rules.sort(key=lambda r: (r[0], r[1]))
+        for _, name, regex in rules:
+            h.update(f'{name}:{regex!r}'.encode())
+        return h.hexdigest()
+
+    def module_names(self, parser_class: type) -> Tuple[str, str]:
+        """
+        Get the lextab and parsetab module names for the given parser class.
+        :param parser_class: a subclass of ParserUtil
+        :return: tuple of (lextab name, parsetab name)
+        """
+        digest = self.grammar_hash(parser_class)[:16]
+        base = f'{parser_class.__name__}_{digest}'
+        return f'lextab_{base}', f'parsetab_{base}'
+
+    def load_module(self, name: str) -> Optional[ModuleType]:
+        """
+        Load a table module from the table dir (without putting the table dir on sys.path).
+        :param name: module name, like parsetab_SasParser_0123456789abcdef
+        :return: the module, or None if it is not in the cache
+        """
+        path = os.path.join(self.table_dir, name + '.py')
+        with self._lock:
+            return self._loaded.get(path) or self._load_module(name, path)
+
+    def _load_module(self, name: str, path: str) -> Optional[ModuleType]:
+        if not os.path.isfile(path):
+            return None
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        try:
+            spec.loader.exec_module(module)
+        except Exception as e:
+            logger.warning(f'Could not load parse table {path}: {e}. Rebuilding.')
+            return None
+        self._loaded[path] = module
+        return module
+
+    def build(self, parser, debug: int = 0, debugfile: str = 'parser.out') -> Tuple[lex.Lexer, yacc.LRParser]:
+        """
+        Build the lexer and parser for the given ParserUtil instance, using the cached tables if possible.
+        :param parser: instance of ParserUtil (or a child class)
+        :param debug: PLY debug flag
+        :param debugfile: name of the yacc debug file
+        :return: tuple of (lexer, parser)
+        """
+        with self._lock:
+            return self._build(parser, debug, debugfile)
+
+    def _build(self, parser, debug: int, debugfile: str) -> Tuple[lex.Lexer, yacc.LRParser]:
+        lexname, parsename = self.module_names(type(parser))
+        lextab = self.load_module(lexname)
+        parsetab = self.load_module(parsename)
+        if lextab and parsetab:
+            self.hits += 1
+            lexer = lex.lex(module=parser, debug=debug, optimize=1, lextab=lextab)
+            lr_parser = yacc.yacc(module=parser, debug=debug, debugfile=debugfile, optimize=1,
+                                  tabmodule=parsetab, write_tables=False)
+            return lexer, lr_parser
+
+        self.misses += 1
+        logger.debug(f'No cached parse tables for {type(parser).__name__}. Building {parsename}.')
+        lexer = lex.lex(module=parser, debug=debug)
+        try:
+            os.makedirs(self.table_dir, exist_ok=True)
+            build_dir = tempfile.mkdtemp(dir=self.table_dir)
+        except OSError as e:
+            logger.warning(f'Cannot write parse tables to {self.table_dir}: {e}. Tables will not be cached.')
+            lr_parser = yacc.yacc(module=parser, debug=debug, debugfile=debugfile, write_tables=False)
+            return lexer, lr_parser
+        try:
+            lexer.writetab(lexname, build_dir)
+            lr_parser = yacc.yacc(module=parser, debug=debug, debugfile=debugfile,
+                                  tabmodule=parsename, outputdir=build_dir)
+            for name in (lexname, parsename):
+                os.replace(os.path.join(build_dir, name + '.py'), os.path.join(self.table_dir, name + '.py'))
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        return lexer, lr_parser
+
+    def clear(self):
+        """
+        Remove every table file from the table dir.
+        """
+        if not os.path.isdir(self.table_dir):
+            return
+        with self._lock:
+            for fn in os.listdir(self.table_dir):
+                if fn.startswith(('lextab_', 'parsetab_')) and fn.endswith('.py'):
+                    path = os.path.join(self.table_dir, fn)
+                    self._loaded.pop(path, None)
+                    os.remove(path)
+
+
+class RuleProfiler:
+    """
+    Call counts, cumulative time and allocations of each p_* and t_* rule function of a parser.
+    This is opt-in (ParserUtil(profile=True)). Without it nothing is wrapped, so the rules run at full speed.
+    String token rules (like t_PLUS) are matched without a call, so they are not in the report.
+    Allocations are the net change of sys.getallocatedblocks() during the calls.
+    """
+    def __init__(self):
+        self._stats = {}     # rule name -> [calls, seconds, blocks]
+
+    def wrap(self, name: str, func):
+        """
+        :param name: rule name, like 'p_procmeans'
+        :param func: the rule function (one argument: a token or a YaccProduction)
+        :return: a function that calls func and records its cost under name
+        """
+        stats = self._stats.setdefault(name, [0, 0.0, 0])
+        clock = time.perf_counter
+        blocks = sys.getallocatedblocks
+
+        def profiled(arg):
+            start_blocks = blocks()
+            start = clock()
+            try:
+                return func(arg)
+            finally:
+                stats[1] += clock() - start
+                stats[2] += blocks() - start_blocks
+                stats[0] += 1
+        profiled.__name__ = name
+        profiled.__doc__ = func.__doc__
+        return profiled
+
+    def instrument_lexer(self, lexer):
+        """
+        Wrap the t_* functions of a PLY lexer or a FastLexer, in place.
+        :param lexer: lex.Lexer or FastLexer
+        """
+        if isinstance(lexer, FastLexer):
+            lexer._actions = [(a[0], self.wrap(a[1].__name__, a[1])) if a and a[1] else a for a in lexer._actions]
+            if lexer._errorf:
+                lexer._errorf = self.wrap(lexer._errorf.__name__, lexer._errorf)
+            return
+        for master in lexer.lexstatere.values():
+            for _, funcs in master:
+                for i, item in enumerate(funcs):
+                    if item and item[0]:
+                        funcs[i] = (self.wrap(item[0].__name__, item[0]), item[1])
+        for state, errorf in lexer.lexstateerrorf.items():
+            lexer.lexstateerrorf[state] = self.wrap(errorf.__name__, errorf)
+        lexer.begin(lexer.lexstate)
+
+    def instrument_parser(self, lr_parser: yacc.LRParser):
+        """
+        Wrap the p_* functions of a PLY parser, in place. The productions of one p_* function share its wrapper.
+        :param lr_parser: yacc.LRParser
+        """
+        wrapped = {}
+        for production in lr_parser.productions:
+            if production.callable is None:
+                continue
+            if production.func not in wrapped:
+                wrapped[production.func] = self.wrap(production.func, production.callable)
+            production.callable = wrapped[production.func]
+        if lr_parser.errorfunc:
+            lr_parser.errorfunc = self.wrap(lr_parser.errorfunc.__name__, lr_parser.errorfunc)
+
+    def reset(self):
+        for stats in self._stats.values():
+            stats[:] = [0, 0.0, 0]
+
+    def stats(self, sort: str = 'seconds') -> List[dict]:
+        """
+        :param sort: 'seconds', 'calls' or 'blocks'
+        :return: one dict per rule that was called, largest first
+        """
+        ans = [{'rule': name, 'calls': calls, 'seconds': seconds, 'blocks': blocks,
+                'us_per_call': seconds / calls * 1e6}
+               for name, (calls, seconds, blocks) in self._stats.items() if calls]
+        ans.sort(key=lambda r: r[sort], reverse=True)
+        return ans
+
+    def report(self, top: int = None, sort: str = 'seconds') -> List[str]:
+        """
+        :param top: number of rules to list. If None, list all.
+        :param sort: 'seconds', 'calls' or 'blocks'
+        :return: lines of a ranked table
+        """
+        rows = self.stats(sort=sort)
+        total = sum(r['seconds'] for r in rows) or 1.0
+        ans = [f'{"rule":<30} {"calls":>10} {"seconds":>10} {"%":>6} {"us/call":>9} {"blocks":>9}']
+        for r in rows[:top]:
+            ans.append(f'{r["rule"]:<30} {r["calls"]:>10} {r["seconds"]:>10.6f} {r["seconds"] / total:>6.1%} '
+                       f'{r["us_per_call"]:>9.2f} {r["blocks"]:>9}')
+        return ans
+
+    def dump(self, target: Union[str, os.PathLike, IO], top: int = None, sort: str = 'seconds'):
+        """
+        Write the report to a path or text stream.
+        :param target: path, or text stream like sys.stderr
+        :param top: number of rules to list. If None, list all.
+        :param sort: 'seconds', 'calls' or 'blocks'
+        """
+        text = '\n'.join(self.report(top=top, sort=sort)) + '\n'
+        if isinstance(target, (str, os.PathLike)):
+            with open(target, 'w', encoding='utf-8') as f:
+                f.write(text)
+        else:
+            target.write(text)
+
+
 class ParserUtil:
     """
     Base class for a lexer/parser that has the rules defined as methods.
+    Each instance has its own lexer, LR parser and AST, so instances may parse at the same time on different threads.
+    One instance parses one program at a time (see ParserPool).
     """
     tokens = ()
     keywords = ()
     precedence = ()
 
     def __init__(self, **kw):
+        """
+        :param kw: debug: PLY debug flag; table_dir: directory for the cached parse tables (see ParseTableCache);
+                   fast: use the FastLexer and skip the per-token debug logging;
+                   profile: record the calls, time and allocations of each rule (see RuleProfiler).
+        """
         self.debug = kw.get('debug', 0)
+        self.fast = kw.get('fast', False)
+        # Decided once, so the token rules do not format log messages that nobody will see.
+        self._trace = not self.fast and logger.isEnabledFor(logging.DEBUG)
         self.names = []
         self._input_lines = None
+        self._ast = AstArena()
+        self._profiler = None
+        self._diagnostics = []
+        self._line_starts = array('q', [0])
+        self._source_length = 0
+        self._statements = None
+        self._statement_offset = 0
+        self._source_offset = None
         try:
             modname = os.path.split(os.path.splitext(__file__)[0])[
                           1] + "_" + self.__class__.__name__
@@ -28,9 +578,78 @@ class ParserUtil:
             modname = "parser" + "_" + self.__class__.__name__
         self.debugfile = modname + ".dbg"
 
-        # build the lexer and parser
-        lex.lex(module=self, debug=self.debug)
-        yacc.yacc(module=self, debug=self.debug, debugfile=self.debugfile)
+        # build the lexer and parser (from the cached tables, if the grammar has not changed)
+        self._table_cache = ParseTableCache(table_dir=kw.get('table_dir'))
+        self._lexer, self._parser = self._table_cache.build(self, debug=self.debug, debugfile=self.debugfile)
+        if self.fast:
+            self._lexer = FastLexer(self)
+        if kw.get('profile', False):
+            self._profiler = RuleProfiler()
+            self._profiler.instrument_lexer(self._lexer)
+            self._profiler.instrument_parser(self._parser)
+
+    @property
+    def table_cache(self) -> ParseTableCache:
+        return self._table_cache
+
+    @property
+    def profiler(self) -> Optional[RuleProfiler]:
+        """
+        :return: the rule profiler, or None if the parser was made without profile=True
+        """
+        return self._profiler
+
+    @property
+    def ast(self) -> AstArena:
+        """
+        (Call run() or run_stream() first.)
+        :return: the arena holding the tree of the last parse
+        """
+        return self._ast
+
+    @property
+    def diagnostics(self) -> List[Diagnostic]:
+        """
+        (Call run(), run_stream() or tokenize() first.)
+        :return: the lexical and syntax errors of the last source, in order
+        """
+        return self._diagnostics
+
+    def diagnose(self, message: str, offset: int) -> Diagnostic:
+        """
+        Record (and log) an error.
+        :param message: what is wrong
+        :param offset: offset in the source
+        :return: the diagnostic
+        """
+        lineno, column = self.position(offset)
+        ans = Diagnostic(message, offset, lineno, column)
+        self._diagnostics.append(ans)
+        logger.error(f'{ans}')
+        return ans
+
+    def position(self, offset: int) -> Tuple[int, int]:
+        """
+        :param offset: offset in the last source
+        :return: tuple of (line, column), both from 1
+        """
+        k = bisect_right(self._line_starts, offset)
+        return k, offset - self._line_starts[k - 1] + 1
+
+    def _index_lines(self, blocks: Iterable[str]) -> Iterator[str]:
+        """
+        Pass the blocks of a new source through, recording the offset of each line start (for diagnose).
+        :param blocks: iterator of str blocks of the source
+        :return: the same blocks
+        """
+        self._diagnostics = []
+        starts = self._line_starts = array('q', [0])
+        base = 0
+        for block in blocks:
+            starts.extend(base + m.end() for m in _newline_re.finditer(block))
+            base += len(block)
+            yield block
+        self._source_length = base
 
     @property
     def input_lines(self):
@@ -50,9 +669,172 @@ class ParserUtil:
                     break
                 if not s:
                     continue
-        newline_count = self.input_lines.count('\n')
-        logger.debug(f'About to parse {newline_count + 1} lines.')
-        yacc.parse(self.input_lines)
+        logger.debug(f'About to parse {len(self.input_lines)} characters.')
+        return self._parse_blocks([self.input_lines])
+
+    def parse(self, text: str) -> Optional[AstNode]:
+        """
+        Parse a program held in a string.
+        :param text: source
+        :return: root of the AST (or None if nothing was parsed)
+        """
+        return self._parse_blocks([text])
+
+    def run_stream(self, source: Source, block_size: int = 1 << 20, encoding: str = 'utf-8'):
+        """
+        Parse a path, file object, or mmap without reading it into memory all at once.
+        The lexer is fed one statement at a time, so the source text held is bounded by the block size and the longest
+        statement. The rest grows with the input, O(lines): the AST, the line starts (8 bytes a line, for diagnostics and
+        position()), and the offset map of the removed comments (16 bytes a comment, for source offsets).
+        :param source: path, text or binary file object, or mmap
+        :param block_size: size of each read
+        :param encoding: used to decode binary files and mmaps
+        :return: root of the AST (or None if nothing was parsed)
+        """
+        return self._parse_blocks(StatementSplitter.read_blocks(source, block_size=block_size, encoding=encoding))
+
+    def _parse_blocks(self, blocks: Iterator[str]) -> Optional[AstNode]:
+        """
+        Strip the comments, split into statements, and parse.
+        :param blocks: iterator of str blocks of the source
+        :return: root of the AST (or None if nothing was parsed)
+        """
+        splitter = StatementSplitter(strip_comments=True)
+        tokens = self._stream_tokens(splitter.statements(self._index_lines(blocks)), splitter)
+        self._lexer.lineno = 1
+        return self.parse_tokens(tokens)
+
+    def tokenize(self, text: str) -> List[lex.LexToken]:
+        """
+        Strip the comments and lex the whole text, without parsing. (For a compiler pass that is timed on its own.)
+        :param text: source
+        :return: list of tokens, with lexpos in the original source
+        """
+        splitter = StatementSplitter(strip_comments=True)
+        self._lexer.lineno = 1
+        return list(self._stream_tokens(splitter.statements(self._index_lines([text])), splitter))
+
+    def parse_tokens(self, tokens: Iterable[lex.LexToken]) -> Optional[AstNode]:
+        """
+        Parse tokens from tokenize() (or any iterable of tokens).
+        :param tokens: iterable of tokens
+        :return: root of the AST (or None if nothing was parsed)
+        """
+        tokens = iter(tokens)
+        self._ast = AstArena()
+        self._statements = None
+        result = self._parser.parse(lexer=self._lexer, tokenfunc=lambda: next(tokens, None), debug=self.debug)
+        return self._finish_ast(result)
+
+    def _stream_tokens(self, statements: Iterator[str], preprocessor: SasPreprocessor) -> Iterator[lex.LexToken]:
+        """
+        Lex each statement in turn. lexpos is mapped back to an offset in the original source.
+        :param statements: iterator of (stripped) statements
+        :param preprocessor: the preprocessor that produced the statements
+        :return: iterator of tokens
+        """
+        lexer = self._lexer
+        source_offset = preprocessor.source_offset
+        self._source_offset = source_offset
+        offset = 0
+        for statement in statements:
+            # For the t_error rule, which sees offsets in the statement.
+            self._statement_offset = offset
+            lexer.input(statement)
+            for tok in lexer:
+                tok.lexpos = source_offset(offset + tok.lexpos)
+                yield tok
+            offset += len(statement)
+
+    def _finish_ast(self, result) -> Optional[AstNode]:
+        """
+        Set the root of the AST from the result of the start rule. A list of nodes is wrapped in a 'program' node.
+        :param result: node index, list of node indices, or None
+        :return: root node, or None
+        """
+        ast = self._ast
+        if result is None and self._statements:
+            # PLY gives up at the end of the input inside an unfinished step. Keep the statements before it.
+            result = self._statements
+        if isinstance(result, list):
+            start = ast.span(result[0])[0] if result else 0
+            end = ast.span(result[-1])[1] if result else 0
+            lineno = ast.lineno(result[0]) if result else 0
+            result = ast.add('program', children=result, start=start, end=end, lineno=lineno)
+        if not isinstance(result, int):
+            ast.root = -1
+            return None
+        ast.root = result
+        return ast.node(result)
+
+    # AST helpers for the p_* rules
+
+    @staticmethod
+    def _symbol_span(sym) -> Tuple[int, int, int]:
+        span = getattr(sym, 'span', None)
+        if span is not None:
+            return span
+        start = getattr(sym, 'lexpos', 0)
+        # The value of PLY's error symbol is the token that caused the error.
+        value = sym.value.value if sym.type == 'error' and hasattr(sym.value, 'value') else sym.value
+        return start, start + len(str(value)), getattr(sym, 'lineno', 0)
+
+    def _lex_offset(self, pos: int) -> int:
+        """
+        :param pos: offset in the statement being lexed (as seen by a t_* rule)
+        :return: offset in the source
+        """
+        if self._source_offset is None:
+            return pos
+        return self._source_offset(self._statement_offset + pos)
+
+    def _mark(self, p) -> Tuple[int, int, int]:
+        """
+        Record the span (start, end, lineno) of the symbols of this production on the result symbol.
+        :param p: PLY YaccProduction
+        :return: the span
+        """
+        start, _, lineno = self._symbol_span(p.slice[1])
+        _, end, _ = self._symbol_span(p.slice[len(p) - 1])
+        span = (start, end, lineno)
+        p.slice[0].span = span
+        return span
+
+    def _node(self, p, kind: str, children: Sequence[int] = (), value=None) -> int:
+        """
+        Add an AST node that spans the symbols of this production.
+        :param p: PLY YaccProduction
+        :param kind: node kind, like 'proc'
+        :param children: indices of the child nodes
+        :param value: node value, like 'MEANS'
+        :return: index of the new node
+        """
+        start, end, lineno = self._mark(p)
+        return self._ast.add(kind, children=children, value=value, start=start, end=end, lineno=lineno)
+
+    def _leaf(self, p, n: int, kind: str) -> int:
+        """
+        Add an AST leaf for the n-th (terminal) symbol of this production.
+        :param p: PLY YaccProduction
+        :param n: position of the terminal
+        :param kind: node kind, like 'name'
+        :return: index of the new node
+        """
+        start, end, lineno = self._symbol_span(p.slice[n])
+        return self._ast.add(kind, value=p[n], start=start, end=end, lineno=lineno)
+
+    def _error(self, p, n: int) -> int:
+        """
+        Add an 'error' node for the text skipped by panic-mode recovery: from the error symbol to the end of the production.
+        Then tell PLY the error is handled, so the next one is reported (p_error has recorded this one).
+        :param p: PLY YaccProduction of an error rule
+        :param n: position of the error symbol
+        :return: index of the new node
+        """
+        start, _, lineno = self._symbol_span(p.slice[n])
+        _, end, _ = self._symbol_span(p.slice[len(p) - 1])
+        p.parser.errok()
+        return self._ast.add('error', start=start, end=end, lineno=lineno)
 
 
 class SasParser(ParserUtil):
@@ -69,10 +851,15 @@ class SasParser(ParserUtil):
         'LPAREN', 'RPAREN',
         'DATASETNAME',
     )
+    reserved = {keyword: keyword for keyword in keywords}
+    # Statements that open and close a step, for IncrementalParser.
+    step_keywords = ('PROC', 'DATA')
+    step_end_keywords = ('RUN', 'QUIT')
 
     # Token rules need to be implemented in each class.
     t_EOL = ';'
     t_PLUS = r'\+'
+    t_MINUS = r'-'
     t_EXP = r'\*\*'
     t_TIMES = r'\*'
     t_DIVIDE = r'/'
@@ -92,21 +879,16 @@ class SasParser(ParserUtil):
 
     def t_DATASETNAME(self, t):
         r'[A-Za-z][A-Za-z0-9\.]*'
-        tupper = str(t.value).upper()
-        if tupper in self.keywords:
-            t.type = tupper
-            logger.debug(f'interpreting as keyword: {t.value}')
-        else:
-            logger.debug(f'encountering datasetname: {t.value}')
+        t.type = self.reserved.get(t.value.upper(), 'DATASETNAME')
+        if self._trace:
+            if t.type == 'DATASETNAME':
+                logger.debug(f'encountering datasetname: {t.value}')
+            else:
+                logger.debug(f'interpreting as keyword: {t.value}')
         return t
 
+    # Comments are removed before lexing, by SasPreprocessor.
     t_ignore = ' \t'
-    t_ignore_COMMENT = r'(\/\*(.|\n)*\*\/)|(^\s*\*(.|\n)*;)'
-
-    # def t_comment(self, t):
-    #     r'(\/\*(.|\n)*\*\/)|(^\s*\*(.|\n)*;)'
-    #     t.lexer.lineno += t.value.count('\n')
-    #     pass
 
     def t_newline(self, t):
         r'\n+'
@@ -114,11 +896,13 @@ class SasParser(ParserUtil):
 
 
     def t_error(self, t):
-        logger.error(f'Illegal character {t.value[0]}')
+        self.diagnose(f'Illegal character {t.value[0]!r}', self._lex_offset(t.lexpos))
         t.lexer.skip(1)
 
     # Parsing rules
 
+    start = 'program'
+
     precedence = (
         ('left', 'PLUS', 'MINUS'),
         ('left', 'TIMES', 'DIVIDE'),
@@ -126,57 +910,201 @@ class SasParser(ParserUtil):
         ('right', 'UMINUS'),
     )
 
+    def p_program(self, p):
+        '''
+        program : statements
+                | statements expression
+                | expression
+        '''
+        # The last expression of the program may leave out its ';', like 1 + 2
+        if len(p) == 3:
+            p[1].append(p[2])
+            p[0] = p[1]
+        elif isinstance(p[1], list):
+            p[0] = p[1]
+        else:
+            p[0] = [p[1]]
+        self._mark(p)
+        self._statements = p[0]
+
+    def p_statements(self, p):
+        '''
+        statements : statements statement
+                   | statement
+        '''
+        if len(p) == 3:
+            p[1].append(p[2])
+            p[0] = p[1]
+        else:
+            p[0] = [p[1]]
+        self._mark(p)
+        # If PLY gives up at the end of the input, _finish_ast still has the statements so far.
+        self._statements = p[0]
+
     def p_statement_proc(self, p):
         '''
         statement : procdecl
         '''
+        p[0] = p[1]
+        self._mark(p)
 
     def p_procdecl(self, p):
         '''
         procdecl : procmeans
         '''
+        p[0] = p[1]
+        self._mark(p)
         logger.debug('encountered proc declaration')
 
     def p_procmeans(self, p):
         '''
         procmeans : procmeansdecl procend
+                  | procmeansdecl procstatements procend
         '''
+        children = p[1] + p[2] if len(p) == 4 else p[1]
+        p[0] = self._node(p, 'proc', children=children, value='MEANS')
         logger.debug('encountered proc means')
 
+    def p_procmeans_error(self, p):
+        '''
+        procmeans : PROC MEANS error procend
+                  | procmeansdecl error procend
+                  | procmeansdecl procstatements error procend
+        '''
+        # Panic mode: skip to RUN; and close the step.
+        if p.slice[1].type == 'PROC':
+            children = [self._error(p, 3)]
+        elif len(p) == 5:
+            children = p[1] + p[2] + [self._error(p, 3)]
+        else:
+            children = p[1] + [self._error(p, 2)]
+        p[0] = self._node(p, 'proc', children=children, value='MEANS')
+
     def p_proc_means_decl(self, p):
         '''
         procmeansdecl : PROC MEANS EOL
                       | PROC MEANS procoptions EOL
         '''
+        p[0] = p[3] if len(p) == 5 else []
+        self._mark(p)
         logger.debug('encountered proc means declaration')
 
+    def p_proc_means_decl_error(self, p):
+        '''
+        procmeansdecl : PROC MEANS error EOL
+        '''
+        # Panic mode: skip the bad options to the end of the PROC statement. The step goes on.
+        p[0] = [self._error(p, 3)]
+        self._mark(p)
+
     def p_proc_options(self, p):
         '''
         procoptions : procoptions procoption
                     | procoption
         '''
+        if len(p) == 3:
+            p[1].append(p[2])
+            p[0] = p[1]
+        else:
+            p[0] = [p[1]]
+        self._mark(p)
 
     def p_proc_option(self, p):
         '''
         procoption : dataoption
         '''
+        p[0] = p[1]
+        self._mark(p)
+
+    def p_proc_keyword_option(self, p):
+        '''
+        procoption : DATASETNAME
+        '''
+        # A keyword option, like the statistic MEAN. These are not reserved words, so they stay valid column names.
+        p[0] = self._node(p, 'option', value=p[1].upper())
 
     def p_data_option(self, p):
         '''
         dataoption : DATA EQUALS DATASETNAME
         '''
+        name = self._leaf(p, 3, 'name')
+        p[0] = self._node(p, 'option', children=[name], value='DATA')
+
+    def p_proc_statements(self, p):
+        '''
+        procstatements : procstatements procstatement
+                       | procstatement
+        '''
+        if len(p) == 3:
+            p[1].append(p[2])
+            p[0] = p[1]
+        else:
+            p[0] = [p[1]]
+        self._mark(p)
+
+    def p_proc_statement(self, p):
+        '''
+        procstatement : DATASETNAME names EOL
+        '''
+        # A statement inside the step, like CLASS origin; or VAR mpg weight;
+        p[0] = self._node(p, 'statement', children=p[2], value=p[1].upper())
+
+    def p_proc_option_statement(self, p):
+        '''
+        procstatement : DATASETNAME DATASETNAME EQUALS DATASETNAME EOL
+        '''
+        # A statement with a dataset option, like OUTPUT OUT=stats;
+        name = self._leaf(p, 4, 'name')
+        start, _, lineno = self._symbol_span(p.slice[2])
+        option = self._ast.add('option', children=[name], value=p[2].upper(), start=start,
+                               end=self._symbol_span(p.slice[4])[1], lineno=lineno)
+        p[0] = self._node(p, 'statement', children=[option], value=p[1].upper())
+
+    def p_proc_statement_error(self, p):
+        '''
+        procstatement : error EOL
+        '''
+        # Panic mode: skip to the end of the statement. The step goes on.
+        p[0] = self._error(p, 1)
+        self._mark(p)
+
+    def p_names(self, p):
+        '''
+        names : names DATASETNAME
+              | DATASETNAME
+        '''
+        if len(p) == 3:
+            p[1].append(self._leaf(p, 2, 'name'))
+            p[0] = p[1]
+        else:
+            p[0] = [self._leaf(p, 1, 'name')]
+        self._mark(p)
 
     def p_procend(self, p):
         '''
         procend : RUN EOL
         '''
+        self._mark(p)
         logger.debug('encountered RUN statement')
 
     def p_statement_expr(self, p):
         '''
-        statement : expression
+        statement : expression EOL
         '''
-        logger.debug(f'encountering expression: {p[1]}')
+        # The ';' keeps a - b one expression, and a; -b two statements.
+        p[0] = p[1]
+        self._mark(p)
+        if self._trace:
+            logger.debug(f'encountering expression: {self._ast.kind(p[1])}')
+
+    def p_statement_error(self, p):
+        '''
+        statement : error EOL
+                  | error procend
+        '''
+        # Panic mode: skip to the end of the statement, or of the step at RUN;
+        p[0] = self._error(p, 1)
+        self._mark(p)
 
     def p_expression_binop(self, p):
         """
@@ -186,31 +1114,351 @@ class SasParser(ParserUtil):
                   | expression DIVIDE expression
                   | expression EXP expression
         """
-        if p[2] == '+':
-            p[0] = p[1] + p[3]
-        elif p[2] == '-':
-            p[0] = p[1] - p[3]
-        elif p[2] == '*':
-            p[0] = p[1] * p[3]
-        elif p[2] == '/':
-            p[0] = p[1] / p[3]
-        elif p[2] == '**':
-            p[0] = p[1] ** p[3]
+        p[0] = self._node(p, 'binop', children=[p[1], p[3]], value=p[2])
 
     def p_expression_uminus(self, p):
         'expression : MINUS expression %prec UMINUS'
-        p[0] = -p[2]
+        p[0] = self._node(p, 'unop', children=[p[2]], value='-')
 
     def p_expression_group(self, p):
         'expression : LPAREN expression RPAREN'
         p[0] = p[2]
+        self._mark(p)
 
     def p_expression_number(self, p):
         'expression : NUMBER'
-        p[0] = p[1]
+        p[0] = self._node(p, 'number', value=p[1])
+
+    def p_expression_name(self, p):
+        'expression : DATASETNAME'
+        p[0] = self._node(p, 'name', value=p[1])
 
     def p_error(self, p):
+        # Only record the error. The error rules above resynchronize.
         if p:
-            logger.error(f'Syntax error at {p.value}')
+            self.diagnose(f'Syntax error at {p.value!r}', p.lexpos)
         else:
-            logger.error('Syntax error at EOF')
+            self.diagnose('Syntax error at end of input', self._source_length)
+
+
+class IncrementalParser:
+    """
+    Reparse only the steps of a program that changed since the last run.
+    The program is split into top-level steps (PROC ... RUN; or a single statement). Each step's AST is cached,
+    keyed by a hash of its normalized text (comments removed, surrounding whitespace stripped).
+    Between runs, only the steps that overlap the edited text are preprocessed and looked up again, widened over any
+    step without RUN; next to them (the edit may move where it ends); the nodes of the other steps are copied from the
+    last AST in two array slices.
+    The diagnostics of each step are cached with its AST, relative to the step, and moved the same way.
+    """
+    _first_word_re = re.compile(r'\s*([A-Za-z_]\w*)\b(?!\s*=)')
+
+    def __init__(self, parser: ParserUtil, max_steps: int = 100000):
+        """
+        :param parser: the parser for changed steps, like SasParser()
+        :param max_steps: size of the step cache. The least recently used steps are evicted.
+        """
+        self.parser = parser
+        self.max_steps = max_steps
+        self._opens = {k.upper() for k in getattr(parser, 'step_keywords', ())}
+        self._closes = {k.upper() for k in getattr(parser, 'step_end_keywords', ())}
+        self._cache = OrderedDict()
+        self._text = ''
+        self._ast = AstArena()
+        # One entry per step of the last run: (source start, source end, first node, root nodes, diagnostics, closed)
+        self._steps = []
+        self._step_starts = []
+        self._diagnostics = []
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def ast(self) -> AstArena:
+        return self._ast
+
+    @property
+    def diagnostics(self) -> List[Diagnostic]:
+        """
+        (Call run() first.)
+        :return: the lexical and syntax errors of the last text, in order, with offsets and lines in that text
+        """
+        return self._diagnostics
+
+    def split_steps(self, statements: Iterator[str]) -> Iterator[List[str]]:
+        """
+        Group statements into steps.
+        :param statements: iterator of (comment-free) statements
+        :return: iterator of steps, each a list of statements
+        """
+        opens = self._opens
+        step = []
+        for statement in statements:
+            word = self._first_word(statement)
+            if word in opens and step:
+                yield step
+                step = []
+            step.append(statement)
+            if self._ends_step(word, len(step)):
+                yield step
+                step = []
+        if step:
+            yield step
+
+    def _first_word(self, statement: str) -> str:
+        m = self._first_word_re.match(statement)
+        return m.group(1).upper() if m else ''
+
+    def _ends_step(self, word: str, size: int) -> bool:
+        """
+        :return: True if a statement starting with word, the size-th of its step, closes the step
+        """
+        return word in self._closes or not (self._opens and (word in self._opens or size > 1))
+
+    def _closed(self, step: List[str]) -> bool:
+        """
+        :return: True if the step ended on its own (RUN;, or a lone statement), not because the next step began.
+                 The statement after a closed step starts a new step, whatever it is.
+        """
+        return not step or self._ends_step(self._first_word(step[-1]), len(step))
+
+    def run(self, text: str) -> Optional[AstNode]:
+        """
+        Parse the program, reusing the AST of every step that did not change.
+        :param text: SAS source
+        :return: root of the AST (or None if nothing was parsed)
+        """
+        old_text, old_ast, old_steps = self._text, self._ast, self._steps
+        old_end = old_ast.root if old_ast.root >= 0 else len(old_ast)
+        delta = len(text) - len(old_text)
+        if old_steps:
+            prefix = self._common_prefix(old_text, text)
+            suffix = self._common_suffix(old_text, text, limit=min(len(old_text), len(text)) - prefix)
+            # The edited steps: from the one holding the char before the edit to the one holding the char after it.
+            first = max(bisect_right(self._step_starts, prefix - 1) - 1, 0)
+            last = min(max(bisect_right(self._step_starts, len(old_text) - suffix) - 1, first), len(old_steps) - 1)
+            # A step that was only ended by the next one may now run on into the edited steps.
+            while first > 0 and not old_steps[first - 1][5]:
+                first -= 1
+            window_start, window_end = old_steps[first][0], old_steps[last][1] + delta
+        else:
+            first, last = 0, -1
+            window_start, window_end = 0, len(text)
+        while True:
+            window = self._window_steps(text, window_start, window_end)
+            if window is None:
+                # The edit left a comment, quote or statement open past the window: redo to the end.
+                last = len(old_steps) - 1
+                window_end = len(text)
+                window = self._window_steps(text, window_start, window_end)
+                break
+            if window_end == len(text) or window[-1][5]:
+                break
+            # The last step of the window is still open, so it may take in the next old step: take that step in too.
+            last += 1
+            window_end = old_steps[last][1] + delta
+
+        ast = AstArena()
+        steps = old_steps[:first]
+        if steps:
+            ast.append_arena(old_ast, [], lo=0, hi=old_steps[first][2] if first < len(old_steps) else old_end)
+        pos, line = window_start, 1 + text.count('\n', 0, window_start)
+        for start, end, normalized, first_char, offset_map, closed in window:
+            line += text.count('\n', pos, first_char)
+            pos = first_char
+            node = len(ast)
+            roots = []
+            diagnostics = []
+            entry = self._lookup(normalized)
+            if entry is not None:
+                step_ast, step_roots, step_diagnostics = entry
+                if offset_map is None:
+                    roots = ast.append_arena(step_ast, step_roots, shift=first_char, line_shift=line - 1)
+                else:
+                    roots = ast.append_arena(step_ast, step_roots, line_shift=line - 1, offset_map=offset_map)
+                for d in step_diagnostics:
+                    offset = first_char + d.offset if offset_map is None else offset_map(d.offset)
+                    diagnostics.append(self._diagnostic(text, d.message, offset, line + text.count('\n', first_char, offset)))
+            steps.append((start, end, node, roots, diagnostics, closed))
+        if last + 1 < len(old_steps):
+            lo = old_steps[last + 1][2]
+            node_shift = len(ast) - lo
+            line_shift = text.count('\n', window_start, window_end) - old_text.count('\n', window_start, window_end - delta)
+            ast.append_arena(old_ast, [], shift=delta, line_shift=line_shift, lo=lo, hi=old_end)
+            steps.extend((s + delta, e + delta, n + node_shift, [r + node_shift for r in roots],
+                          [self._diagnostic(text, d.message, d.offset + delta, d.lineno + line_shift) for d in diagnostics],
+                          closed)
+                         for s, e, n, roots, diagnostics, closed in old_steps[last + 1:])
+        children = [r for step in steps for r in step[3]]
+        if children:
+            ast.root = ast.add('program', children=children, start=ast.span(children[0])[0],
+                               end=ast.span(children[-1])[1], lineno=ast.lineno(children[0]))
+        self._text, self._ast, self._steps = text, ast, steps
+        self._step_starts = [step[0] for step in steps]
+        self._diagnostics = [d for step in steps for d in step[4]]
+        return ast.node(ast.root) if ast.root >= 0 else None
+
+    def _window_steps(self, text: str, start: int, end: int) -> Optional[List[tuple]]:
+        """
+        Preprocess text[start:end], which begins at a step boundary, and split it into steps.
+        The steps partition the window: each one runs to the char after its last ';'.
+        :return: list of (source start, source end, normalized text, offset of its first char, offset map or None,
+                 closed) for each step, or None if the window does not end at a step boundary
+        """
+        pre = SasPreprocessor()
+        statements = list(pre.feed(text[start:end]))
+        if end < len(text) and pre.pending:
+            return None
+        rest = pre.close()
+        if rest is not None:
+            statements.append(rest)
+        out_offsets = pre.offset_map[0]
+        source_offset = pre.source_offset
+        steps = list(self.split_steps(statements))
+        ans = []
+        out = 0
+        step_start = start
+        for i, step in enumerate(steps):
+            step_text = ''.join(step)
+            normalized = step_text.strip()
+            first_out = out + len(step_text) - len(step_text.lstrip())
+            out += len(step_text)
+            step_end = end if i == len(steps) - 1 else start + source_offset(out - 1) + 1
+            offset_map = None
+            # A comment removed from inside the step: spans must go through the offset map.
+            if bisect_right(out_offsets, first_out) != bisect_right(out_offsets, first_out + len(normalized)):
+                offset_map = lambda r, first_out=first_out: start + source_offset(first_out + r)
+            ans.append((step_start, step_end, normalized, start + source_offset(first_out), offset_map, self._closed(step)))
+            step_start = step_end
+        if not ans:
+            ans.append((start, end, '', start, None, True))
+        return ans
+
+    def _lookup(self, normalized: str) -> Optional[tuple]:
+        """
+        Get the cached AST of a step, parsing the step if it is not in the cache.
+        :param normalized: comment-free text of the step, stripped
+        :return: tuple of (arena, list of statement roots in that arena, diagnostics relative to the step),
+                 or None if the step is empty
+        """
+        if not normalized:
+            return None
+        key = hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+        entry = self._cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return entry
+        self.misses += 1
+        self.parser.input_lines = normalized
+        root = self.parser.run()
+        step_ast = self.parser.ast
+        roots = list(step_ast.children(root.index)) if root is not None and root.kind == 'program' else \
+            ([root.index] if root is not None else [])
+        entry = (step_ast, roots, list(self.parser.diagnostics))
+        self._cache[key] = entry
+        if len(self._cache) > self.max_steps:
+            self._cache.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _diagnostic(text: str, message: str, offset: int, lineno: int) -> Diagnostic:
+        """
+        A diagnostic at offset in text. The column is taken from the text, since an edit earlier on the line moves it.
+        """
+        return Diagnostic(message, offset, lineno, offset - text.rfind('\n', 0, offset))
+
+    @staticmethod
+    def _common_prefix(a: str, b: str) -> int:
+        """
+        Length of the common prefix, by binary search over slice compares (which run in C).
+        """
+        lo, hi = 0, min(len(a), len(b))
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if a[lo:mid] == b[lo:mid]:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    @staticmethod
+    def _common_suffix(a: str, b: str, limit: int) -> int:
+        """
+        Length of the common suffix, at most limit.
+        """
+        lo, hi = 0, max(limit, 0)
+        la, lb = len(a), len(b)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if a[la - mid:la - lo] == b[lb - mid:lb - lo]:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+
+class ParserPool:
+    """
+    Parse many programs on a thread pool. Each worker thread makes its own parser on its first task
+    (from the shared table cache), and keeps it, so the lexers, LR parsers and arenas are never shared.
+    With the GIL, the threads overlap I/O (like run_stream on files); on a free-threaded build they also parse in parallel.
+    Typical call:
+      with ParserPool(SasParser, workers=4, fast=True) as pool:
+          roots = list(pool.map(texts))
+    """
+    def __init__(self, parser_class: type = SasParser, workers: int = None, **kw):
+        """
+        :param parser_class: ParserUtil or one of its children
+        :param workers: threads. If None, use the ThreadPoolExecutor default.
+        :param kw: keywords for parser_class, like fast=True or table_dir
+        """
+        self.parser_class = parser_class
+        self._kw = kw
+        self._local = threading.local()
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='parser')
+
+    def parser(self) -> ParserUtil:
+        """
+        :return: the parser of the calling thread, made on first use
+        """
+        ans = getattr(self._local, 'parser', None)
+        if ans is None:
+            ans = self.parser_class(**self._kw)
+            self._local.parser = ans
+        return ans
+
+    def _parse(self, text: str) -> Optional[AstNode]:
+        return self.parser().parse(text)
+
+    def _parse_stream(self, source: Source) -> Optional[AstNode]:
+        return self.parser().run_stream(source)
+
+    def submit(self, text: str) -> futures.Future:
+        """
+        :param text: source
+        :return: future of the root of the AST (each parse has its own arena)
+        """
+        return self._executor.submit(self._parse, text)
+
+    def map(self, texts: Iterable[str]) -> Iterator[Optional[AstNode]]:
+        """
+        :param texts: sources
+        :return: iterator of AST roots, in the order of texts
+        """
+        return self._executor.map(self._parse, texts)
+
+    def map_files(self, sources: Iterable[Source]) -> Iterator[Optional[AstNode]]:
+        """
+        :param sources: paths, file objects or mmaps (see run_stream)
+        :return: iterator of AST roots, in the order of sources
+        """
+        return self._executor.map(self._parse_stream, sources)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> ParserPool:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
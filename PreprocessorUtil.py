@@ -0,0 +1,238 @@
+import logging
+import re
+from array import array
+from bisect import bisect_right
+from typing import Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+* SasPreprocessor is a state machine that scans forward only. Each step is a regex search or str.find from the
+*   current position, so every char is looked at a constant number of times: the run time is linear.
+* It is incremental: the state (in a comment, in a quote, at the start of a statement) is kept between blocks.
+* The offset map holds one (output offset, source offset) pair per removed comment, in two array.array columns,
+*   and bisect finds the pair that applies to an output offset.
+"""
+
+_CODE, _BLOCK, _STAR, _QUOTE = range(4)
+
+class SasPreprocessor:
+    """
+    Single-pass comment stripper and statement splitter for SAS source.
+    Removes /* */ comments and '* ... ;' comment statements, and leaves quoted strings alone.
+    A removed comment is replaced by its newlines (or by one space if it has none), so line numbers do not change.
+    The offset map translates an offset in the output back to an offset in the original source.
+    """
+    _code_re = re.compile(r"/\*|['\";]")
+    _space_re = re.compile(r'\s*')
+
+    def __init__(self, strip_comments: bool = True):
+        """
+        :param strip_comments: if False, only split into statements (the comments are kept)
+        """
+        self.strip_comments = strip_comments
+        self._pieces = []        # output text of the current statement
+        self._tail = ''          # a held-back last char that may start a two-char token
+        self._state = _CODE
+        self._quote = None       # the open quote char, in the _QUOTE state
+        self._at_start = True    # only whitespace (and block comments) since the last ';'
+        self._comment_newlines = 0
+        self._src_base = 0       # source offset of the first char of the next data
+        self._out_total = 0      # chars output so far
+        self._out_offsets = array('q', [0])
+        self._src_offsets = array('q', [0])
+
+    def feed(self, text: str) -> Iterator[str]:
+        """
+        Scan the next block of source text.
+        :param text: next block of source text
+        :return: iterator of the (stripped) statements completed by this block. Each ends with ';'.
+        """
+        data = self._tail + text
+        self._tail = ''
+        n = len(data)
+        pos = 0
+        start = 0   # first char of data not yet output or dropped
+        body = 0    # first char that can be part of a closing '*/' (not the '*' of the opener)
+        strip = self.strip_comments
+        while pos < n:
+            state = self._state
+            if state == _CODE:
+                if self._at_start:
+                    pos = self._space_re.match(data, pos).end()
+                    if pos >= n:
+                        break
+                    c = data[pos]
+                    if c == '*':
+                        start = self._begin_comment(data, start, pos, _STAR)
+                        pos += 1
+                        continue
+                    if c == '/' and pos == n - 1:
+                        break
+                    if not data.startswith('/*', pos):
+                        self._at_start = False
+                m = self._code_re.search(data, pos)
+                if m is None:
+                    pos = n
+                    break
+                tok = m.group()
+                pos = m.end()
+                if tok == ';':
+                    self._keep(data[start:pos])
+                    start = pos
+                    self._at_start = True
+                    yield self._flush()
+                elif tok == '/*':
+                    start = self._begin_comment(data, start, m.start(), _BLOCK)
+                    body = pos
+                else:
+                    self._state = _QUOTE
+                    self._quote = tok
+                    self._at_start = False
+            elif state == _QUOTE:
+                i = data.find(self._quote, pos)
+                if i < 0:
+                    pos = n
+                    break
+                pos = i + 1
+                self._state = _CODE
+            else:
+                end_token = '*/' if state == _BLOCK else ';'
+                i = data.find(end_token, pos)
+                if i < 0:
+                    pos = n
+                    break
+                pos = i + len(end_token)
+                start = self._end_comment(data, start, pos)
+                if state == _STAR:
+                    self._at_start = True
+                    if not strip:
+                        yield self._flush()
+        # A trailing '/' may start a comment, and a trailing '*' may end one. Wait for the next block.
+        # The '*' of a '/*' that ends the block is not held: '/*/' does not close the comment.
+        hold = 0
+        if n and n - 1 >= start:
+            last = data[-1]
+            if (self._state == _CODE and last == '/') or (self._state == _BLOCK and last == '*' and n - 1 >= body):
+                hold = 1
+        if self._state in (_BLOCK, _STAR):
+            self._drop(data[start:n - hold])
+        else:
+            self._keep(data[start:n - hold])
+        self._tail = data[n - hold:]
+        self._src_base += n - hold
+
+    def close(self) -> Optional[str]:
+        """
+        Flush the text after the last ';'.
+        :return: the trailing text, or None if it is only whitespace
+        """
+        if self._tail:
+            if self._state in (_BLOCK, _STAR):
+                self._drop(self._tail)
+            else:
+                self._keep(self._tail)
+            self._src_base += len(self._tail)
+            self._tail = ''
+        if self._state == _BLOCK:
+            logger.warning('Unterminated /* comment at end of input.')
+        if self._state in (_BLOCK, _STAR) and self.strip_comments:
+            self._end_replacement(self._state, self._src_base)
+        self._state = _CODE
+        self._at_start = True
+        rest = self._flush()
+        return rest if rest.strip() else None
+
+    def process(self, text: str) -> str:
+        """
+        Strip the comments from a whole program.
+        :param text: SAS source
+        :return: stripped source
+        """
+        ans = list(self.feed(text))
+        rest = self.close()
+        if rest is not None:
+            ans.append(rest)
+        return ''.join(ans)
+
+    def source_offset(self, offset: int) -> int:
+        """
+        Map an offset in the output to the offset of the same char in the original source.
+        :param offset: offset in the output
+        :return: offset in the source
+        """
+        k = bisect_right(self._out_offsets, offset) - 1
+        return self._src_offsets[k] + (offset - self._out_offsets[k])
+
+    @property
+    def pending(self) -> bool:
+        """
+        :return: True if the text fed so far ends inside a comment, a quoted string, or an unfinished statement
+        """
+        return self._state != _CODE or bool(self._tail) or any(piece.strip() for piece in self._pieces)
+
+    @property
+    def offset_map(self) -> Tuple[array, array]:
+        """
+        :return: tuple of (output offsets, source offsets). Between two entries, offsets advance together.
+        """
+        return self._out_offsets, self._src_offsets
+
+    # Helpers for feed()
+
+    def _keep(self, text: str):
+        if text:
+            self._pieces.append(text)
+            self._out_total += len(text)
+
+    def _drop(self, text: str):
+        if not text:
+            return
+        if self.strip_comments:
+            newlines = text.count('\n')
+            if newlines:
+                self._pieces.append('\n' * newlines)
+                self._out_total += newlines
+                self._comment_newlines += newlines
+        else:
+            self._keep(text)
+
+    def _flush(self) -> str:
+        ans = ''.join(self._pieces)
+        self._pieces = []
+        return ans
+
+    def _begin_comment(self, data: str, start: int, pos: int, state: int) -> int:
+        """
+        Output the code before a comment and enter the comment state.
+        :return: the new start (the first char of the comment)
+        """
+        self._keep(data[start:pos])
+        self._state = state
+        self._comment_newlines = 0
+        return pos
+
+    def _end_comment(self, data: str, start: int, pos: int) -> int:
+        """
+        Drop (or keep) the comment text up to pos and leave the comment state.
+        :return: the new start (pos)
+        """
+        self._drop(data[start:pos])
+        if self.strip_comments:
+            self._end_replacement(self._state, self._src_base + pos)
+        self._state = _CODE
+        return pos
+
+    def _end_replacement(self, kind: int, src_end: int):
+        """
+        Finish the replacement text of a removed comment and record an offset map entry.
+        :param kind: _BLOCK or _STAR
+        :param src_end: source offset just after the comment
+        """
+        if kind == _BLOCK and self._comment_newlines == 0:
+            # Keep the tokens on either side of the comment apart.
+            self._pieces.append(' ')
+            self._out_total += 1
+        self._out_offsets.append(self._out_total)
+        self._src_offsets.append(src_end)
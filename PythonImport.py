@@ -1,24 +1,66 @@
+import itertools
+import keyword
+import re
 import sys
 from abc import ABC, abstractmethod
 import logging
 from collections import defaultdict
-from Add_path import Add_path
-Add_path.add_path(newPath=r'C:\Users\Owner\PycharmProjects\Utilities')
-# sys.path.insert(0, r'C:\Users\Owner\PycharmProjects\Utilities') # Fix for where your Utilities dir is.
-from StringUtil import LineAccmulator
+from typing import Callable, Iterable, List, Set
+from LazyImport import LazyModule
+
+# Imported when the first body is analyzed.
+ast = LazyModule('ast')
+tokenize = LazyModule('tokenize')
+# Imported when the first PythonImport is made. Fix the path for where your Utilities dir is.
+string_util = LazyModule('StringUtil', path=r'C:\Users\Owner\PycharmProjects\Utilities')
 
-logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+"""
+Interesting Python features:
+* used_names parses the emitted body with ast and collects the names it loads, so minimize() can drop
+*   every import that binds a name the body never uses. (A body that does not parse falls back to a regex.)
+* collect_used_names does the same a token at a time, with tokenize pulling the lines through a generator,
+*   so a streamed body can be minimized without holding all of it.
+* In deferred mode, a heavy library is bound to a _LazyModule that imports it on first attribute use,
+*   so a generated program only pays for pandas (say) if it reaches a line that uses it.
+"""
+
+_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
 
 class PythonImport(ABC):
     """
     This is an abstract base class for Python imports.
     It follows a Bridge (Structural) design pattern.
     """
-    def __init__(self):
+    # Top-level packages that are slow to import. In deferred mode, their whole-module imports are made lazy.
+    heavy_libs = frozenset({'pandas', 'numpy', 'pyspark', 'scipy', 'matplotlib', 'sklearn', 'statsmodels'})
+    # Emitted once, before the first deferred import.
+    lazy_import_source = '''
+import importlib
+
+
+class _LazyModule:
+    """Stands in for a module, which is imported the first time one of its attributes is used."""
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        if attr == '_name':
+            raise AttributeError(attr)
+        value = getattr(importlib.import_module(self._name), attr)
+        setattr(self, attr, value)
+        return value
+'''
+
+    def __init__(self, deferred: bool = False):
+        """
+        :param deferred: if True, emit the whole-module imports of heavy_libs as _LazyModule stand-ins
+        """
         self._libs = {}
-        self._emitter = LineAccmulator()
+        self._emitter = string_util.LineAccmulator()
+        self.deferred = deferred
 
     @property
     def libs(self) -> dict:
@@ -28,6 +70,13 @@ class PythonImport(ABC):
     def libs(self, d: dict):
         self._libs = d
 
+    def key(self) -> tuple:
+        """
+        :return: hashable summary of the imports. Two objects with the same key emit the same lines.
+        """
+        libs = ((lib, tuple(sorted(v)) if isinstance(v, set) else v) for lib, v in self.libs.items())
+        return type(self).__name__, self.deferred, tuple(sorted(libs))
+
     @abstractmethod
     def add_lib_method(self, lib: str):
         """
@@ -60,6 +109,103 @@ class PythonImport(ABC):
         """
         self._emitter.add_line(line)
 
+    @abstractmethod
+    def prune(self, used: Set[str]) -> List[str]:
+        """
+        Remove the imports that bind none of the used names.
+        :param used: names used by the program
+        :return: the names that were dropped
+        """
+        raise NotImplementedError('Must be implemented by concrete classes')
+
+    def minimize(self, body: Iterable[str]) -> List[str]:
+        """
+        Keep only the imports used by the body.
+        :param body: lines of the emitted program (without the imports)
+        :return: the names that were dropped
+        """
+        dropped = self.prune(self.used_names(body))
+        if dropped:
+            logger.debug(f'Dropped unused imports: {dropped}')
+        return dropped
+
+    @staticmethod
+    def used_names(body: Iterable[str]) -> Set[str]:
+        """
+        Names loaded by the body, like {'pd', 'print'} for print(pd.concat(x)).
+        :param body: lines of Python
+        :return: set of names
+        """
+        text = '\n'.join(body)
+        try:
+            tree = ast.parse(text)
+        except SyntaxError:
+            # Not a whole program: every identifier outside the comments counts, which can only keep extra imports.
+            logger.debug('Body does not parse; finding the used names with a regex.')
+            return set(_IDENTIFIER.findall(re.sub(r'#.*', '', text)))
+        return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+
+    @staticmethod
+    def collect_used_names(lines: Iterable[str], sink: Callable[[str], object] = None) -> Set[str]:
+        """
+        Names used by the body, read one line at a time, so the body need not be in memory.
+        Every name that is not a keyword or an attribute (after a '.') counts, so an assigned name or a keyword argument
+        can keep an extra import, but a used one is never dropped. From a line that does not tokenize on, the regex
+        of used_names is used.
+        :param lines: lines of Python. May be a generator.
+        :param sink: called with each line as it is read, like the write of a spool file
+        :return: set of names
+        """
+        used = set()
+        # Physical lines of the current logical line: scanned again with the regex if tokenize fails on it.
+        pending = []
+
+        def physical():
+            for line in lines:
+                if sink is not None:
+                    sink(line)
+                for part in line.split('\n'):
+                    if pending is not None:
+                        pending.append(part)
+                    yield part + '\n'
+
+        parts = physical()
+        prev = None
+        try:
+            # A readline that raises StopIteration ends the input.
+            for tok in tokenize.generate_tokens(parts.__next__):
+                if tok.type == tokenize.NAME:
+                    if prev != '.' and not keyword.iskeyword(tok.string):
+                        used.add(tok.string)
+                elif tok.type == tokenize.STRING and 'f' in tok.string[:tok.string.index(tok.string[-1])].lower():
+                    # Before Python 3.12, an f-string is one token: its fields are found with ast.
+                    used |= PythonImport.used_names([tok.string])
+                elif tok.type in (tokenize.NEWLINE, tokenize.NL):
+                    pending.clear()
+                prev = tok.string if tok.type == tokenize.OP else None
+        except (tokenize.TokenError, SyntaxError):
+            logger.debug('Body does not tokenize; finding the rest of the used names with a regex.')
+            rest = list(pending)
+            pending = None
+            for part in itertools.chain(rest, parts):
+                used.update(_IDENTIFIER.findall(re.sub(r'#.*', '', part)))
+        return used
+
+    def is_deferred(self, lib: str) -> bool:
+        """
+        :param lib: library name, like pandas or pyspark.sql.functions
+        :return: True if the import of lib is emitted as a _LazyModule
+        """
+        return self.deferred and lib.split('.')[0] in self.heavy_libs
+
+    @classmethod
+    def lazy_import_lines(cls) -> List[str]:
+        return cls.lazy_import_source.strip('\n').split('\n') + ['', '']
+
+    def add_lazy_import_lines(self):
+        for line in self.lazy_import_lines():
+            self.add_line_to_emission(line)
+
 
 class PandasStyleImport(PythonImport):
     """
@@ -67,8 +213,8 @@ class PandasStyleImport(PythonImport):
       import pandas as pd
       import numpy as np
     """
-    def __init__(self):
-        super(PandasStyleImport, self).__init__()
+    def __init__(self, deferred: bool = False):
+        super(PandasStyleImport, self).__init__(deferred=deferred)
 
     def add_lib_method(self, lib: str, alias: str) -> dict:
         """
@@ -80,13 +226,27 @@ class PandasStyleImport(PythonImport):
         self.libs[lib] = alias
         return self.libs
 
-    def emit(self):
+    def emit(self, helper: bool = True):
+        """
+        :param helper: emit the _LazyModule class before the first deferred import
+        """
         d = self.libs
         for lib, alias in d.items():
-            line = f'import {lib} as {alias}'
+            if self.is_deferred(lib):
+                if helper:
+                    self.add_lazy_import_lines()
+                    helper = False
+                line = f'{alias} = _LazyModule({lib!r})'
+            else:
+                line = f'import {lib} as {alias}'
             logger.debug(f'emitting Pandas-style import: <{line}>')
             self.add_line_to_emission(line)
 
+    def prune(self, used: Set[str]) -> List[str]:
+        dropped = [alias for alias in self.libs.values() if alias not in used]
+        self.libs = {lib: alias for lib, alias in self.libs.items() if alias in used}
+        return dropped
+
 
 class PythonStyleImport(PythonImport):
     """
@@ -94,8 +254,12 @@ class PythonStyleImport(PythonImport):
       import sys
       from collections import defaultdict
     """
-    def __init__(self):
-        super(PythonStyleImport, self).__init__()
+    def __init__(self, deferred: bool = False):
+        """
+        :param deferred: if True, emit the bare imports of heavy_libs (import numpy) as _LazyModule stand-ins.
+          A from-import (from numpy import array) binds the object itself, so it stays eager.
+        """
+        super(PythonStyleImport, self).__init__(deferred=deferred)
         self.libs = defaultdict(lambda: set())
 
     def add_lib_method(self, lib: str, method: str = None):
@@ -113,9 +277,18 @@ class PythonStyleImport(PythonImport):
             self.libs[lib] = set()
         return self.libs
 
-    def emit(self):
+    def emit(self, helper: bool = True):
+        """
+        :param helper: emit the _LazyModule class before the first deferred import
+        """
         for lib, methods in self.libs.items():
-            if methods == set():
+            if methods == set() and self.is_deferred(lib) and '.' not in lib:
+                # A dotted lib binds its top package, so only a plain one can be a stand-in.
+                if helper:
+                    self.add_lazy_import_lines()
+                    helper = False
+                line = f'{lib} = _LazyModule({lib!r})'
+            elif methods == set():
                 # Empty set. import the whole lib.
                 line = f'import {lib}'
             else:
@@ -126,3 +299,46 @@ class PythonStyleImport(PythonImport):
                 line = f'from {lib} import {methods_str}'
             logger.debug(f'emitting Python-style import: <{line}>')
             self.add_line_to_emission(line)
+
+    def prune(self, used: Set[str]) -> List[str]:
+        dropped = []
+        for lib, methods in list(self.libs.items()):
+            if methods == set():
+                # import a.b binds a
+                if lib.split('.')[0] not in used:
+                    dropped.append(lib)
+                    del self.libs[lib]
+                continue
+            unused = {method for method in methods if method not in used}
+            dropped.extend(sorted(unused))
+            methods -= unused
+            if not methods:
+                del self.libs[lib]
+        return dropped
+
+
+def emit_imports(imports: Iterable[PythonImport], body: Iterable[str] = None, deferred: bool = False,
+                 used: Set[str] = None) -> List[str]:
+    """
+    The import lines of a program, minimized against its body.
+    :param imports: PythonImport objects with the libs the program may use
+    :param body: lines of the program. If None (and used is None), every import is kept.
+    :param deferred: emit the imports of heavy libs as _LazyModule stand-ins (the class is emitted once)
+    :param used: names used by the program, if already known (see collect_used_names). Then body is not read.
+    :return: lines
+    """
+    if used is None and body is not None:
+        used = PythonImport.used_names(body)
+    ans = []
+    helper = True
+    for imp in imports:
+        if used is not None:
+            imp.prune(used)
+        imp.deferred = deferred
+        imp.emit(helper=False)
+        lines = imp.emission()
+        if helper and any('_LazyModule(' in line for line in lines):
+            ans.extend(PythonImport.lazy_import_lines())
+            helper = False
+        ans.extend(lines)
+    return ans
@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List
+
+import EmitterUtil
+from CompilerUtil import SasCompilerUtil
+from EmitterUtil import EmitterHelpers
+from ParserUtil import ParseTableCache, SasParser
+
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+* The front end is asyncio: one task per connection reads newline-delimited JSON requests and writes the replies.
+* The CPU-bound work (lex, parse, emit) runs in a pool (run_in_executor), where each worker keeps a warm parser,
+*   so a request pays neither interpreter start-up, imports, nor building the PLY tables.
+* Backpressure: a connection does not read its next request until a slot of the in-flight semaphore is free,
+*   so a flooded server stops reading and the clients' socket buffers fill, instead of queueing without bound.
+* Requests of one connection may complete out of order; each reply carries the id of its request.
+"""
+
+# The warm compilers of this worker, by emitter class name and options, least recently used first. Set by _init_worker.
+_worker_parser = None
+_worker_helpers = None
+_worker_compilers = OrderedDict()
+# Compilers kept per worker. The options come from the clients, so there may be any number of them.
+max_worker_compilers = 32
+
+
+def _init_worker(parser_class: type, table_dir: str):
+    global _worker_parser, _worker_helpers, _worker_compilers
+    _worker_parser = parser_class(table_dir=table_dir, fast=True)
+    _worker_helpers = EmitterHelpers()
+    _worker_compilers = OrderedDict()
+
+
+def _init_pool_worker(*initargs):
+    # Only in a worker process: logging.disable is process-wide, so in the server process it would silence the server.
+    logging.disable(logging.INFO)
+    _init_worker(*initargs)
+
+
+def emitter_class(name: str) -> type:
+    """
+    :param name: name of an EmitterUtil class, like 'PandasEmitterUtil'
+    :return: the class
+    """
+    cls = getattr(EmitterUtil, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, EmitterUtil.EmitterUtil)):
+        raise ValueError(f'Unknown emitter: {name}')
+    return cls
+
+
+def _compile_in_worker(source: str, emitter: str, options: dict) -> tuple:
+    """
+    Compile one program with the warm parser of this worker.
+    :return: tuple of (program text, compile seconds, diagnostics as dicts)
+    """
+    start = time.perf_counter()
+    key = (emitter, json.dumps(options, sort_keys=True))
+    compiler = _worker_compilers.get(key)
+    if compiler is None:
+        compiler = SasCompilerUtil(parser=_worker_parser, emitter_class=emitter_class(emitter), emitter_options=options,
+                                   helpers=_worker_helpers)
+        _worker_compilers[key] = compiler
+        if len(_worker_compilers) > max_worker_compilers:
+            _worker_compilers.popitem(last=False)
+    else:
+        _worker_compilers.move_to_end(key)
+    unit = compiler.compile(source)
+    return '\n'.join(unit.lines) + '\n', time.perf_counter() - start, [d.as_dict() for d in unit.diagnostics]
+
+
+class CompileServer:
+    """
+    Resident compile service on a Unix socket or a localhost TCP port.
+    Each request is one line of JSON: {"id": 1, "source": "PROC MEANS ...", "emitter": "PandasEmitterUtil", "options": {}}
+    and each reply is one line: {"id": 1, "status": "ok", "program": "...", "latency_ms": ..., "compile_ms": ...}.
+    A program with syntax errors gets "status": "error" and all its "diagnostics" (message, offset, lineno, column).
+    {"op": "stats"} replies with the latency statistics of the requests so far.
+    """
+    default_emitter = 'PandasEmitterUtil'
+
+    def __init__(self, workers: int = None, max_in_flight: int = None, executor: str = 'process',
+                 parser_class: type = SasParser, table_dir: str = None, max_line: int = 1 << 26, latency_window: int = 10000):
+        """
+        :param workers: workers of the pool. If None, use os.cpu_count().
+        :param max_in_flight: requests being compiled or waiting for a worker, over all connections. If None, 4 per worker.
+        :param executor: 'process' for a process pool (parsing in parallel), or 'thread' (one process, for testing)
+        :param parser_class: SasParser or one of its children
+        :param table_dir: directory for the cached parse tables (see ParseTableCache)
+        :param max_line: longest request, in bytes
+        :param latency_window: the latency percentiles in stats() are over this many of the latest requests
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or 4 * self.workers
+        self.executor = executor
+        self.parser_class = parser_class
+        self.table_dir = ParseTableCache(table_dir).table_dir
+        self.max_line = max_line
+        self._pool = None
+        self._server = None
+        self._slots = None
+        self._latencies = deque(maxlen=latency_window)
+        self.requests = 0
+        self.errors = 0
+
+    def _make_pool(self) -> Executor:
+        initargs = (self.parser_class, self.table_dir)
+        if self.executor == 'thread':
+            # One worker: the thread pool shares the worker globals of this process.
+            return ThreadPoolExecutor(max_workers=1, initializer=_init_worker, initargs=initargs)
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_pool_worker, initargs=initargs)
+
+    async def start(self, path: str = None, host: str = '127.0.0.1', port: int = 0) -> asyncio.AbstractServer:
+        """
+        Start the pool and listen.
+        :param path: Unix socket path. If None, listen on host and port.
+        :param host: TCP host (localhost by default)
+        :param port: TCP port. 0 picks a free one (see address).
+        :return: the asyncio server
+        """
+        # Build the tables once here, so no worker has to.
+        self.parser_class(table_dir=self.table_dir)
+        self._pool = self._make_pool()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        if path:
+            self._server = await asyncio.start_unix_server(self._serve, path=path, limit=self.max_line)
+        else:
+            self._server = await asyncio.start_server(self._serve, host=host, port=port, limit=self.max_line)
+        logger.info(f'Compile server listening on {self.address} with {self.workers} {self.executor} workers.')
+        return self._server
+
+    @property
+    def address(self):
+        """
+        :return: the Unix socket path, or (host, port)
+        """
+        return self._server.sockets[0].getsockname()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks = set()
+        lock = asyncio.Lock()
+        try:
+            while True:
+                # Backpressure: wait for a free slot before reading the next request.
+                await self._slots.acquire()
+                try:
+                    line = await reader.readline()
+                except (ValueError, ConnectionError) as e:
+                    self._slots.release()
+                    logger.warning(f'Closing connection: {e}')
+                    break
+                if not line:
+                    self._slots.release()
+                    break
+                task = asyncio.ensure_future(self._handle(line, writer, lock, time.perf_counter()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.CancelledError:
+            # The server is closing. Returning (not raising) keeps asyncio from logging the cancelled handler.
+            for task in tasks:
+                task.cancel()
+        finally:
+            writer.close()
+
+    async def _handle(self, line: bytes, writer: asyncio.StreamWriter, lock: asyncio.Lock, received: float):
+        try:
+            reply = await self.reply(line, received)
+        finally:
+            self._slots.release()
+        async with lock:
+            writer.write(json.dumps(reply).encode() + b'\n')
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def reply(self, line: bytes, received: float) -> dict:
+        """
+        :param line: one request
+        :param received: perf_counter when the request was read
+        :return: the reply
+        """
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            if request.get('op') == 'stats':
+                return {'id': request_id, 'status': 'ok', 'stats': self.stats()}
+            emitter = request.get('emitter') or self.default_emitter
+            emitter_class(emitter)
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            program, compile_seconds, diagnostics = await loop.run_in_executor(
+                self._pool, _compile_in_worker, request['source'], emitter, request.get('options') or {})
+            ans = {'id': request_id, 'status': 'ok', 'program': program,
+                   'queue_ms': (started - received) * 1e3, 'compile_ms': compile_seconds * 1e3}
+            if diagnostics:
+                # The program holds the steps without errors.
+                ans['status'] = 'error'
+                ans['error'] = f'{len(diagnostics)} syntax error(s)'
+                ans['diagnostics'] = diagnostics
+        except Exception as e:
+            self.errors += 1
+            ans = {'id': request_id, 'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+        latency = time.perf_counter() - received
+        ans['latency_ms'] = latency * 1e3
+        self.requests += 1
+        self._latencies.append(latency)
+        return ans
+
+    def stats(self) -> dict:
+        """
+        :return: request count and errors so far, and latency percentiles (ms) of the latest requests (see latency_window)
+        """
+        ans = {'requests': self.requests, 'errors': self.errors}
+        latencies = sorted(self._latencies)
+        if latencies:
+            ans['p50_ms'] = statistics.median(latencies) * 1e3
+            ans['p99_ms'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e3
+            ans['max_ms'] = latencies[-1] * 1e3
+        return ans
+
+
+async def compile_remote(requests: List[dict], path: str = None, host: str = '127.0.0.1', port: int = None) -> List[dict]:
+    """
+    Send requests on one connection and wait for all the replies.
+    :param requests: request dicts. An id is added to each that has none.
+    :param path: Unix socket path of the server. If None, use host and port.
+    :param host: TCP host
+    :param port: TCP port
+    :return: replies, in the order of the requests
+    """
+    if path:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        ids = []
+        for i, request in enumerate(requests):
+            request = dict(request)
+            request.setdefault('id', i)
+            ids.append(request['id'])
+            writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+        replies = {}
+        while len(replies) < len(ids):
+            line = await reader.readline()
+            if not line:
+                break
+            reply = json.loads(line)
+            replies[reply.get('id')] = reply
+        return [replies.get(i) for i in ids]
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description='Resident SAS to Python compile server.')
+    ap.add_argument('--unix', default=None, help='listen on this Unix socket path')
+    ap.add_argument('--host', default='127.0.0.1', help='TCP host (default: localhost)')
+    ap.add_argument('--port', type=int, default=8765, help='TCP port')
+    ap.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    ap.add_argument('--max-in-flight', type=int, default=None, help='requests compiling or queued (default: 4 per worker)')
+    ap.add_argument('--table-dir', default=None, help='directory for the cached parse tables')
+    args = ap.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    server = CompileServer(workers=args.workers, max_in_flight=args.max_in_flight, table_dir=args.table_dir)
+
+    async def serve():
+        await server.start(path=args.unix, host=args.host, port=args.port)
+        try:
+            await server._server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,17 +1,23 @@
+import logging
 from pathlib import Path, PurePath
 from sys import path
 
+logger = logging.getLogger(__name__)
+
+def add_parent() -> str:
+    """
+    Add the parent dir of Utilities to sys.path. (This was done at import time; now it is up to the caller.)
+    """
+    return add_path(Path('..').resolve())
+
 def add_path(newPath: str) -> str:
     # Taken from ExecUtil.
     strPath = str(newPath) if isinstance(newPath, PurePath) else newPath
 
     if strPath in path:
-        print(f'path: {newPath} is already on sys.path. (No action taken.)')
+        logger.debug(f'path: {newPath} is already on sys.path. (No action taken.)')
         return path
     else:
-        print(f'Adding new path: {strPath} to sys.path.')
+        logger.debug(f'Adding new path: {strPath} to sys.path.')
         path.append(strPath)
     return path
-
-parent = Path('..').resolve() # Must add the parent dir of Utilities.
-add_path(parent)
\ No newline at end of file
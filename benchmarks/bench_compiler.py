@@ -0,0 +1,150 @@
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Callable, List
+
+from CompilerUtil import PassManager, SasCompilerUtil
+from EmitterUtil import ChunkedPandasEmitterUtil, EmitterHelpers, PandasEmitterUtil, PySparkEmitterUtil
+from ParserUtil import SasParser
+from benchmarks.corpus import SasCorpus
+
+logger = logging.getLogger(__name__)
+
+"""
+Benchmark of the lexer, the parser, the whole compiler, and each emitter on a synthetic corpus (see corpus.py).
+Each result is the best of --repeat timings; the peak memory is measured in a separate run, under tracemalloc.
+The results are written as JSON, and --baseline compares them with an earlier file. Run from the repo root:
+    python -m benchmarks.bench_compiler --steps 2000 --out bench.json
+    python -m benchmarks.bench_compiler --steps 2000 --baseline bench.json
+"""
+
+_EMITTERS = (PandasEmitterUtil, ChunkedPandasEmitterUtil, PySparkEmitterUtil)
+
+
+def best_time(function: Callable[[], object], repeat: int) -> float:
+    """
+    :param function: work to time
+    :param repeat: timings
+    :return: the fastest wall time, in seconds
+    """
+    ans = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        ans = min(ans, time.perf_counter() - start)
+    return ans
+
+
+def peak_memory(function: Callable[[], object]) -> int:
+    """
+    :param function: work to measure
+    :return: peak bytes allocated by Python during the call
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def result(name: str, seconds: float, items: int = None, unit: str = None, peak_bytes: int = None, **extra) -> dict:
+    ans = {'name': name, 'seconds': seconds}
+    if items is not None:
+        ans['items'] = items
+        ans['unit'] = unit
+        ans['per_second'] = items / seconds if seconds else None
+    if peak_bytes is not None:
+        ans['peak_bytes'] = peak_bytes
+    ans.update(extra)
+    return ans
+
+
+def run(text: str, repeat: int = 5) -> List[dict]:
+    """
+    Measure every stage on one program.
+    :param text: SAS program
+    :param repeat: timings of each measurement; the best is kept
+    :return: list of results
+    """
+    ans = []
+    for fast in (False, True):
+        parser = SasParser(fast=fast)
+        label = 'fast' if fast else 'ply'
+        tokens = parser.tokenize(text)
+        ans.append(result(f'lex[{label}]', best_time(lambda: parser.tokenize(text), repeat), len(tokens), 'tokens'))
+        root = parser.parse_tokens(tokens)
+        statements = len(root.children) if root is not None else 0
+        ans.append(result(f'parse[{label}]', best_time(lambda: parser.parse_tokens(tokens), repeat), statements, 'statements'))
+    parser = SasParser(fast=True)
+    helpers = EmitterHelpers()
+    for emitter_class in _EMITTERS:
+        compiler = SasCompilerUtil(parser=parser, emitter_class=emitter_class, helpers=helpers)
+        name = emitter_class.__name__
+        unit = compiler.compile(text)
+        statements = next(r for r in unit.stats if r['pass'] == 'analyze')['output_size']
+        seconds = best_time(lambda: compiler.compile(text), repeat)
+        peak = peak_memory(lambda: compiler.compile(text))
+        ans.append(result(f'compile[{name}]', seconds, statements, 'statements', peak_bytes=peak, lines=len(unit.lines)))
+        records = []
+        for _ in range(repeat):
+            records.extend(compiler.compile(text).stats)
+        for pass_name, total in PassManager.totals(records).items():
+            ans.append(result(f'pass[{name}].{pass_name}', total['wall_seconds'] / total['units'],
+                              cpu_seconds=total['cpu_seconds'] / total['units']))
+    return ans
+
+
+def compare(results: List[dict], baseline: List[dict]) -> List[str]:
+    """
+    :param results: this run
+    :param baseline: an earlier run
+    :return: one line per result in both, with the change of its time
+    """
+    before = {r['name']: r['seconds'] for r in baseline}
+    ans = []
+    for r in results:
+        old = before.get(r['name'])
+        if old:
+            ans.append(f'{r["name"]:>45}: {old * 1e3:10.3f} ms -> {r["seconds"] * 1e3:10.3f} ms ({r["seconds"] / old - 1:+7.1%})')
+    return ans
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description='Throughput and memory of the SAS compiler on a synthetic corpus.')
+    ap.add_argument('--steps', type=int, default=500, help='PROC MEANS steps in the program')
+    ap.add_argument('--expressions', type=int, default=2, help='most expression statements after each step')
+    ap.add_argument('--seed', type=int, default=0, help='seed of the corpus generator')
+    ap.add_argument('-r', '--repeat', type=int, default=5, help='timings; the best is reported')
+    ap.add_argument('--out', default=None, help='write the results to this JSON file')
+    ap.add_argument('--baseline', default=None, help='JSON file of an earlier run to compare with')
+    args = ap.parse_args(argv)
+    logging.disable(logging.INFO)
+    corpus = SasCorpus(seed=args.seed, steps=args.steps, expressions=args.expressions)
+    text = corpus.program()
+    results = run(text, repeat=args.repeat)
+    report = {
+        'corpus': {'seed': args.seed, 'steps': args.steps, 'expressions': args.expressions, 'chars': len(text)},
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    for r in results:
+        rate = f'{r["per_second"]:12.0f} {r["unit"]}/s' if r.get('per_second') else ''
+        print(f'{r["name"]:>45}: {r["seconds"] * 1e3:10.3f} ms {rate}')
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            print('\n'.join(compare(results, json.load(f)['results'])))
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
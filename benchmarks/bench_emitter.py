@@ -0,0 +1,44 @@
+import argparse
+import io
+import logging
+import timeit
+from typing import List
+
+from EmitterUtil import EmitterHelpers, EmitterUtil
+
+logger = logging.getLogger(__name__)
+
+"""
+Micro-benchmark of the fixed cost of emitting one module: making the emitter, the preamble and the banners.
+Run from the repo root:
+    python -m benchmarks.bench_emitter -n 2000
+"""
+
+def emit_modules(n: int, shared: bool) -> None:
+    """
+    Emit n small modules.
+    :param n: number of modules
+    :param shared: if True, all emitters share one EmitterHelpers (a batch); if False, each makes its own
+    """
+    helpers = EmitterHelpers() if shared else None
+    for i in range(n):
+        eu = EmitterUtil(helpers=helpers)
+        eu.add_to_body(f'x = {i}')
+        eu.emit_to(io.StringIO())
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description='Per-module overhead of EmitterUtil.')
+    ap.add_argument('-n', '--modules', type=int, default=2000, help='modules per timing')
+    ap.add_argument('-r', '--repeat', type=int, default=5, help='timings; the best is reported')
+    args = ap.parse_args(argv)
+    logging.disable(logging.INFO)
+    for shared in (False, True):
+        best = min(timeit.repeat(lambda: emit_modules(args.modules, shared), number=1, repeat=args.repeat))
+        label = 'shared helpers' if shared else 'own helpers'
+        print(f'{label:>15}: {best / args.modules * 1e6:8.1f} us per module')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
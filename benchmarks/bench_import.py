@@ -0,0 +1,50 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import List
+
+"""
+Cold-start cost of the compiler modules: each timing is a new interpreter that imports them.
+Run from the repo root:
+    python -m benchmarks.bench_import -n 20
+"""
+
+MODULES = ('ParserUtil', 'EmitterUtil', 'CompilerUtil')
+# Budget for importing MODULES, on top of the interpreter start-up.
+BUDGET_SECONDS = 0.1
+
+_PROBE = '''
+import sys, time
+start = time.perf_counter()
+import {modules}
+print(time.perf_counter() - start)
+'''
+
+
+def import_seconds(modules=MODULES, cwd: str = None) -> float:
+    """
+    :param modules: module names
+    :param cwd: dir to import them from. If None, the repo root.
+    :return: seconds to import the modules in a new interpreter
+    """
+    cwd = cwd or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    probe = _PROBE.format(modules=', '.join(modules))
+    out = subprocess.run([sys.executable, '-c', probe], cwd=cwd, check=True, capture_output=True, text=True).stdout
+    return float(out.split()[-1])
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description='Import time of the compiler modules in a new interpreter.')
+    ap.add_argument('-n', '--runs', type=int, default=20, help='interpreters to start')
+    args = ap.parse_args(argv)
+    times = [import_seconds() for _ in range(args.runs)]
+    median = statistics.median(times)
+    print(f'import {", ".join(MODULES)}: median {median * 1e3:.1f} ms, best {min(times) * 1e3:.1f} ms '
+          f'(budget {BUDGET_SECONDS * 1e3:.0f} ms)')
+    return 0 if median <= BUDGET_SECONDS else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,104 @@
+import argparse
+import random
+from typing import Iterator, List
+
+"""
+Seeded generator of synthetic SAS programs for the benchmarks.
+The same seed and sizes always give the same program, so timings of different runs compare the same input.
+Write a program to stdout from the repo root:
+    python -m benchmarks.corpus --steps 100 --seed 1
+"""
+
+_COLUMNS = ['mpg', 'weight', 'price', 'length', 'height', 'cyl', 'hp', 'torque', 'year', 'origin', 'make', 'type']
+_STATS = ['N', 'MEAN', 'STD', 'STDERR', 'MIN', 'MAX', 'SUM', 'VAR']
+_OPS = ['+', '-', '*', '/', '**']
+_WORDS = ['check', 'totals', 'by', 'origin', 'see', 'ticket', 'rerun', 'monthly', 'note', 'old', 'version']
+
+
+class SasCorpus:
+    """
+    Make SAS programs of PROC MEANS steps, expression statements, and comments.
+    """
+    def __init__(self, seed: int = 0, steps: int = 100, expressions: int = 2, comments: float = 0.5, max_depth: int = 4):
+        """
+        :param seed: seed of the random generator
+        :param steps: PROC MEANS steps per program
+        :param expressions: expression statements after each step (0 to this many)
+        :param comments: probability of a comment before each step and inside each expression
+        :param max_depth: deepest nesting of an expression
+        """
+        self.seed = seed
+        self.steps = steps
+        self.expressions = expressions
+        self.comments = comments
+        self.max_depth = max_depth
+
+    def program(self) -> str:
+        return ''.join(self.pieces())
+
+    def pieces(self) -> Iterator[str]:
+        """
+        Generate the program a piece at a time.
+        :return: iterator of str
+        """
+        rng = random.Random(self.seed)
+        for i in range(self.steps):
+            # Every statement ends with ';', so both kinds of comment can come before a step.
+            if rng.random() < self.comments:
+                if rng.random() < 0.5:
+                    yield f'* {self.words(rng)};\n'
+                else:
+                    yield f'/* {self.words(rng)} */\n'
+            yield self.step(rng, i)
+            for _ in range(rng.randint(0, self.expressions)):
+                yield self.expression(rng, self.max_depth) + ';\n'
+
+    def step(self, rng: random.Random, i: int) -> str:
+        """
+        :param rng: random generator
+        :param i: step number, used in the dataset name
+        :return: one PROC MEANS step, like PROC MEANS DATA=lib.ds1 MEAN STD; CLASS origin; VAR mpg; RUN;
+        """
+        stats = rng.sample(_STATS, rng.randint(0, 4))
+        columns = rng.sample(_COLUMNS, rng.randint(2, 5))
+        lines = [' '.join(['PROC MEANS', f'DATA=lib.ds{i}'] + stats) + ';']
+        if rng.random() < 0.7:
+            lines.append(f'  CLASS {columns[0]};')
+        if rng.random() < 0.8:
+            lines.append('  VAR ' + ' '.join(columns[1:]) + ';')
+        lines.append('RUN;')
+        return '\n'.join(lines) + '\n'
+
+    def expression(self, rng: random.Random, depth: int) -> str:
+        """
+        :param rng: random generator
+        :param depth: levels of nesting left
+        :return: an arithmetic expression over the columns
+        """
+        if depth <= 0 or rng.random() < 0.3:
+            return rng.choice(_COLUMNS) if rng.random() < 0.6 else str(rng.randint(0, 99))
+        op = rng.choice(_OPS)
+        left = self.expression(rng, depth - 1)
+        right = str(rng.randint(2, 3)) if op == '**' else self.expression(rng, depth - 1)
+        ans = f'({left} {op} {right})'
+        if rng.random() < self.comments / 4:
+            ans = f'{ans} /* {self.words(rng)} */'
+        return ans
+
+    @staticmethod
+    def words(rng: random.Random) -> str:
+        return ' '.join(rng.choice(_WORDS) for _ in range(rng.randint(1, 6)))
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description='Write a synthetic SAS program to stdout.')
+    ap.add_argument('--steps', type=int, default=100, help='PROC MEANS steps')
+    ap.add_argument('--expressions', type=int, default=2, help='most expression statements after each step')
+    ap.add_argument('--seed', type=int, default=0, help='seed of the generator')
+    args = ap.parse_args(argv)
+    print(SasCorpus(seed=args.seed, steps=args.steps, expressions=args.expressions).program(), end='')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
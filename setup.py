@@ -1,5 +1,5 @@
 from distutils.core import setup
 setup(name='Compiler',
       version='0.5',
-      py_modules=['CompilerUtil', 'EmitterUtil', 'ParserUtil', 'PythonImport'], requires=['Utilities']
+      py_modules=['AstUtil', 'BatchUtil', 'CompilerUtil', 'EmitterUtil', 'ExpressionUtil', 'LazyImport', 'ParserUtil', 'PreprocessorUtil', 'PythonImport', 'ServerUtil'], requires=['Utilities']
       )
\ No newline at end of file
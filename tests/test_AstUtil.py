@@ -0,0 +1,64 @@
+import logging
+from unittest import TestCase, main
+
+from AstUtil import AstArena, AstNode
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+"""
+
+class Test_AstArena(TestCase):
+    def setUp(self):
+        # Build 1 + 2 bottom-up, the way the parser does.
+        self.arena = AstArena()
+        self.one = self.arena.add('number', value=1, start=0, end=1, lineno=1)
+        self.two = self.arena.add('number', value=2, start=4, end=5, lineno=1)
+        self.plus = self.arena.add('binop', children=[self.one, self.two], value='+', start=0, end=5, lineno=1)
+        self.arena.root = self.plus
+
+    def test_add(self):
+        # Test 1. The node columns are stored.
+        self.assertEqual(3, len(self.arena), 'fail test 1')
+        self.assertEqual('binop', self.arena.kind(self.plus), 'fail test 1 (kind)')
+        self.assertEqual('+', self.arena.value(self.plus), 'fail test 1 (value)')
+        self.assertEqual((0, 5), self.arena.span(self.plus), 'fail test 1 (span)')
+        # Test 2. The children are in order.
+        self.assertEqual([self.one, self.two], list(self.arena.children(self.plus)), 'fail test 2')
+        self.assertEqual([], list(self.arena.children(self.one)), 'fail test 2 (leaf)')
+
+    def test_walk(self):
+        # Test 1. Pre-order from the root.
+        self.assertEqual([self.plus, self.one, self.two], list(self.arena.walk()), 'fail test 1')
+        # Test 2. Find by kind.
+        self.assertEqual([self.one, self.two], list(self.arena.find('number')), 'fail test 2')
+        self.assertEqual([], list(self.arena.find('noSuchKind')), 'fail test 2 (missing kind)')
+
+    def test_node(self):
+        node = self.arena.node(self.plus)
+        self.assertEqual('binop', node.kind)
+        self.assertEqual([1, 2], [child.value for child in node])
+        self.assertEqual(AstNode(self.arena, self.plus), node)
+
+    def test_append_arena(self):
+        other = AstArena()
+        other.add('name', value='x')
+        roots = other.append_arena(self.arena, [self.plus], shift=10, line_shift=2, lo=0)
+        # Test 1. The copied nodes are renumbered, and their spans and lines are moved.
+        self.assertEqual([3], roots, 'fail test 1')
+        self.assertEqual((10, 15), other.span(3), 'fail test 1 (span)')
+        self.assertEqual(3, other.lineno(3), 'fail test 1 (line)')
+        # Test 2. The children point at the copies.
+        self.assertEqual([1, 2], list(other.children(3)), 'fail test 2')
+        other.root = roots[0]
+        self.assertEqual(self.arena.dump(), other.dump(), 'fail test 2 (dump)')
+
+    def test_dump(self):
+        exp = ["binop '+'", '  number 1', '  number 2']
+        self.assertEqual(exp, self.arena.dump())
+
+
+if __name__ == '__main__':
+    main()
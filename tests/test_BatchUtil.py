@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from BatchUtil import BatchCompiler, CompileCache, compile_file
+from CompilerUtil import SasCompilerUtil
+from EmitterUtil import EmitterUtil, PandasEmitterUtil
+from ParserUtil import SasParser
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+"""
+
+_PROGRAM = 'PROC MEANS data=cars;\nCLASS origin;\nVAR mpg;\nRUN;\n'
+_STEP = "means_cars = cars.groupby(['origin'], sort=True, observed=True)[['mpg']].agg(['count', 'mean', 'std', 'min', 'max'])"
+
+class Test_BatchCompiler(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp, 'sas')
+        self.out_dir = os.path.join(self.tmp, 'py')
+        self.table_dir = os.path.join(self.tmp, 'tables')
+        os.makedirs(os.path.join(self.src_dir, 'sub'))
+        for name in ('a.sas', 'b.sas', os.path.join('sub', 'c.sas')):
+            with open(os.path.join(self.src_dir, name), 'w') as f:
+                f.write(_PROGRAM)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_compile_file(self):
+        target = os.path.join(self.out_dir, 'a.py')
+        record = compile_file(os.path.join(self.src_dir, 'a.sas'), target, SasParser(table_dir=self.table_dir))
+        # Test 1. The program is written.
+        self.assertEqual('ok', record['status'], 'fail test 1')
+        self.assertTrue(os.path.isfile(target), 'fail test 1 (target)')
+        # Test 2. It has the body of the step, not just the banners.
+        with open(target) as f:
+            lines = f.read().splitlines()
+        self.assertIn(_STEP, lines, 'fail test 2')
+
+    def test_compile_dir(self):
+        # Test 1. Every program is compiled, keeping the dir structure.
+        bc = BatchCompiler(out_dir=self.out_dir, workers=2, table_dir=self.table_dir)
+        records = bc.compile_dir(self.src_dir)
+        self.assertEqual(3, len(records), 'fail test 1')
+        self.assertTrue(os.path.isfile(os.path.join(self.out_dir, 'sub', 'c.py')), 'fail test 1 (subdir)')
+        # Test 2. The manifest has a record per file.
+        with open(os.path.join(self.out_dir, BatchCompiler.manifest_name)) as f:
+            manifest = json.load(f)
+        self.assertEqual(3, manifest['files'], 'fail test 2')
+        self.assertEqual(0, manifest['failed'], 'fail test 2 (failed)')
+        self.assertTrue(all(r['status'] == 'ok' for r in manifest['results']), 'fail test 2 (status)')
+        # Test 3. Each program has the step.
+        with open(os.path.join(self.out_dir, 'sub', 'c.py')) as f:
+            self.assertIn(_STEP, f.read().splitlines(), 'fail test 3')
+        # Test 4. Compiling in this process leaves its logging as it was.
+        probe = logging.getLogger(f'{__name__}.probe')
+        probe.setLevel(logging.DEBUG)
+        BatchCompiler(out_dir=self.out_dir, workers=1, table_dir=self.table_dir).compile_dir(self.src_dir)
+        self.assertTrue(probe.isEnabledFor(logging.INFO), 'fail test 4')
+
+    def test_syntax_errors(self):
+        source = os.path.join(self.src_dir, 'bad.sas')
+        with open(source, 'w') as f:
+            f.write('PROC MEANS data= ;\nRUN;\n1 + ;\n')
+        target = os.path.join(self.out_dir, 'bad.py')
+        record = compile_file(source, target, SasParser(table_dir=self.table_dir))
+        # Test 1. All the errors are in the record, and nothing is written.
+        self.assertEqual('error', record['status'], 'fail test 1')
+        self.assertEqual(['line 1, column 18', 'line 3, column 5'], [d.split(':')[0] for d in record['diagnostics']], 'fail test 1')
+        self.assertFalse(os.path.exists(target), 'fail test 1 (target)')
+
+
+class Test_CompileCache(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'a.sas')
+        with open(self.source, 'w') as f:
+            f.write(_PROGRAM)
+        self.cache = CompileCache(os.path.join(self.tmp, 'cache'))
+        self.parser = SasParser(table_dir=os.path.join(self.tmp, 'tables'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_key(self):
+        key = self.cache.key(self.source, SasParser, EmitterUtil)
+        # Test 1. The key depends on the emitter and its options, and on the program.
+        self.assertEqual(key, self.cache.key(self.source, SasParser, EmitterUtil, {}), 'fail test 1')
+        self.assertNotEqual(key, self.cache.key(self.source, SasParser, PandasEmitterUtil), 'fail test 1 (class)')
+        self.assertNotEqual(key, self.cache.key(self.source, SasParser, EmitterUtil, {'x': 1}), 'fail test 1 (options)')
+        # Test 2. It depends on the compiler settings.
+        fused = self.cache.key(self.source, SasParser, EmitterUtil, compiler_settings=SasCompilerUtil().settings)
+        self.assertNotEqual(key, fused, 'fail test 2')
+        self.assertNotEqual(fused, self.cache.key(self.source, SasParser, EmitterUtil, compiler_settings=SasCompilerUtil(fuse=False).settings),
+                            'fail test 2 (fuse)')
+        with open(self.source, 'a') as f:
+            f.write('1 + 2')
+        self.assertNotEqual(key, self.cache.key(self.source, SasParser, EmitterUtil), 'fail test 3 (program)')
+
+    def test_compile_file(self):
+        target = os.path.join(self.tmp, 'out', 'a.py')
+        # Test 1. A miss compiles and fills the cache; a hit copies the same program.
+        r1 = compile_file(self.source, target, self.parser, cache=self.cache)
+        os.remove(target)
+        r2 = compile_file(self.source, target, self.parser, cache=self.cache)
+        self.assertEqual(('miss', 'hit'), (r1['cache'], r2['cache']), 'fail test 1')
+        self.assertNotIn('parse_seconds', r2, 'fail test 1 (not parsed)')
+        self.assertEqual({'hits': 1, 'misses': 1, 'evictions': 0}, self.cache.stats, 'fail test 1 (stats)')
+        # Test 2. The hit is the program a fresh compile (without the cache) writes, step body and all.
+        fresh = os.path.join(self.tmp, 'fresh', 'a.py')
+        compile_file(self.source, fresh, self.parser)
+        with open(fresh) as f:
+            exp = f.read()
+        self.assertIn(_STEP, exp.splitlines(), 'fail test 2 (body)')
+        with open(target) as f:
+            self.assertEqual(exp, f.read(), 'fail test 2')
+        # Test 3. Other compiler settings miss.
+        r3 = compile_file(self.source, target, self.parser, cache=self.cache, compiler_options={'fuse': False})
+        self.assertEqual('miss', r3['cache'], 'fail test 3')
+
+    def test_evict(self):
+        emitted = os.path.join(self.tmp, 'emitted.py')
+        with open(emitted, 'w') as f:
+            f.write('x' * 100)
+        self.cache.max_bytes = 250
+        # Test 1. The least recently used entry goes first.
+        for i, key in enumerate(('a', 'b')):
+            self.cache.put(key, emitted)
+            os.utime(self.cache.path(key), (i, i))
+        self.assertTrue(self.cache.get('a', os.path.join(self.tmp, 'a.py')), 'fail test 1')
+        self.cache.put('c', emitted)
+        self.assertEqual(1, self.cache.evictions, 'fail test 1 (evictions)')
+        self.assertFalse(os.path.exists(self.cache.path('b')), 'fail test 1 (b evicted)')
+        self.assertTrue(os.path.exists(self.cache.path('a')), 'fail test 1 (a kept)')
+        # Test 2. No temp files are left.
+        self.assertEqual(['a.py', 'c.py'], sorted(os.listdir(self.cache.cache_dir)), 'fail test 2')
+
+    def test_evict_workers(self):
+        # The pool workers only report what they add; the dir stays within the bound, whatever the number of workers.
+        src_dir = os.path.join(self.tmp, 'sas')
+        os.makedirs(src_dir)
+        for i in range(24):
+            with open(os.path.join(src_dir, f'p{i}.sas'), 'w') as f:
+                f.write(_PROGRAM.replace('cars', f'cars{i}'))
+        size = os.path.getsize(compile_file(self.source, os.path.join(self.tmp, 'one.py'), self.parser)['target'])
+        # Each worker writes less than the bound, but all of them together write more.
+        max_bytes = size * 10
+        bc = BatchCompiler(out_dir=os.path.join(self.tmp, 'py'), workers=4, table_dir=os.path.join(self.tmp, 'tables'),
+                           chunksize=1, cache_dir=self.cache.cache_dir, cache_max_bytes=max_bytes)
+        records = bc.compile_dir(src_dir)
+        self.assertTrue(all(r['cache'] == 'miss' and r['cache_bytes'] > 0 for r in records), 'fail test 1')
+        self.assertLessEqual(self.cache.scan()[1], max_bytes, 'fail test 1 (size)')
+        self.assertGreater(self.cache.scan()[1], 0, 'fail test 1 (entries)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
+import io
 import logging
 import sys
 from unittest import TestCase, main
 
-from CompilerUtil import SasCompilerUtil
+from CompilerUtil import PassManager, SasCompilerUtil, StepGraph
+from ParserUtil import SasParser
 
 sys.path.insert(0, '../../Utilities') # Fix for where your Utilities dir is.
 from LogitUtil import logit
@@ -58,5 +60,150 @@ class Test_CompilerUtil(TestCase):
         act = self.scu.get_option(option=test1_opt)
         self.assertEqual(test1_val, act)
 
+    @logit()
+    def test_add_proc(self):
+        s = SasParser()
+        s.input_lines = 'PROC MEANS data=cars mean std; CLASS origin type; VAR mpg;\nRUN;'
+        s.run()
+        d = self.scu.add_proc(s.ast, next(s.ast.find('proc')))
+        # Test 1. Options, statistics and statements.
+        self.assertEqual(_PROC_TYPE, self.scu.proc_type, 'fail test 1')
+        self.assertEqual('cars', d['DATA'], 'fail test 1 (DATA)')
+        self.assertEqual(['MEAN', 'STD'], d['STATS'], 'fail test 1 (STATS)')
+        self.assertEqual(['origin', 'type'], d['CLASS'], 'fail test 1 (CLASS)')
+        self.assertEqual(['mpg'], d['VAR'], 'fail test 1 (VAR)')
+        # Test 2. A missing option is None.
+        self.assertIsNone(d['BY'], 'fail test 2')
+        # Test 3. The option of a statement, like OUTPUT OUT=, is stored like the options of the step.
+        s.input_lines = 'PROC MEANS data=cars; CLASS origin; OUTPUT out=stats;\nRUN;'
+        s.run()
+        d = self.scu.add_proc(s.ast, next(s.ast.find('proc')))
+        self.assertEqual(('cars', 'stats', ['origin']), (d['DATA'], d['OUT'], d['CLASS']), 'fail test 3')
+        self.assertIsNone(d['OUTPUT'], 'fail test 3 (no statement)')
+
+    @logit()
+    def test_compile(self):
+        src = 'PROC MEANS data=cars mean; CLASS origin;\nRUN;\n(x + 1) * (x + 1) + 2 * 3'
+        unit = self.scu.compile(src, name='cars.sas')
+        # Test 1. Every pass ran, in order, with its sizes.
+        self.assertEqual(['lex', 'parse', 'analyze', 'fuse', 'optimize', 'dependencies', 'emit'], [r['pass'] for r in unit.stats], 'fail test 1')
+        lex = unit.stats[0]
+        self.assertEqual((len(src), len(unit.tokens)), (lex['input_size'], lex['output_size']), 'fail test 1 (lex)')
+        self.assertEqual(2, unit.stats[2]['output_size'], 'fail test 1 (analyze)')
+        self.assertTrue(all(r['wall_seconds'] >= 0 and r['unit'] == 'cars.sas' for r in unit.stats), 'fail test 1 (times)')
+        # Test 2. The program has the proc and the optimized expression.
+        self.assertTrue(any('groupby' in line for line in unit.lines), 'fail test 2')
+        self.assertIn('expr_0 = _t0 * _t0 + 6', unit.lines, 'fail test 2 (expression)')
+        # Test 3. With a target, the same program is written there instead.
+        target = io.StringIO()
+        streamed = self.scu.compile(src, target=target)
+        self.assertEqual([], streamed.lines, 'fail test 3')
+        self.assertEqual(unit.lines, target.getvalue().splitlines(), 'fail test 3 (program)')
+        self.assertEqual(len(unit.lines), streamed.stats[-1]['output_size'], 'fail test 3 (size)')
+
+    @logit()
+    def test_compile_interned(self):
+        # Test 1. The interned expressions of one unit do not outlive it, so the table stays the size of one program.
+        self.scu.compile('(x + 1) * (x + 1) + 2 * 3')
+        size = len(self.scu._expressions._interned)
+        for i in range(20):
+            self.scu.compile(f'(x{i} + 1) * (x{i} + 1) + 2 * 3')
+        self.assertEqual(size, len(self.scu._expressions._interned), 'fail test 1')
+
+    @logit()
+    def test_compile_errors(self):
+        src = 'PROC MEANS data=a;\n  VAR = x;\nRUN;\nPROC MEANS data=b MEAN;\n  VAR y;\nRUN;\n3 * ;\n'
+        unit = self.scu.compile(src)
+        # Test 1. Both errors are in the unit.
+        self.assertEqual([(2, 7), (7, 5)], [(d.lineno, d.column) for d in unit.diagnostics], 'fail test 1')
+        # Test 2. The step and the statement with errors are left out; the good step is emitted.
+        self.assertEqual(['b'], [options['DATA'] for _, options in unit.procs], 'fail test 2')
+        self.assertEqual([], unit.expressions, 'fail test 2 (expressions)')
+        self.assertIn("means_b = b[['y']].agg(['mean']).T", unit.lines, 'fail test 2 (emitted)')
+
+    @logit()
+    def test_pass_manager(self):
+        pm = PassManager()
+        calls = []
+        pm.register('a', lambda unit: calls.append('a') or (0, 0))
+        pm.register('c', lambda unit: calls.append('c') or (0, 0))
+        pm.register('b', lambda unit: calls.append('b') or (1, 2), before='c')
+        # Test 1. Passes run in the registered order.
+        self.assertEqual(['a', 'b', 'c'], pm.names, 'fail test 1')
+        unit = self.scu.compile('1')
+        records = pm.run(unit)
+        self.assertEqual(['a', 'b', 'c'], calls, 'fail test 1 (calls)')
+        # Test 2. Totals by pass.
+        totals = PassManager.totals(records + records)
+        self.assertEqual(2, totals['b']['units'], 'fail test 2')
+        self.assertEqual(4, totals['b']['output_size'], 'fail test 2 (size)')
+
+    @logit()
+    def test_dependencies(self):
+        src = ('PROC MEANS data=cars; OUTPUT OUT=stats; RUN;\nPROC MEANS data=trucks; RUN;\n'
+               'PROC MEANS data=STATS; RUN;\nstats * 2')
+        unit = self.scu.compile(src)
+        # Test 1. The third step and the expressions read what the first one writes; the second is independent.
+        self.assertEqual([set(), set(), {0}, {0}], unit.graph.deps, 'fail test 1')
+        self.assertEqual([[0, 1], [2, 3]], unit.graph.levels(), 'fail test 1 (levels)')
+        # Test 2. The sizes of the pass: steps and edges.
+        record = next(r for r in unit.stats if r['pass'] == 'dependencies')
+        self.assertEqual((4, 2), (record['input_size'], record['output_size']), 'fail test 2')
+
+    @logit()
+    def test_fuse_procs(self):
+        def means(data, **options):
+            return 'MEANS', dict(DATA=data, **options)
+        procs = [means('cars', CLASS=['origin'], VAR=['mpg'], STATS=['MEAN']),
+                 means('CARS', CLASS=['ORIGIN'], VAR=['weight', 'mpg'], STATS=['MAX']),
+                 means('cars', VAR=['mpg']),
+                 means('cars', VAR=['hp'], OUT='cars'),
+                 means('cars', VAR=['hp']),
+                 means('trucks')]
+        act = SasCompilerUtil.fuse_procs(procs)
+        # Test 1. The first two steps are one, with the variables of both and the options of each.
+        self.assertEqual(4, len(act), 'fail test 1')
+        proc_type, fused = act[0]
+        self.assertEqual(('MEANS', 'cars', ['origin'], ['mpg', 'weight']),
+                         (proc_type, fused['DATA'], fused['CLASS'], fused['VAR']), 'fail test 1 (options)')
+        self.assertEqual([procs[0][1], procs[1][1]], fused['STEPS'], 'fail test 1 (steps)')
+        # Test 2. Other CLASS variables: not fused. A step that writes its DATA= is fused, but ends the run.
+        self.assertEqual([2, None, None], [len(options.get('STEPS') or []) or None for _, options in act[1:]],
+                         'fail test 2')
+        # Test 3. The fused step reads and writes what its steps do.
+        self.assertEqual((['cars', 'cars'], ['cars']), SasCompilerUtil.step_datasets(*act[1]), 'fail test 3')
+        # Test 4. Without fuse, the pass is not run.
+        unit = SasCompilerUtil(fuse=False).compile('PROC MEANS data=a; RUN;\nPROC MEANS data=a; RUN;')
+        self.assertEqual(2, len(unit.procs), 'fail test 4')
+        self.assertNotIn('fuse', [r['pass'] for r in unit.stats], 'fail test 4 (pass)')
+
+
+class Test_StepGraph(TestCase):
+    def test_add(self):
+        graph = StepGraph()
+        graph.add(reads=['a'], writes=['b'])
+        graph.add(reads=['c'])
+        graph.add(reads=['b'], writes=['d'])
+        graph.add(writes=['A'])
+        graph.add(reads=['d'], writes=['d'])
+        graph.add(writes=['b'])
+        # Test 1. Read after write (2 after 0), write after read (3 after 0, the case of names does not matter),
+        # and write after write and read (5 after 0 and 2).
+        self.assertEqual([set(), set(), {0}, {0}, {2}, {0, 2}], graph.deps, 'fail test 1')
+        # Test 2. Levels: each step is one level after the latest step it needs.
+        self.assertEqual([[0, 1], [2, 3], [4, 5]], graph.levels(), 'fail test 2')
+        self.assertEqual([(0, 2), (0, 3), (0, 5), (2, 4), (2, 5)], graph.edges(), 'fail test 2 (edges)')
+
+    def test_independent(self):
+        graph = StepGraph()
+        for i in range(1000):
+            graph.add(reads=[f'ds{i}', 'shared'])
+        # Test 1. Steps that only read are independent: one level.
+        self.assertEqual(1, len(graph.levels()), 'fail test 1')
+        # Test 2. A write of the shared dataset waits for every reader.
+        step = graph.add(writes=['shared'])
+        self.assertEqual(set(range(1000)), graph.deps[step], 'fail test 2')
+
+
 if __name__ == '__main__':
     main()
@@ -1,6 +1,11 @@
+import importlib.util
+import io
 import logging
-from unittest import mock, TestCase, main
-from EmitterUtil import EmitterUtil
+import os
+import tempfile
+from unittest import mock, skipUnless, TestCase, main
+from CompilerUtil import SasCompilerUtil
+from EmitterUtil import ChunkedPandasEmitterUtil, EmitterHelpers, EmitterUtil, PandasEmitterUtil, PySparkEmitterUtil
 from LogitUtil import logit
 from CollectionUtil import CollectionUtil
 from datetime import datetime
@@ -20,6 +25,71 @@ class Test_EmitterUtil(TestCase):
     def test_emit(self):
         self._eu.emit()
 
+    @logit()
+    def test_emit_to(self):
+        self._eu.add_to_body(['one', 'two'])
+        self._eu.emit()
+        exp = '\n'.join(self._eu.program) + '\n'
+        # Test 1. Same text as emit(), for any buffer size.
+        for buffer_size in (1, 10, 1 << 16):
+            out = io.StringIO()
+            count = self._eu.emit_to(out, buffer_size=buffer_size)
+            self.assertEqual(exp, out.getvalue(), f'fail test 1 (buffer_size {buffer_size})')
+            self.assertEqual(len(self._eu.program), count, 'fail test 1 (count)')
+        # Test 2. A body generator is written after the added body lines.
+        out = io.StringIO()
+        self._eu.emit_to(out, body=(f'line{i}' for i in range(3)))
+        self.assertIn('two\nline0\nline1\nline2\n', out.getvalue(), 'fail test 2')
+
+    @logit()
+    def test_emit_to_minimized(self):
+        import tracemalloc
+        body = lambda n: (f"means_{i % 7} = cars.groupby(['origin'])[['mpg']].agg(['mean'])  # step {i}" for i in range(n))
+        pe = PandasEmitterUtil()
+        pe.spool_size = 1 << 10
+        # Test 1. The streamed program is the one emit() makes: the body, and only the imports it uses.
+        pe.add_to_body('x = pd.DataFrame()')
+        out = io.StringIO()
+        count = pe.emit_to(out, body=body(100))
+        pe.add_to_body(list(body(100)))
+        pe.emit()
+        self.assertEqual('\n'.join(pe.program) + '\n', out.getvalue(), 'fail test 1')
+        self.assertEqual(len(pe.program), count, 'fail test 1 (count)')
+        self.assertIn('import pandas as pd', pe.program, 'fail test 1 (imports)')
+        # Test 2. The body goes through the spool file, so memory does not grow with it.
+        class Discard(io.TextIOBase):
+            def write(self, s):
+                return len(s)
+        peaks = []
+        for n in (200, 800):
+            pe = PandasEmitterUtil()
+            pe.spool_size = 1 << 10
+            tracemalloc.start()
+            try:
+                pe.emit_to(Discard(), body=body(n), buffer_size=1 << 10)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        self.assertLess(peaks[1], peaks[0] * 1.5, f'fail test 2 ({peaks})')
+
+    @logit()
+    def test_shared_helpers(self):
+        helpers = EmitterHelpers()
+        emitters = [EmitterUtil(helpers=helpers) for _ in range(3)]
+        # Test 1. The year and the banners are computed once for the batch.
+        with mock.patch.object(helpers.du, 'now', wraps=helpers.du.now) as now, \
+                mock.patch.object(helpers.su, 'fill_string', wraps=helpers.su.fill_string) as fill:
+            programs = []
+            for eu in emitters:
+                eu.emit()
+                programs.append(eu.program)
+        self.assertEqual(1, now.call_count, 'fail test 1 (year)')
+        self.assertEqual(3, fill.call_count, 'fail test 1 (one per banner)')
+        # Test 2. The output is the same, and a caller may change the lines it gets.
+        self.assertEqual(programs[0], programs[2], 'fail test 2')
+        emitters[0].gen_header(header='body').append('changed')
+        self.assertEqual(5, len(emitters[1].gen_header(header='body')), 'fail test 2 (copy)')
+
     @logit()
     def test_preamble(self):
         cu = CollectionUtil()
@@ -57,5 +127,352 @@ class Test_EmitterUtil(TestCase):
         self.assertEqual(lines.pop(), act2.pop(), 'fail test 2 (penultimate item)')
 
 
+    @logit()
+    def test_step_function(self):
+        lines = ['def helper(x):', '    return x', '', '# step', 'a = helper(1)', 'for i in range(3):', '    a += i',
+                 '_t0 = a', 'b, c = _t0, 2']
+        hoisted, function = EmitterUtil.step_function('_step_0', lines)
+        # Test 1. The def stays at the top level.
+        self.assertEqual(['def helper(x):', '    return x'], hoisted, 'fail test 1')
+        # Test 2. The assigned names are global, but not the loop variable or the private names.
+        self.assertEqual(['def _step_0():', '    global a, b, c', '    # step'], function[:3], 'fail test 2')
+        scope = {}
+        exec('\n'.join(hoisted + function + ['_step_0()']), scope)
+        self.assertEqual((4, 4, 2), (scope['a'], scope['b'], scope['c']), 'fail test 2 (run)')
+        self.assertNotIn('i', scope, 'fail test 2 (local)')
+
+    @logit()
+    def test_output_name(self):
+        self.assertEqual(['means_a', 'means_b', 'means_a_2', 'means_a_3'],
+                         [self._eu.output_name(name) for name in ('means_a', 'means_b', 'means_a', 'means_a')])
+
+
+class Test_PandasEmitterUtil(TestCase):
+    def setUp(self):
+        self._pe = PandasEmitterUtil()
+        self._scu = SasCompilerUtil()
+        self._scu.proc_type = 'MEANS'
+        self._scu.init_options(default=None)
+
+    @logit()
+    def test_proc_means(self):
+        import pandas as pd
+        self._scu.add_option('DATA', 'lib.cars')
+        self._scu.add_option('CLASS', ['origin'])
+        self._scu.add_option('VAR', ['mpg'])
+        self._scu.add_option('STATS', ['N', 'MEAN', 'MAX'])
+        lines = self._pe.add_proc(self._scu)
+        # Test 1. One groupby and one agg call with every statistic.
+        exp = "means_lib_cars = lib_cars.groupby(['origin'], sort=True, observed=True)[['mpg']].agg(['count', 'mean', 'max'])"
+        self.assertIn(exp, lines, 'fail test 1')
+        self.assertEqual(lines, self._pe.emit_body()[-len(lines):], 'fail test 1 (body)')
+        # Test 2. The lines run.
+        lib_cars = pd.DataFrame({'origin': ['US', 'EU', 'US'], 'mpg': [20, 30, 24], 'weight': [3000, 2000, 3500]})
+        scope = {'lib_cars': lib_cars, 'print': lambda *args: None}
+        exec('\n'.join(lines), scope)
+        act = scope['means_lib_cars']
+        self.assertEqual([2, 22.0, 24], list(act.loc['US', 'mpg']), 'fail test 2')
+
+    @logit()
+    def test_proc_means_defaults(self):
+        self._scu.add_option('DATA', 'cars')
+        self._scu.add_option('STATS', ['NOPRINT'])
+        lines = self._pe.add_proc(self._scu)
+        # Test 1. No CLASS or VAR: the numeric columns, with the default statistics, and no print.
+        exp = "means_cars = cars.select_dtypes(\"number\").agg(['count', 'mean', 'std', 'min', 'max']).T"
+        self.assertEqual(['# PROC MEANS DATA=cars', exp], lines, 'fail test 1')
+        # Test 2. An unknown statistic is an error.
+        self._scu.add_option('STATS', ['P99X'])
+        with self.assertRaises(ValueError):
+            self._pe.add_proc(self._scu)
+
+    @logit()
+    def test_emit_imports(self):
+        self.assertEqual('import pandas as pd', self._pe.emit_imports()[-1])
+
+    @logit()
+    def test_program_imports(self):
+        self._scu.add_option('DATA', 'cars')
+        self._scu.add_option('VAR', ['mpg'])
+        self._pe.add_proc(self._scu)
+        # Test 1. The body does not use pd, so pandas is not imported.
+        program = list(self._pe.iter_program())
+        self.assertNotIn('import pandas as pd', program, 'fail test 1')
+        # Test 2. A body line that uses pd brings it back.
+        program = list(self._pe.iter_program(body=['print(pd.__version__)']))
+        self.assertIn('import pandas as pd', program, 'fail test 2')
+        # Test 3. With lazy_imports, pandas is a stand-in.
+        pe = PandasEmitterUtil(lazy_imports=True)
+        self.assertIn("pd = _LazyModule('pandas')", list(pe.iter_program(body=['df = pd.DataFrame()'])), 'fail test 3')
+        # Test 4. Without minimize_imports, everything declared is imported.
+        pe = PandasEmitterUtil(minimize_imports=False)
+        self.assertIn('import pandas as pd', list(pe.iter_program()), 'fail test 4')
+
+
+    @logit()
+    def test_parallel(self):
+        import pandas as pd
+        src = ('PROC MEANS data=cars mean; CLASS origin; VAR mpg; OUTPUT OUT=stats; RUN;\n'
+               'PROC MEANS data=cars max; VAR mpg; RUN;\n'
+               'PROC MEANS data=stats NOPRINT; RUN;\n'
+               'PROC MEANS data=trucks sum; RUN;\n')
+        cars = pd.DataFrame({'origin': ['US', 'EU', 'US'], 'mpg': [20, 30, 24]})
+        trucks = pd.DataFrame({'hp': [300, 400]})
+        scopes = []
+        for parallel in (False, True):
+            unit = SasCompilerUtil(emitter_options={'parallel': parallel, 'max_workers': 2}).compile(src)
+            printed = []
+            scope = {'cars': cars, 'trucks': trucks, 'print': printed.append}
+            exec('\n'.join(unit.lines), scope)
+            scopes.append((unit.lines, scope, printed))
+        (lines, scope, printed), (parallel_lines, parallel_scope, parallel_printed) = scopes
+        # Test 1. Each step is a function, run by _run_steps; the third step waits for the first.
+        self.assertIn('def _step_3():', parallel_lines, 'fail test 1')
+        self.assertIn('    (_step_2, {0}),', parallel_lines, 'fail test 1 (dependency)')
+        self.assertNotIn('def _step_0():', lines, 'fail test 1 (sequential)')
+        # Test 2. The same frames, and the same prints in the same order.
+        for name in ('means_cars', 'means_cars_2', 'stats', 'means_stats', 'means_trucks'):
+            pd.testing.assert_frame_equal(scope[name], parallel_scope[name])
+        self.assertEqual(3, len(parallel_printed), 'fail test 2')
+        for exp, act in zip(printed, parallel_printed):
+            pd.testing.assert_frame_equal(exp, act)
+        # Test 3. A chain of steps is emitted in order, without the pool.
+        unit = SasCompilerUtil(emitter_options={'parallel': True}).compile('PROC MEANS data=a; OUTPUT OUT=b; RUN;\n'
+                                                                           'PROC MEANS data=b; RUN;')
+        self.assertFalse(any('_run_steps' in line for line in unit.lines), 'fail test 3')
+        self.assertEqual(['print(means_a)', 'print(means_b)'], unit.lines[-7:-5], 'fail test 3 (prints)')
+
+    @logit()
+    def test_fused(self):
+        import pandas as pd
+        src = ('PROC MEANS data=cars mean; CLASS origin; VAR mpg; RUN;\n'
+               'PROC MEANS data=cars max std; CLASS origin; VAR weight mpg; RUN;\n'
+               'PROC MEANS data=cars sum NOPRINT; RUN;\n'
+               'PROC MEANS data=cars max; RUN;\n')
+        cars = pd.DataFrame({'origin': ['US', 'EU', 'US', 'JP'], 'mpg': [20, 30, 24, 33], 'weight': [3000, 2000, 3500, 2100]})
+        scopes = []
+        for fuse in (False, True):
+            unit = SasCompilerUtil(fuse=fuse).compile(src)
+            printed = []
+            scope = {'cars': cars, 'print': printed.append}
+            exec('\n'.join(unit.lines), scope)
+            scopes.append((unit.lines, scope, printed))
+        (_, scope, printed), (lines, fused_scope, fused_printed) = scopes
+        # Test 1. cars is aggregated twice, not four times.
+        self.assertEqual(2, sum('= cars.' in line for line in lines), 'fail test 1')
+        self.assertIn("means_cars = _means_cars[[('mpg', 'mean')]]", lines, 'fail test 1 (selection)')
+        # Test 2. Each step still has its own output, as without fusion; the prints too.
+        for name in ('means_cars', 'means_cars_2', 'means_cars_3', 'means_cars_4'):
+            pd.testing.assert_frame_equal(scope[name], fused_scope[name])
+        self.assertEqual(3, len(fused_printed), 'fail test 2')
+        for exp, act in zip(printed, fused_printed):
+            pd.testing.assert_frame_equal(exp, act)
+
+    @logit()
+    def test_instrument(self):
+        import json
+        import pandas as pd
+        src = 'PROC MEANS data=cars mean; CLASS origin; VAR mpg; RUN;\nPROC MEANS data=trucks max; RUN;\nx * 2'
+        cars = pd.DataFrame({'origin': ['US', 'EU', 'US'], 'mpg': [20, 30, 24]})
+        trucks = pd.DataFrame({'hp': [300, 400]})
+        tmp_dir = tempfile.mkdtemp()
+        report = os.path.join(tmp_dir, 'steps.jsonl')
+        try:
+            # Test 1. Without the option, the program has no probe code and no imports for it.
+            plain = SasCompilerUtil().compile(src).lines
+            self.assertEqual(plain, SasCompilerUtil(emitter_options={'instrument': None}).compile(src).lines, 'fail test 1')
+            self.assertFalse(any('_StepProbe' in line or line == 'import time' for line in plain), 'fail test 1 (probes)')
+            # Test 2. With it, each step appends one record to the report: the procs and then the expressions.
+            lines = SasCompilerUtil(emitter_options={'instrument': report}).compile(src).lines
+            scope = {'cars': cars, 'trucks': trucks, 'x': 3, 'print': lambda *args: None}
+            exec('\n'.join(lines), scope)
+            with open(report, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(['PROC MEANS DATA=cars', 'PROC MEANS DATA=trucks', 'expressions'],
+                             [r['label'] for r in records], 'fail test 2')
+            self.assertEqual(({'cars': 3}, {'means_cars': 2}), (records[0]['rows_in'], records[0]['rows_out']),
+                             'fail test 2 (rows)')
+            self.assertTrue(all(r['status'] == 'ok' and r['wall_seconds'] >= 0 for r in records), 'fail test 2 (status)')
+            self.assertEqual(6, scope['expr_0'], 'fail test 2 (program)')
+            # Test 3. A failed step is reported, and its error still stops the program.
+            del scope['trucks']
+            with self.assertRaises(NameError):
+                exec('\n'.join(lines), scope)
+            with open(report, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f][3:]
+            self.assertEqual(['ok', 'error'], [r['status'] for r in records], 'fail test 3')
+            self.assertIn('NameError', records[1]['error'], 'fail test 3 (error)')
+        finally:
+            if os.path.exists(report):
+                os.remove(report)
+            os.rmdir(tmp_dir)
+
+
+    @logit()
+    def test_shared_imports(self):
+        import pandas as pd
+        src = 'PROC MEANS data=cars mean; RUN;\nPROC MEANS data=trucks max; RUN;'
+        frames = {'cars': pd.DataFrame({'mpg': [20, 30]}), 'trucks': pd.DataFrame({'hp': [300, 400]})}
+        helpers = EmitterHelpers()
+        tmp_dir = tempfile.mkdtemp()
+        report = os.path.join(tmp_dir, 'steps.jsonl')
+        try:
+            # Test 1. With shared helpers, a plain program first does not take the imports of the next ones.
+            for options in ({}, {'instrument': report}, {'parallel': True}, {'parallel': True, 'instrument': report}):
+                options['minimize_imports'] = False
+                lines = SasCompilerUtil(helpers=helpers, emitter_options=options).compile(src).lines
+                scope = dict(frames, print=lambda *args: None)
+                exec('\n'.join(lines), scope)
+                self.assertEqual([300, 400], list(scope['trucks']['hp']), f'fail test 1 ({options})')
+            with open(report, encoding='utf-8') as f:
+                self.assertEqual(4, len(f.readlines()), 'fail test 1 (report)')
+        finally:
+            if os.path.exists(report):
+                os.remove(report)
+            os.rmdir(tmp_dir)
+
+
+class Test_ChunkedPandasEmitterUtil(TestCase):
+    def setUp(self):
+        self._scu = SasCompilerUtil()
+        self._scu.proc_type = 'MEANS'
+        self._scu.init_options(default=None)
+        self._scu.add_option('DATA', 'cars')
+        self._scu.add_option('CLASS', ['origin'])
+        self._scu.add_option('STATS', ['N', 'MEAN', 'STD', 'MIN', 'MAX', 'SUM', 'NOPRINT'])
+
+    @logit()
+    def test_proc_means(self):
+        import pandas as pd
+        cars = pd.DataFrame({'origin': ['US', 'EU', 'US', 'JP', 'US', 'EU', 'US'],
+                             'mpg': [1e6 + 20, 1e6 + 30, None, 1e6 + 35, 1e6 + 21, 1e6 + 29, 1e6 + 26],
+                             'weight': [3000, 2000, 3500, 1800, 3300, 2100, 3100]})
+        exp_scope = {'cars': cars}
+        exec('\n'.join(PandasEmitterUtil().add_proc(self._scu)), exp_scope)
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'cars.csv')
+        cars.to_csv(path, index=False)
+        try:
+            # Test 1. The chunked program gives the same statistics as the in-memory one, for any chunk size.
+            for chunksize in (1, 2, 3, 100):
+                ce = ChunkedPandasEmitterUtil(chunksize=chunksize, source=os.path.join(tmp_dir, '{data}.csv'))
+                scope = {'pd': pd}
+                exec('\n'.join(ce.add_proc(self._scu)), scope)
+                pd.testing.assert_frame_equal(exp_scope['means_cars'], scope['means_cars'], check_dtype=False)
+        finally:
+            os.remove(path)
+            os.rmdir(tmp_dir)
+
+    @logit()
+    def test_helpers_once(self):
+        ce = ChunkedPandasEmitterUtil()
+        ce.add_proc(self._scu)
+        ce.add_proc(self._scu)
+        # Test 1. The helper functions are emitted once per program.
+        body = ce.emit_body()
+        self.assertEqual(1, sum(1 for line in body if line.startswith('def _means_merge')), 'fail test 1')
+        # Test 2. MEDIAN cannot be merged across chunks.
+        self._scu.add_option('STATS', ['MEDIAN'])
+        with self.assertRaises(ValueError):
+            ce.add_proc(self._scu)
+
+    @logit()
+    def test_fused(self):
+        import pandas as pd
+        src = ('PROC MEANS data=cars mean NOPRINT; CLASS origin; VAR mpg; RUN;\n'
+               'PROC MEANS data=cars max std NOPRINT; CLASS origin; VAR weight mpg; RUN;\n'
+               'PROC MEANS data=cars sum NOPRINT; VAR weight; RUN;\n'
+               'PROC MEANS data=cars max NOPRINT; VAR mpg weight; RUN;\n')
+        cars = pd.DataFrame({'origin': ['US', 'EU', 'US', 'JP'], 'mpg': [20, 30, 24, 33], 'weight': [3000, 2000, 3500, 2100]})
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'cars.csv')
+        cars.to_csv(path, index=False)
+        options = {'chunksize': 3, 'source': os.path.join(tmp_dir, '{data}.csv')}
+        try:
+            scopes = []
+            for fuse in (False, True):
+                unit = SasCompilerUtil(emitter_class=ChunkedPandasEmitterUtil, emitter_options=options, fuse=fuse).compile(src)
+                scope = {}
+                exec('\n'.join(unit.lines), scope)
+                scopes.append((unit.lines, scope))
+            (_, scope), (lines, fused_scope) = scopes
+            # Test 1. The file is read twice, not four times.
+            self.assertEqual(2, sum(line.startswith('for chunk in') for line in lines), 'fail test 1')
+            # Test 2. Each step has the statistics it would have without fusion.
+            for name in ('means_cars', 'means_cars_2', 'means_cars_3', 'means_cars_4'):
+                pd.testing.assert_frame_equal(scope[name], fused_scope[name])
+        finally:
+            os.remove(path)
+            os.rmdir(tmp_dir)
+
+
+class Test_PySparkEmitterUtil(TestCase):
+    def setUp(self):
+        self._pe = PySparkEmitterUtil()
+        self._scu = SasCompilerUtil()
+        self._scu.proc_type = 'MEANS'
+        self._scu.init_options(default=None)
+        self._scu.add_option('DATA', 'cars')
+        self._scu.add_option('CLASS', ['origin'])
+
+    @logit()
+    def test_proc_means(self):
+        self._scu.add_option('VAR', ['mpg'])
+        self._scu.add_option('STATS', ['N', 'MEAN'])
+        lines = self._pe.add_proc(self._scu)
+        # Test 1. One groupBy and one agg of built-in functions.
+        exp = "means_cars = cars.groupBy('origin').agg(F.count('mpg').alias('mpg_N'), " \
+              "F.mean('mpg').alias('mpg_Mean')).orderBy('origin')"
+        self.assertEqual(['# PROC MEANS DATA=cars', exp, 'means_cars.show()'], lines, 'fail test 1')
+        # Test 2. Without VAR, the numeric columns come from the schema.
+        self._scu.add_option('VAR', None)
+        lines = self._pe.add_proc(self._scu)
+        self.assertIn("if isinstance(f.dataType, NumericType) and f.name not in ['origin']]", lines[1], 'fail test 2')
+        # Test 3. MEDIAN uses percentile_approx, which older Spark versions have (F.median needs Spark 3.4).
+        self._scu.add_option('VAR', ['mpg'])
+        self._scu.add_option('STATS', ['MEDIAN'])
+        lines = self._pe.add_proc(self._scu)
+        self.assertIn("agg(F.percentile_approx('mpg', 0.5).alias('mpg_Median'))", lines[1], 'fail test 3')
+
+    @logit()
+    def test_fused(self):
+        src = 'PROC MEANS data=cars mean; CLASS origin; VAR mpg; RUN;\nPROC MEANS data=cars max; CLASS origin; VAR hp; RUN;'
+        lines = SasCompilerUtil(emitter_class=PySparkEmitterUtil).compile(src).lines
+        # Test 1. One cached aggregation of both steps, then one select per step.
+        exp = ("_means_cars = cars.groupBy('origin').agg(F.mean('mpg').alias('mpg_Mean'), F.max('mpg').alias('mpg_Max'), "
+               "F.mean('hp').alias('hp_Mean'), F.max('hp').alias('hp_Max')).orderBy('origin').cache()")
+        self.assertIn(exp, lines, 'fail test 1')
+        self.assertIn("means_cars = _means_cars.select('origin', 'mpg_Mean')", lines, 'fail test 1 (first)')
+        self.assertIn("means_cars_2 = _means_cars.select('origin', 'hp_Max')", lines, 'fail test 1 (second)')
+
+    @logit()
+    def test_instrument(self):
+        pe = PySparkEmitterUtil(instrument='steps.jsonl')
+        self._scu.add_option('VAR', ['mpg'])
+        lines = pe.add_proc(self._scu)
+        # Test 1. The step is timed, but its rows are not counted: count() would run a Spark job.
+        self.assertIn("with _StepProbe(0, 'PROC MEANS DATA=cars', 'steps.jsonl') as _probe:", lines, 'fail test 1')
+        self.assertFalse(any('_probe.rows' in line for line in lines), 'fail test 1 (rows)')
+
+    @skipUnless(importlib.util.find_spec('pyspark'), 'pyspark is not installed')
+    @logit()
+    def test_local_session(self):
+        from pyspark.sql import SparkSession
+        from pyspark.sql import functions as F
+        from pyspark.sql.types import NumericType
+        spark = SparkSession.builder.master('local[1]').appName('test_PySparkEmitterUtil').getOrCreate()
+        try:
+            cars = spark.createDataFrame([('US', 20.0, 3000), ('EU', 30.0, 2000), ('US', 24.0, 3500)], ['origin', 'mpg', 'weight'])
+            self._scu.add_option('STATS', ['NOPRINT', 'N', 'MEAN', 'MAX'])
+            lines = self._pe.add_proc(self._scu)
+            scope = {'cars': cars, 'F': F, 'NumericType': NumericType}
+            exec('\n'.join(lines), scope)
+            rows = scope['means_cars'].collect()
+            self.assertEqual(['EU', 'US'], [row['origin'] for row in rows])
+            self.assertEqual((2, 22.0, 3500), (rows[1]['mpg_N'], rows[1]['mpg_Mean'], rows[1]['weight_Max']))
+        finally:
+            spark.stop()
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,107 @@
+import logging
+import sys
+from unittest import TestCase, main
+
+from ExpressionUtil import ExpressionUtil
+from ParserUtil import SasParser
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+"""
+
+class Test_ExpressionUtil(TestCase):
+    def setUp(self):
+        self.parser = SasParser()
+        self.eu = ExpressionUtil()
+
+    def lower(self, src: str):
+        self.parser.input_lines = src
+        root = self.parser.run()
+        return [self.eu.lower(self.parser.ast, child.index) for child in root]
+
+    def optimized(self, src: str) -> str:
+        (expr,) = self.lower(src)
+        return self.eu.to_source(self.eu.optimize(expr))
+
+    def test_lower(self):
+        # Test 1. Equal subexpressions are the same object.
+        (expr,) = self.lower('(x - 1) * (x - 1)')
+        self.assertIs(expr.args[0], expr.args[1], 'fail test 1')
+        # Test 2. Only the needed parentheses are emitted, for Python's precedence.
+        src = '(a - (b - c)); ((a - b) - c); (-2 ** 2); (-(x ** 2)); (a ** (b ** c)); (a ** b ** c)'
+        exp = ['a - (b - c)', 'a - b - c', '(-2) ** 2', '-x ** 2', 'a ** b ** c', '(a ** b) ** c']
+        self.assertEqual(exp, [self.eu.to_source(e) for e in self.lower(src)], 'fail test 2')
+
+    def test_fold_constants(self):
+        # Test 1. Constants are evaluated.
+        self.assertEqual('1024', self.optimized('2 ** 10'), 'fail test 1')
+        self.assertEqual('x + 7', self.optimized('x + 1 + 2 * 3'), 'fail test 1 (mixed)')
+        # Test 2. Identities are removed, but x * 0 and division by zero are kept.
+        self.assertEqual('x', self.optimized('- - x * 1 + 0'), 'fail test 2')
+        self.assertEqual('-x', self.optimized('0 - x'), 'fail test 2 (negate)')
+        self.assertEqual('x * 0', self.optimized('x * 0'), 'fail test 2 (NaN)')
+        self.assertEqual('1 / 0', self.optimized('1 / 0'), 'fail test 2 (divide by zero)')
+        # Test 3. Dividing by 1, or multiplying by 1.0, makes a float of an int x: those are kept.
+        self.assertEqual('x / 1', self.optimized('x / 1'), 'fail test 3')
+        self.assertEqual('x * 1.0', self.optimized('x * (2 / 2)'), 'fail test 3 (float one)')
+        self.assertEqual('x / 1.0', self.optimized('x / (4 / 4)'), 'fail test 3 (float divisor)')
+        # Test 4. A result bigger than max_fold_bits is left to run time, and the program can still be emitted.
+        big = str(9 ** 64)
+        self.assertEqual(f'{big} ** 64', self.optimized('(9 ** 64) ** 64'), 'fail test 4')
+        (expr,) = self.lower('((9 ** 64) ** 64) ** 2')
+        self.assertEqual([f'_t0 = {big} ** 64', 'y = _t0 * _t0'], self.eu.to_python([self.eu.optimize(expr)], ['y']),
+                         'fail test 4 (nested)')
+        self.assertEqual(f'{2 ** 3840} / 3', self.optimized('(2 ** 64) ** 60 / 3'), 'fail test 4 (too large for a float)')
+
+    def test_reduce_strength(self):
+        self.assertEqual('x * x', self.optimized('x ** 2'), 'fail test 1')
+        self.assertEqual('1.0 / x', self.optimized('x ** -1'), 'fail test 2')
+        self.assertEqual('x ** 9', self.optimized('x ** 9'), 'fail test 3')
+
+    def test_to_python(self):
+        exprs = [self.eu.optimize(e) for e in self.lower('(price - 6) ** 2 + (price - 6) ** 2; (price - 6) / 2')]
+        act = self.eu.to_python(exprs, ['y', 'z'], names=lambda n: f"df['{n}']")
+        exp = ["_t0 = df['price'] - 6", '_t1 = _t0 * _t0', 'y = _t1 + _t1', 'z = _t0 / 2']
+        self.assertEqual(exp, act, 'fail test 1')
+        # Test 2. The emitted code gives the same values as the original expressions.
+        env = {'df': {'price': 10.5}}
+        exec('\n'.join(act), env)
+        self.assertEqual((10.5 - 6) ** 2 * 2, env['y'], 'fail test 2')
+        # Test 3. Without CSE, each expression is emitted whole.
+        no_cse = ExpressionUtil(eliminate_cse=False).to_python(exprs[1:], ['z'])
+        self.assertEqual(['z = (price - 6) / 2'], no_cse, 'fail test 3')
+
+    def test_names(self):
+        exprs = self.lower('(price - 6) * weight + price; cyl / 2')
+        self.assertEqual(['price', 'weight', 'cyl'], self.eu.names(exprs), 'fail test 1')
+        self.assertEqual([], self.eu.names(self.lower('2 * 3')), 'fail test 2')
+
+    def test_deep_expression(self):
+        # Test 1. A chain deeper than the recursion limit is lowered, optimized and emitted.
+        n = sys.getrecursionlimit() * 2
+        (expr,) = self.lower(' + '.join(f'x{i % 3} * {i}' for i in range(2, n)))
+        exp = ' + '.join(f'x{i % 3} * {i}' for i in range(2, n))
+        self.assertEqual(exp, self.eu.to_source(self.eu.optimize(expr)), 'fail test 1')
+        # Test 2. Folding the whole chain gives one constant.
+        (expr,) = self.lower(' + '.join(str(i) for i in range(1, n)))
+        self.assertEqual(str(n * (n - 1) // 2), self.eu.to_source(self.eu.optimize(expr)), 'fail test 2')
+        # Test 3. A repeated subexpression under the chain still becomes one temporary.
+        (expr,) = self.lower(' + '.join(['(a - 1) * (a - 1)'] * n))
+        lines = self.eu.to_python([self.eu.optimize(expr)], ['y'])
+        self.assertEqual(['_t0 = a - 1', '_t1 = _t0 * _t0'], lines[:2], 'fail test 3')
+        self.assertEqual(' + '.join(['_t1'] * n), lines[-1][len('y = '):], 'fail test 3 (chain)')
+
+    def test_clear(self):
+        (expr,) = self.lower('(x - 1) * 2')
+        self.assertIs(expr, self.lower('(x - 1) * 2')[0], 'fail test 1')
+        # Test 2. After clear(), nothing is interned, and new nodes are not the old ones.
+        self.eu.clear()
+        self.assertEqual(0, len(self.eu._interned), 'fail test 2')
+        self.assertIsNot(expr, self.lower('(x - 1) * 2')[0], 'fail test 2 (new node)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import logging
+import os
+import subprocess
+import sys
+from unittest import TestCase, main
+
+from LazyImport import LazyModule
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+"""
+
+_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class Test_LazyModule(TestCase):
+    def test_lazy(self):
+        lm = LazyModule('json')
+        # Test 1. Nothing is imported until an attribute is read.
+        self.assertIn('not imported', repr(lm), 'fail test 1')
+        self.assertEqual('[1]', lm.dumps([1]), 'fail test 1 (attribute)')
+        self.assertIn("'json' (imported)", repr(lm), 'fail test 1 (imported)')
+        # Test 2. The attribute is kept on the LazyModule.
+        self.assertIn('dumps', vars(lm), 'fail test 2')
+        with self.assertRaises(AttributeError):
+            lm.no_such_function
+
+    def test_cold_start(self):
+        probe = ('import sys, time, logging\n'
+                 'start = time.perf_counter()\n'
+                 'import ParserUtil, EmitterUtil, CompilerUtil\n'
+                 'elapsed = time.perf_counter() - start\n'
+                 'loaded = [m for m in ("ply", "ply.yacc", "StringUtil", "DateUtil", "pandas") if m in sys.modules]\n'
+                 'print(elapsed, loaded, len(logging.getLogger().handlers))\n')
+        out = subprocess.run([sys.executable, '-c', probe], cwd=_REPO, check=True, capture_output=True, text=True).stdout
+        # Test 1. No output, no PLY or Utilities, and no logging handlers at import.
+        elapsed, rest = out.strip().split(' ', 1)
+        self.assertEqual('[] 0', rest, 'fail test 1')
+        # Test 2. A loose budget, so a slow machine does not fail it. See benchmarks/bench_import.py for the real one.
+        self.assertLess(float(elapsed), 1.0, 'fail test 2')
+
+
+if __name__ == '__main__':
+    main()
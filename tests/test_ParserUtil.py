@@ -1,8 +1,13 @@
+import io
 import logging
+import mmap
+import os
+import shutil
 import sys
+import tempfile
 from unittest import TestCase, main
 
-from ParserUtil import SasParser
+from ParserUtil import FastLexer, IncrementalParser, ParserPool, ParseTableCache, RuleProfiler, SasParser, StatementSplitter
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -19,4 +24,323 @@ class Test_SasParser(TestCase):
     def test_proc_data(self):
         s = SasParser()
         s.input_lines = '** comment **;\nPROC MEANS data=Hello; /* comment */\nRUN;'
-        s.run()
\ No newline at end of file
+        root = s.run()
+        # The comments are removed before lexing, so the proc is parsed.
+        self.assertEqual(['proc'], [child.kind for child in root])
+        self.assertEqual(2, root.children[0].lineno)
+        self.assertEqual('PROC MEANS data=Hello; /* comment */\nRUN;', s.input_lines[slice(*root.children[0].span)])
+
+    def test_run_stream(self):
+        # Test 1. Parse a file object with two procs.
+        s = SasParser()
+        src = 'PROC MEANS data=Hello;\nRUN;\nPROC MEANS data=World;\nRUN;\n'
+        s.run_stream(io.StringIO(src), block_size=4)
+        self.assertEqual(['program', 'proc', 'option', 'name', 'proc', 'option', 'name'],
+                         [s.ast.kind(i) for i in s.ast.walk()], 'fail test 1')
+        tree = [(s.ast.kind(i), s.ast.value(i), s.ast.span(i)) for i in s.ast.walk()]
+        # Test 2. Parse a path: the same tree.
+        with tempfile.NamedTemporaryFile('w', suffix='.sas', delete=False) as f:
+            f.write(src)
+        try:
+            s.run_stream(f.name)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(tree, [(s.ast.kind(i), s.ast.value(i), s.ast.span(i)) for i in s.ast.walk()], 'fail test 2')
+        # Test 3. A large file through an mmap, in small blocks (which split statements, comments and UTF-8 chars),
+        # gives the tree of parsing the whole text.
+        steps = [f'/* étape {i} */ PROC MEANS data=lib.ds{i} mean;\n  VAR x{i} y;\nRUN;\n(x{i} - {i}) * 2;\n' for i in range(2000)]
+        big = ''.join(steps) + 'a - b\n'
+        s.parse(big)
+        exp = [(s.ast.kind(i), s.ast.value(i), s.ast.span(i), s.ast.lineno(i)) for i in s.ast.walk()]
+        with tempfile.NamedTemporaryFile('wb', suffix='.sas', delete=False) as f:
+            f.write(big.encode('utf-8'))
+        try:
+            with open(f.name, 'rb') as fb, mmap.mmap(fb.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                root = s.run_stream(mm, block_size=4093)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(2000 * 2 + 1, len(root.children), 'fail test 3')
+        self.assertEqual(exp, [(s.ast.kind(i), s.ast.value(i), s.ast.span(i), s.ast.lineno(i)) for i in s.ast.walk()],
+                         'fail test 3 (tree)')
+        self.assertEqual([], s.diagnostics, 'fail test 3 (diagnostics)')
+
+    def test_ast(self):
+        s = SasParser()
+        s.input_lines = 'PROC MEANS data=Hello;\nRUN;\n1 + 2 * 3'
+        root = s.run()
+        # Test 1. One node per proc and expression statement.
+        self.assertEqual('program', root.kind, 'fail test 1')
+        self.assertEqual(['proc', 'binop'], [child.kind for child in root], 'fail test 1 (children)')
+        # Test 2. The DATA option holds the dataset name.
+        name = next(s.ast.find('name'))
+        self.assertEqual('Hello', s.ast.value(name), 'fail test 2')
+        # Test 3. Spans point back into the source.
+        proc = root.children[0]
+        self.assertEqual('PROC MEANS data=Hello;\nRUN;', s.input_lines[slice(*proc.span)], 'fail test 3')
+        self.assertEqual(3, s.ast.lineno(root.children[1].index), 'fail test 3 (lineno)')
+
+    def test_expression_statements(self):
+        s = SasParser()
+        # Test 1. Without a ';' between them, a - b is one expression; with it, two statements.
+        s.input_lines = 'a\n- b'
+        self.assertEqual(['binop'], [child.kind for child in s.run()], 'fail test 1')
+        s.input_lines = 'a;\n- b;'
+        self.assertEqual(['name', 'unop'], [child.kind for child in s.run()], 'fail test 1 (two statements)')
+        # Test 2. Only the last expression of the program may leave out its ';'.
+        s.input_lines = 'a\nb'
+        s.run()
+        self.assertEqual(["Syntax error at 'b'"], [d.message for d in s.diagnostics], 'fail test 2')
+
+    def test_grammar_conflicts(self):
+        from ply import yacc
+        # Test 1. The LALR tables are built with no shift/reduce or reduce/reduce conflicts.
+        out = io.StringIO()
+        # (PLY only counts the conflicts in debug mode.)
+        with tempfile.TemporaryDirectory() as table_dir:
+            yacc.yacc(module=SasParser(table_dir=table_dir), tabmodule='_no_parsetab', write_tables=False,
+                      debug=True, debuglog=yacc.NullLogger(), errorlog=yacc.PlyLogger(out))
+        self.assertNotIn('conflict', out.getvalue(), 'fail test 1')
+
+    def test_proc_statements(self):
+        s = SasParser()
+        s.input_lines = 'PROC MEANS data=cars mean n; CLASS origin;\nVAR mpg weight;\nRUN;'
+        s.run()
+        # Keyword options follow DATA=, and the statements are children of the proc.
+        exp = [('proc', 'MEANS'), ('option', 'DATA'), ('name', 'cars'), ('option', 'MEAN'), ('option', 'N'),
+               ('statement', 'CLASS'), ('name', 'origin'), ('statement', 'VAR'), ('name', 'mpg'), ('name', 'weight')]
+        self.assertEqual(exp, [(s.ast.kind(i), s.ast.value(i)) for i in s.ast.walk()][1:])
+
+    def test_error_recovery(self):
+        src = ('PROC MEANS data= ;\n  VAR y;\nRUN;\n'
+               'PROC MEANS data=c;\n  VAR = z;\n  CLASS k;\nRUN;\n'
+               '1 + ;\n2 * 3;\n'
+               'PROC MEANS data=d # MAX;\nRUN;\n'
+               'PROC MEANS data=e;\n  VAR q;\n')
+        for fast in (False, True):
+            s = SasParser(fast=fast)
+            root = s.parse(src)
+            # Test 1. Every error is found in one parse, with its line and column.
+            exp1 = [(1, 18, "Syntax error at ';'"), (5, 7, "Syntax error at '='"), (8, 5, "Syntax error at ';'"),
+                    (10, 19, "Illegal character '#'"), (14, 1, 'Syntax error at end of input')]
+            self.assertEqual(exp1, [(d.lineno, d.column, d.message) for d in s.diagnostics], f'fail test 1 (fast={fast})')
+            self.assertEqual(src.index('VAR = z') + 4, s.diagnostics[1].offset, f'fail test 1 (fast={fast}, offset)')
+            # Test 2. Parsing goes on after each error. The skipped text is an 'error' node; the step without RUN; is lost.
+            exp2 = ['proc', 'proc', 'error', 'binop', 'proc']
+            self.assertEqual(exp2, [child.kind for child in root], f'fail test 2 (fast={fast})')
+            self.assertEqual(['error', 'statement'], [child.kind for child in root.children[0]], f'fail test 2 (fast={fast})')
+            self.assertEqual(['option', 'error', 'statement'], [child.kind for child in root.children[1]], f'fail test 2 (fast={fast})')
+            # Test 3. A good program has no diagnostics.
+            s.parse('PROC MEANS data=a;\nRUN;')
+            self.assertEqual([], s.diagnostics, f'fail test 3 (fast={fast})')
+
+
+
+class Test_FastLexer(TestCase):
+    def lex_all(self, parser, src):
+        lexer = parser._lexer
+        lexer.lineno = 1
+        lexer.input(src)
+        return [(t.type, t.value, t.lineno, t.lexpos) for t in lexer]
+
+    def test_same_tokens_as_ply(self):
+        src = 'PROC MEANS data=lib.cars1;\n\n RUN;\n1 + 2 * (3 / 4) ** 5  \t'
+        exp = self.lex_all(SasParser(), src)
+        act = self.lex_all(SasParser(fast=True), src)
+        self.assertIsInstance(SasParser(fast=True)._lexer, FastLexer)
+        self.assertEqual(exp, act)
+
+    def test_keywords(self):
+        act = self.lex_all(SasParser(fast=True), 'proc Means DATA=run.x')
+        self.assertEqual(['PROC', 'MEANS', 'DATA', 'EQUALS', 'DATASETNAME'], [t[0] for t in act])
+
+    def test_run(self):
+        s = SasParser(fast=True)
+        s.input_lines = 'PROC MEANS data=Hello;\nRUN;\n'
+        root = s.run()
+        self.assertEqual(['proc'], [child.kind for child in root])
+
+
+class Test_StatementSplitter(TestCase):
+    def test_split(self):
+        src = "PROC MEANS data=a; /* x ; y */ RUN; title 'a;b'; last"
+        exp = ['PROC MEANS data=a;', ' /* x ; y */ RUN;', " title 'a;b';", ' last']
+        # Test 1. The statements do not depend on the block size.
+        for block_size in (1, 2, 3, 1000):
+            act = list(StatementSplitter.split(io.StringIO(src), block_size=block_size))
+            self.assertEqual(exp, act, f'fail test 1 (block_size {block_size})')
+        # Test 2. Binary input is decoded.
+        act2 = list(StatementSplitter.split(io.BytesIO(src.encode()), block_size=5))
+        self.assertEqual(exp, act2, 'fail test 2')
+
+class Test_IncrementalParser(TestCase):
+    def full_parse(self, text):
+        s = SasParser()
+        s.input_lines = text
+        s.run()
+        return s.ast
+
+    def assertSameTree(self, exp, act, msg):
+        exp_nodes = [(exp.kind(i), exp.value(i), exp.span(i), exp.lineno(i)) for i in exp.walk()]
+        act_nodes = [(act.kind(i), act.value(i), act.span(i), act.lineno(i)) for i in act.walk()]
+        self.assertEqual(exp_nodes, act_nodes, msg)
+
+    def test_run(self):
+        steps = [f'PROC MEANS data=d{i}; /* step {i} */\nRUN;\n' for i in range(5)]
+        text = ''.join(steps)
+        ip = IncrementalParser(SasParser())
+        # Test 1. The first run gives the same tree as a full parse.
+        ip.run(text)
+        self.assertSameTree(self.full_parse(text), ip.ast, 'fail test 1')
+        self.assertEqual(5, ip.misses, 'fail test 1 (misses)')
+        # Test 2. Editing one step reparses only that step. The later spans and lines move.
+        steps[2] = 'PROC MEANS\n  data=changed;\nRUN;\n'
+        text2 = ''.join(steps)
+        ip.run(text2)
+        self.assertEqual(6, ip.misses, 'fail test 2')
+        self.assertSameTree(self.full_parse(text2), ip.ast, 'fail test 2 (tree)')
+        # Test 3. A step that only differs in a comment is a cache hit.
+        text3 = text2.replace('/* step 4 */', '/* a much longer comment */')
+        ip.run(text3)
+        self.assertEqual(6, ip.misses, 'fail test 3')
+        self.assertSameTree(self.full_parse(text3), ip.ast, 'fail test 3 (tree)')
+
+    def test_open_comment(self):
+        # An edit that opens a comment swallows the steps after it.
+        text = 'PROC MEANS data=a;\nRUN;\nPROC MEANS data=b;\nRUN;\n'
+        ip = IncrementalParser(SasParser())
+        ip.run(text)
+        text2 = text.replace('RUN;\nPROC', 'RUN;\n/* PROC', 1)
+        root = ip.run(text2)
+        self.assertEqual(['proc'], [child.kind for child in root])
+        self.assertSameTree(self.full_parse(text2), ip.ast, 'fail test 1')
+
+    def test_edits(self):
+        # Every edit gives the tree and the errors of a fresh parse, also when it moves where a step ends.
+        def state(ip):
+            ast = ip.ast
+            nodes = [(ast.kind(i), ast.value(i), ast.span(i), ast.lineno(i)) for i in ast.walk()] if ast.root >= 0 else []
+            return nodes, [d.as_dict() for d in ip.diagnostics]
+        parser = SasParser(fast=True)
+        text = ('PROC MEANS data=a;\nRUN;\nx + 1;\nPROC MEANS data=b; VAR y;\nPROC MEANS data=c; /* c */\nRUN;\n'
+                '/* c */ y * 2;\nPROC MEANS data=d;\n')
+        edits = [text[:i] + text[i + 1:] for i in range(len(text))]
+        edits += [text.replace('RUN', 'R', 1), text.replace('RUN;', '', 1), text.replace('PROC', 'PRC', 2),
+                  text.replace('VAR', 'RUN', 1), text.replace('x + 1;', 'PROC MEANS data=z;', 1)]
+        edits += [text[:i] + insert + text[i:] for i in range(0, len(text), 3) for insert in ('/*', "'", ';', 'RUN;', 'PROC ')]
+        ip = IncrementalParser(parser)
+        for edit in edits:
+            ip.run(text)
+            ip.run(edit)
+            fresh = IncrementalParser(parser)
+            fresh.run(edit)
+            self.assertEqual(state(fresh), state(ip), f'fail test 1 ({edit!r})')
+
+    def test_diagnostics(self):
+        def full_diagnostics(text):
+            s = SasParser()
+            s.input_lines = text
+            s.run()
+            return [d.as_dict() for d in s.diagnostics]
+        bad = 'PROC MEANS data=b;\n  VAR = y;\nRUN;\n'
+        text = 'PROC MEANS data=a; /* a\n comment */ VAR = x;\nRUN;\n' + bad
+        ip = IncrementalParser(SasParser())
+        # Test 1. The first run reports the errors of a full parse.
+        ip.run(text)
+        self.assertEqual(2, len(ip.diagnostics), 'fail test 1')
+        self.assertEqual(full_diagnostics(text), [d.as_dict() for d in ip.diagnostics], 'fail test 1 (places)')
+        # Test 2. An edit before the steps moves their errors, including the column on the edited line.
+        text2 = 'x = 1; ' + text.replace('data=a', 'data=aaaa')
+        ip.run(text2)
+        self.assertEqual(full_diagnostics(text2), [d.as_dict() for d in ip.diagnostics], 'fail test 2')
+        # Test 3. A step taken from the cache keeps its error, in its new place.
+        misses = ip.misses
+        text3 = bad + text2
+        ip.run(text3)
+        self.assertEqual(misses, ip.misses, 'fail test 3 (cache hit)')
+        self.assertEqual(full_diagnostics(text3), [d.as_dict() for d in ip.diagnostics], 'fail test 3')
+        # Test 4. Fixing a step removes its error.
+        text4 = text3.replace('VAR = x', 'VAR x')
+        ip.run(text4)
+        self.assertEqual(full_diagnostics(text4), [d.as_dict() for d in ip.diagnostics], 'fail test 4')
+        self.assertEqual(3, len(ip.diagnostics), 'fail test 4 (count)')
+
+
+
+class Test_RuleProfiler(TestCase):
+    def test_profile(self):
+        src = 'PROC MEANS data=a;\nRUN;\nPROC MEANS data=b;\nRUN;\n1 + 2'
+        for fast in (False, True):
+            s = SasParser(fast=fast, profile=True)
+            self.assertIsInstance(s.profiler, RuleProfiler)
+            s.input_lines = src
+            s.run()
+            stats = {r['rule']: r for r in s.profiler.stats()}
+            # Test 1. The p_* and t_* functions are counted. (Keywords are matched by t_DATASETNAME too.)
+            self.assertEqual(2, stats['p_procmeans']['calls'], f'fail test 1 (fast={fast})')
+            self.assertEqual(10, stats['t_DATASETNAME']['calls'], f'fail test 1 (fast={fast}, tokens)')
+            self.assertEqual(2, stats['t_NUMBER']['calls'], f'fail test 1 (fast={fast}, numbers)')
+            # Test 2. The report is ranked by time.
+            out = io.StringIO()
+            s.profiler.dump(out, top=3)
+            lines = out.getvalue().splitlines()
+            self.assertEqual(4, len(lines), f'fail test 2 (fast={fast})')
+            seconds = [r['seconds'] for r in s.profiler.stats()]
+            self.assertEqual(sorted(seconds, reverse=True), seconds, f'fail test 2 (fast={fast}, order)')
+        # Test 3. Off by default.
+        self.assertIsNone(SasParser().profiler, 'fail test 3')
+
+class Test_ParseTableCache(TestCase):
+    def setUp(self):
+        self.table_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ParseTableCache(table_dir=self.table_dir).clear()
+        shutil.rmtree(self.table_dir, ignore_errors=True)
+
+    def test_build(self):
+        # Test 1. A cold build writes the lextab and parsetab modules.
+        s1 = SasParser(table_dir=self.table_dir)
+        self.assertEqual(1, s1.table_cache.misses, 'fail test 1')
+        lexname, parsename = s1.table_cache.module_names(SasParser)
+        files = os.listdir(self.table_dir)
+        self.assertIn(lexname + '.py', files, 'fail test 1 (lextab)')
+        self.assertIn(parsename + '.py', files, 'fail test 1 (parsetab)')
+        # Test 2. A second parser loads the tables from the cache.
+        s2 = SasParser(table_dir=self.table_dir)
+        self.assertEqual(1, s2.table_cache.hits, 'fail test 2')
+        s2.input_lines = 'PROC MEANS data=Hello;\nRUN;'
+        s2.run()
+
+    def test_grammar_hash(self):
+        # Test 1. The hash is stable.
+        self.assertEqual(ParseTableCache.grammar_hash(SasParser), ParseTableCache.grammar_hash(SasParser))
+        # Test 2. Changing a rule changes the hash.
+        class OtherParser(SasParser):
+            t_EQUALS = r'=='
+        self.assertNotEqual(ParseTableCache.grammar_hash(SasParser), ParseTableCache.grammar_hash(OtherParser))
+
+class Test_ParserPool(TestCase):
+    def setUp(self):
+        self.table_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.table_dir, ignore_errors=True)
+
+    def test_map(self):
+        texts = [f'PROC MEANS data=ds{i} MEAN;\n  VAR x{i} y;\nRUN;\n{i} + {i} * 2\n' * (i % 5 + 1) for i in range(40)]
+        exp = [SasParser().parse(text).arena.dump() for text in texts]
+        # Test 1. Threads with a cold table dir build the tables, and give the same trees as one parser.
+        for fast in (False, True):
+            with ParserPool(SasParser, workers=4, fast=fast, table_dir=self.table_dir) as pool:
+                act = [root.arena.dump() for root in pool.map(texts)]
+            self.assertEqual(exp, act, f'fail test 1 (fast={fast})')
+        # Test 2. Files are parsed with run_stream.
+        paths = []
+        for i, text in enumerate(texts[:4]):
+            paths.append(os.path.join(self.table_dir, f'p{i}.sas'))
+            with open(paths[-1], 'w') as f:
+                f.write(text)
+        with ParserPool(SasParser, workers=2, table_dir=self.table_dir) as pool:
+            self.assertEqual(exp[:4], [root.arena.dump() for root in pool.map_files(paths)], 'fail test 2')
+            # Test 3. A worker thread does not get the parser of the calling thread.
+            self.assertIsNot(pool.parser(), pool._executor.submit(pool.parser).result(), 'fail test 3')
@@ -0,0 +1,85 @@
+import logging
+from unittest import TestCase, main
+
+from PreprocessorUtil import SasPreprocessor
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+"""
+
+_SOURCE = ("** comment **;\n"
+           "PROC MEANS data=Hello; /* comment */\n"
+           "RUN;\n"
+           "title 'it''s /* not */ a comment; ok';\n"
+           "  * star ' comment\n spanning;\n"
+           "PROC/*x*/MEANS data=a; /* multi\nline */ RUN;")
+class Test_SasPreprocessor(TestCase):
+    def feed_all(self, pp: SasPreprocessor, block_size: int) -> list:
+        ans = []
+        for i in range(0, len(_SOURCE), block_size):
+            ans.extend(pp.feed(_SOURCE[i:i + block_size]))
+        rest = pp.close()
+        if rest is not None:
+            ans.append(rest)
+        return ans
+
+    def test_process(self):
+        act = SasPreprocessor().process(_SOURCE)
+        # Test 1. The comments are gone, but the quoted string is untouched.
+        self.assertNotIn('comment **', act, 'fail test 1 (star comment)')
+        self.assertNotIn('/* comment */', act, 'fail test 1 (block comment)')
+        self.assertNotIn('spanning', act, 'fail test 1 (multi-line star comment)')
+        self.assertIn("'it''s /* not */ a comment; ok'", act, 'fail test 1 (quoted string)')
+        # Test 2. A comment between two tokens still separates them.
+        self.assertIn('PROC MEANS data=a;', act, 'fail test 2')
+        # Test 3. Line numbers are kept.
+        self.assertEqual(_SOURCE.count('\n'), act.count('\n'), 'fail test 3')
+
+    def test_feed(self):
+        exp = SasPreprocessor().process(_SOURCE)
+        # Test 1. The statements do not depend on the block size.
+        for block_size in (1, 2, 3, 7, 1000):
+            act = self.feed_all(SasPreprocessor(), block_size)
+            self.assertEqual(exp, ''.join(act), f'fail test 1 (block_size {block_size})')
+            self.assertTrue(all(stmt.endswith(';') for stmt in act), f'fail test 1 (statements, block_size {block_size})')
+        # Test 2. Without stripping, the source is only split.
+        act2 = self.feed_all(SasPreprocessor(strip_comments=False), 4)
+        self.assertEqual(_SOURCE, ''.join(act2), 'fail test 2')
+        self.assertEqual(7, len(act2), 'fail test 2 (statements)')
+
+    def test_feed_slash_star_slash(self):
+        # '/*/' opens a comment without closing it, wherever the blocks split.
+        sources = ['PROC MEANS data=a; /*/ old: PROC MEANS data=b; RUN; */\nRUN;\n',
+                   'PROC MEANS data=a; /*// old; */ RUN; /**/ x; /***/ y; /*/*/ z;\n']
+        for src in sources:
+            exp = SasPreprocessor().process(src)
+            self.assertNotIn('old', exp, 'fail test 1')
+            for block_size in range(1, len(src) + 1):
+                pp = SasPreprocessor()
+                act = []
+                for i in range(0, len(src), block_size):
+                    act.extend(pp.feed(src[i:i + block_size]))
+                rest = pp.close()
+                if rest is not None:
+                    act.append(rest)
+                self.assertEqual(exp, ''.join(act), f'fail test 1 (block_size {block_size})')
+
+    def test_source_offset(self):
+        for block_size in (1, 1000):
+            pp = SasPreprocessor()
+            act = ''.join(self.feed_all(pp, block_size))
+            # Every char that was kept maps back to the same char in the source.
+            for i, c in enumerate(act):
+                if not c.isspace():
+                    self.assertEqual(c, _SOURCE[pp.source_offset(i)], f'fail at output offset {i} (block_size {block_size})')
+
+    def test_unterminated_comment(self):
+        act = SasPreprocessor().process('PROC MEANS; /* never closed\n RUN;')
+        self.assertEqual('PROC MEANS;', act)
+
+
+if __name__ == '__main__':
+    main()
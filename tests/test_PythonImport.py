@@ -3,7 +3,7 @@ import sys
 from unittest import TestCase, main
 
 from CompilerUtil import SasCompilerUtil
-from PythonImport import PythonImport, PandasStyleImport, PythonStyleImport
+from PythonImport import PythonImport, PandasStyleImport, PythonStyleImport, emit_imports
 # from Add_path import Add_path
 # Add_path.find_ancestor_with_child(child='Utilities')
 # sys.path.insert(0, '../../Utilities') # Fix for where your Utilities dir is.
@@ -114,6 +114,73 @@ class Test_PandasStyleImport(test_PythonImport):
         act1 = self.ps.emission()
         self.assertTrue(next((True for line in act1 if exp1 in line), False))
 
+    def test_emit_deferred(self):
+        # Test 1. A heavy lib is a stand-in, after the _LazyModule class. A light one is imported.
+        ps = PandasStyleImport(deferred=True)
+        ps.add_lib_method(lib='pandas', alias='pd')
+        ps.add_lib_method(lib='datetime', alias='dt')
+        ps.emit()
+        act1 = ps.emission()
+        self.assertEqual(["pd = _LazyModule('pandas')", 'import datetime as dt'], act1[-2:], 'fail test 1')
+        self.assertEqual(1, sum('class _LazyModule' in line for line in act1), 'fail test 1 (one class)')
+        # Test 2. The emitted lines run, and the module is imported on first use.
+        scope = {}
+        exec('\n'.join(act1), scope)
+        self.assertIn('_name', vars(scope['pd']), 'fail test 2')
+        self.assertTrue(callable(scope['pd'].DataFrame), 'fail test 2')
+
+    def test_minimize(self):
+        # Test 1. Only the aliases used by the body are kept.
+        self.ps.add_lib_method(lib='pandas', alias='pd')
+        self.ps.add_lib_method(lib='numpy', alias='np')
+        body = ['# np is not used', 'x = pd.DataFrame()', "print('np')"]
+        self.assertEqual(['np'], self.ps.minimize(body), 'fail test 1')
+        self.assertEqual({'pandas': 'pd'}, self.ps.libs, 'fail test 1')
+
+class Test_used_names(TestCase):
+    def test_used_names(self):
+        # Test 1. The names of a program, without attributes, strings or comments.
+        body = ['import os', 'x = pd.concat([a, b])  # np', "y = 'sys'"]
+        exp1 = {'pd', 'a', 'b'}
+        self.assertEqual(exp1, PythonImport.used_names(body), 'fail test 1')
+        # Test 2. A fragment that does not parse falls back to the identifiers.
+        exp2 = {'for', 'x', 'in', 'np', 'arange'}
+        self.assertEqual(exp2, PythonImport.used_names(['for x in np.arange(3):  # pd']), 'fail test 2')
+
+    def test_collect_used_names(self):
+        # Test 1. The names of a program, without attributes, strings or comments; also inside f-strings.
+        body = ['x = pd.concat([a, b])  # np', "y = 'sys'", 'z = f"{np.pi:.2f} {os.sep!r}"']
+        read = []
+        self.assertEqual({'pd', 'a', 'b', 'np', 'os', 'x', 'y', 'z'}, PythonImport.collect_used_names(iter(body), read.append),
+                         'fail test 1')
+        # Test 2. Each line is passed to the sink, once and in order.
+        self.assertEqual(body, read, 'fail test 2')
+        # Test 3. From a line that does not tokenize on, the identifiers are used.
+        body = ['if x:', '    y = 1', '  z = np.pi  # pd', 'w = sys.argv']
+        self.assertEqual({'x', 'y', 'z', 'np', 'pi', 'w', 'sys', 'argv'}, PythonImport.collect_used_names(body), 'fail test 3')
+
+class Test_emit_imports(TestCase):
+    def test_emit_imports(self):
+        # Test 1. Unused imports of both styles are dropped.
+        ps = PandasStyleImport()
+        ps.add_lib_method(lib='pandas', alias='pd')
+        py = PythonStyleImport()
+        py.add_lib_method(lib='collections', method='defaultdict')
+        py.add_lib_method(lib='collections', method='OrderedDict')
+        py.add_lib_method(lib='os.path')
+        py.add_lib_method(lib='sys')
+        body = ['d = defaultdict(list)', 'print(os.path.sep)']
+        exp1 = ['from collections import defaultdict', 'import os.path']
+        self.assertEqual(exp1, emit_imports([ps, py], body=body), 'fail test 1')
+        # Test 2. Deferred: the class is emitted once, before the first stand-in.
+        ps = PandasStyleImport()
+        ps.add_lib_method(lib='pandas', alias='pd')
+        py = PythonStyleImport()
+        py.add_lib_method(lib='numpy')
+        act2 = emit_imports([ps, py], deferred=True)
+        self.assertEqual(["pd = _LazyModule('pandas')", "numpy = _LazyModule('numpy')"], act2[-2:], 'fail test 2')
+        self.assertEqual(1, sum('class _LazyModule' in line for line in act2), 'fail test 2 (one class)')
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+from unittest import mock, TestCase, main
+
+import ServerUtil
+from ServerUtil import CompileServer, compile_remote
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+"""
+Interesting Python features:
+* Each test runs its server and client in one event loop with asyncio.run.
+"""
+
+_PROGRAM = 'PROC MEANS data=Hello MEAN;\n  VAR x;\nRUN;\n'
+class Test_CompileServer(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.table_dir = os.path.join(self.tmp, 'tables')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def run_server(self, *sessions, executor='thread', unix=False, **kw):
+        # Each list of requests is sent on its own connection, after the replies of the one before.
+        async def session():
+            server = CompileServer(workers=1, executor=executor, table_dir=self.table_dir, **kw)
+            path = os.path.join(self.tmp, 'compile.sock') if unix else None
+            await server.start(path=path)
+            try:
+                ans = []
+                for requests in sessions:
+                    if unix:
+                        ans.extend(await compile_remote(requests, path=path))
+                    else:
+                        ans.extend(await compile_remote(requests, port=server.address[1]))
+                return ans
+            finally:
+                await server.close()
+        return asyncio.run(session())
+
+    def test_compile(self):
+        # Test 1. Many requests on one connection, more than the in-flight limit; all replies come back.
+        requests = [{'source': _PROGRAM} for _ in range(10)]
+        replies = self.run_server(requests, [{'op': 'stats'}], max_in_flight=2)
+        for i, reply in enumerate(replies[:-1]):
+            self.assertEqual(i, reply['id'], 'fail test 1')
+            self.assertEqual('ok', reply['status'], 'fail test 1')
+            self.assertIn("means_Hello = Hello[['x']].agg(['mean']).T", reply['program'], 'fail test 1')
+            self.assertGreaterEqual(reply['latency_ms'], reply['compile_ms'], 'fail test 1')
+        # Test 2. Stats count the compiles.
+        self.assertEqual(10, replies[-1]['stats']['requests'], 'fail test 2')
+        self.assertIn('p99_ms', replies[-1]['stats'], 'fail test 2')
+        # Test 3. The latencies kept for the percentiles are bounded.
+        replies = self.run_server(requests, [{'op': 'stats'}], latency_window=4)
+        self.assertEqual(10, replies[-1]['stats']['requests'], 'fail test 3')
+        self.assertEqual(max(r['latency_ms'] for r in replies[6:10]), replies[-1]['stats']['max_ms'], 'fail test 3 (window)')
+        # Test 4. The thread worker leaves the logging of this process as it was.
+        probe = logging.getLogger(f'{__name__}.probe')
+        probe.setLevel(logging.DEBUG)
+        self.assertTrue(probe.isEnabledFor(logging.INFO), 'fail test 4')
+
+    def test_errors(self):
+        # Test 1. An unknown emitter and a bad line are errors, and the connection keeps working.
+        replies = self.run_server([{'source': _PROGRAM, 'emitter': 'NoSuchEmitter'}, {'id': 'x'}, {'source': _PROGRAM}])
+        self.assertEqual('error', replies[0]['status'], 'fail test 1')
+        self.assertIn('NoSuchEmitter', replies[0]['error'], 'fail test 1')
+        self.assertEqual('error', replies[1]['status'], 'fail test 1')
+        self.assertEqual('ok', replies[2]['status'], 'fail test 1')
+        # Test 2. A program with syntax errors gets all of them.
+        replies = self.run_server([{'source': 'PROC MEANS data= ;\nRUN;\n1 + ;\n'}])
+        self.assertEqual('error', replies[0]['status'], 'fail test 2')
+        self.assertEqual([1, 3], [d['lineno'] for d in replies[0]['diagnostics']], 'fail test 2')
+
+    def test_worker_compilers(self):
+        # Test 1. Each set of client options gets a compiler, but the worker keeps only the most recently used ones.
+        requests = [{'source': _PROGRAM, 'options': {'max_workers': i}} for i in range(5)] + [{'source': _PROGRAM}]
+        with mock.patch.object(ServerUtil, 'max_worker_compilers', 2):
+            replies = self.run_server(requests)
+        self.assertTrue(all(reply['status'] == 'ok' for reply in replies), 'fail test 1')
+        self.assertEqual([('PandasEmitterUtil', '{"max_workers": 4}'), ('PandasEmitterUtil', '{}')],
+                         list(ServerUtil._worker_compilers), 'fail test 1 (kept)')
+
+    def test_process_pool(self):
+        # Test 1. Process workers over a Unix socket, with the PySpark emitter chosen by name.
+        replies = self.run_server([{'source': _PROGRAM, 'emitter': 'PySparkEmitterUtil'}], executor='process', unix=True)
+        self.assertEqual('ok', replies[0]['status'], 'fail test 1')
+        self.assertIn("F.mean('x').alias('x_Mean')", replies[0]['program'], 'fail test 1')
+
+
+if __name__ == '__main__':
+    main()